@@ -24,7 +24,15 @@
 
 import os
 import re
+import random
 import errno
+import time
+import collections
+import StringIO
+import array
+import sys
+import threading
+import Queue
 
 # bitcointools -- modified deserialize.py to return raw transaction
 import BCDataStream
@@ -32,8 +40,11 @@ import deserialize
 import util
 import logging
 import base58
+import bloom
+import blkindex
+import readconf
 
-SCHEMA_VERSION = "Abe35"
+SCHEMA_VERSION = "Abe39"
 
 CONFIG_DEFAULTS = {
     "dbtype":             None,
@@ -51,6 +62,25 @@ CONFIG_DEFAULTS = {
     "keep_scriptsig":     True,
     "import_tx":          [],
     "default_loader":     "default",
+    "batch_insert":       None,
+    "id_block_size":      None,
+    "txout_cache_size":   None,
+    "pubkey_cache_size":  None,
+    "tx_bloom_bytes":     None,
+    "tx_bloom_fp_rate":   0.001,
+    "tx_bloom_file":      None,
+    "blkfile_index":      None,
+    "parse_workers":      None,
+    "bulk_load":          None,
+    "block_cache_size":   100000,
+    "rpc_timeout":        60,
+    "rpc_pool_size":      2,
+    "rpc_prefetch":       0,
+    "rpc_batch_size":     10,
+    "rpc_raw_blocks":     True,
+    "mempool_expiry":     14 * 24 * 60 * 60,
+    "datadir_workers":    None,
+    "deadlock_retries":   3,
 }
 
 WORK_BITS = 304  # XXX more than necessary.
@@ -102,6 +132,47 @@ MAX_SCRIPT = 1000000
 
 NO_CLOB = 'BUG_NO_CLOB'
 
+# Sequences whose identifiers new_id hands out from blocks reserved in
+# advance when the database's id_block_size exceeds 1.
+ID_BLOCK_KEYS = ('tx', 'txout', 'txin', 'pubkey', 'block')
+
+# MySQL's limit on auto_increment_increment, and so on id_block_size
+# with sequence_type=mysql.
+MYSQL_MAX_AUTO_INCREMENT_INCREMENT = 65535
+
+# Blocks queued per parse-workers process ahead of the importer.
+PARSE_BLOCKS_PER_WORKER = 4
+
+# Secondary indexes that bulk-load creates after loading all blocks.
+# Block import does not read them while bulk loading.
+BULK_LOAD_INDEXES = [
+    ("block_tx", "x_block_tx_tx",
+     "CREATE INDEX x_block_tx_tx ON block_tx (tx_id)"),
+    ("txout", "x_txout_pubkey",
+     "CREATE INDEX x_txout_pubkey ON txout (pubkey_id)"),
+    ("txin", "x_txin_txout",
+     "CREATE INDEX x_txin_txout ON txin (txout_id)"),
+    ("address_history", "x_address_history_block",
+     "CREATE INDEX x_address_history_block ON address_history (block_id)"),
+    ]
+
+# Most values bound to one "IN (?, ?, ...)" list.
+IN_LIST_MAX = 500
+
+# Rows fetched at a time by selectiter.
+FETCH_ROWS = 1000
+
+INSERT_RE = re.compile(r"\s*INSERT INTO (\w+)\s*\(([^)]*)\)")
+
+# Error codes, by driver module, of deadlocks, serialization failures,
+# and lock wait timeouts, after which a datadir load is retried.
+LOCK_CONFLICT_CODES = {
+    "psycopg2":  ("40P01", "40001", "55P03"),
+    "MySQLdb":   (1205, 1213),
+    "cx_Oracle": (60, 8177),
+    }
+SQLITE_LOCK_CONFLICTS = ("database is locked", "database table is locked")
+
 # XXX This belongs in another module.
 class InvalidBlock(Exception):
     pass
@@ -113,6 +184,145 @@ class MerkleRootMismatch(InvalidBlock):
         return 'Block header Merkle root does not match its transactions. ' \
             'block hash=%s' % (ex.block_hash[::-1].encode('hex'),)
 
+class CachedBlock(object):
+    """Height and ancestry of a block, as kept in DataStore._blocks."""
+    __slots__ = ('height', 'prev_id', 'search_id')
+
+    def __init__(block, height, prev_id, search_id):
+        block.height = height
+        block.prev_id = prev_id
+        block.search_id = search_id
+
+class ImportBatch(object):
+    """
+    Rows collected while importing a block's transactions, written
+    with one executemany() per statement by DataStore.flush_batch.
+    Statements are flushed in the order first seen, which satisfies
+    the foreign keys tx <- txout, tx <- txin <- unlinked_txin.
+    """
+    def __init__(batch):
+        batch.stmts = []
+        batch.rows = {}
+        batch.txs = []        # (tx, is_coinbase) for each new transaction
+        batch.outpoints = {}  # (tx_hash, pos) to (txout_id, value, source)
+        batch.unlinked = {}   # (tx_hash, pos) to list of txin_id
+        batch.links = []      # (txout_id, txin_id) for stored unlinked_txin
+
+    def add(batch, stmt, row):
+        rows = batch.rows.get(stmt)
+        if rows is None:
+            rows = []
+            batch.rows[stmt] = rows
+            batch.stmts.append(stmt)
+        rows.append(row)
+
+class RpcPrefetcher(threading.Thread):
+    """
+    Thread that fetches blocks by height, starting at height, using
+    JSON-RPC batch requests of batch_size heights and one batch per
+    block for its transactions.  Iterating yields (height, rpc_hash,
+    rpc_block, raw_txs) up to the daemon's best block, where raw_txs
+    maps each hash in rpc_block['tx'] to the transaction's hex data,
+    or None if the daemon lacks it or known(hash) returned true.  If
+    raw_blocks is true, rpc_block is instead the block's hex
+    serialization and raw_txs is None.  At most max_blocks wait to be
+    consumed.  After stop(), join() before closing client.
+    """
+    def __init__(fetch, client, height, batch_size, max_blocks, log,
+                 raw_blocks=False, known=None):
+        threading.Thread.__init__(fetch, name="RpcPrefetcher")
+        fetch.daemon = True
+        fetch.client = client
+        fetch.height = height
+        fetch.batch_size = batch_size
+        fetch.raw_blocks = raw_blocks
+        fetch.known = known
+        fetch.log = log
+        fetch.queue = Queue.Queue(max(1, max_blocks))
+        fetch.stopping = threading.Event()
+
+    def run(fetch):
+        try:
+            while not fetch.stopping.is_set():
+                hashes = fetch._batch("getblockhash", [
+                        (height,) for height in xrange(
+                            fetch.height, fetch.height + fetch.batch_size)],
+                                      -1)  # -1: Block number out of range.
+                if None in hashes:
+                    hashes = hashes[:hashes.index(None)]
+                if fetch.raw_blocks:
+                    blocks = fetch._batch("getblock", [
+                            (rpc_hash, False) for rpc_hash in hashes])
+                else:
+                    blocks = fetch._batch("getblock", [
+                            (rpc_hash,) for rpc_hash in hashes])
+
+                for rpc_hash, rpc_block in zip(hashes, blocks):
+                    if fetch.raw_blocks:
+                        raw_txs = None
+                    else:
+                        if rpc_hash != rpc_block['hash']:
+                            raise InvalidBlock('block hash mismatch')
+                        tx_hashes = rpc_block['tx']
+                        if fetch.known is not None:
+                            tx_hashes = [tx_hash for tx_hash in tx_hashes
+                                         if not fetch.known(tx_hash)]
+                        raw = fetch._batch(
+                            "getrawtransaction",
+                            [(tx_hash,) for tx_hash in tx_hashes],
+                            -5)  # -5: transaction not in index.
+                        raw_txs = dict(zip(tx_hashes, raw))
+                    if not fetch._put((fetch.height, rpc_hash, rpc_block,
+                                       raw_txs)):
+                        return
+                    fetch.height += 1
+
+                if len(hashes) < fetch.batch_size:
+                    break
+            fetch._put(None)
+        except Exception:
+            fetch._put((None, sys.exc_info()))
+
+    def _batch(fetch, method, params_list, missing_code=None):
+        """
+        Call method once per params in one request.  Return None for
+        calls that fail with missing_code, and raise other errors.
+        """
+        if not params_list:
+            return []
+        fetch.log.info("RPC>> %s x %d", method, len(params_list))
+        ret = []
+        for result in fetch.client.batch(
+            [(method, params) for params in params_list]):
+            if isinstance(result, util.JsonrpcException):
+                if result.code != missing_code:
+                    raise result
+                result = None
+            ret.append(result)
+        return ret
+
+    def _put(fetch, item):
+        while not fetch.stopping.is_set():
+            try:
+                fetch.queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(fetch):
+        while True:
+            item = fetch.queue.get()
+            if item is None:
+                return
+            if item[0] is None:
+                exc_info = item[1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield item
+
+    def stop(fetch):
+        fetch.stopping.set()
+
 class DataStore(object):
 
     """
@@ -152,10 +362,51 @@ class DataStore(object):
         store.rpclog = logging.getLogger(__name__ + ".rpc")
         if not args.log_rpc:
             store.rpclog.setLevel(logging.ERROR)
+        store.rpc_timeout = None if args.rpc_timeout is None \
+            else float(args.rpc_timeout)
+        store.rpc_pool_size = int(args.rpc_pool_size)
+        store.rpc_prefetch = int(args.rpc_prefetch or 0)
+        store.rpc_batch_size = max(1, int(args.rpc_batch_size))
+        store.rpc_raw_blocks = bool(args.rpc_raw_blocks)
+        store.mempool_expiry = int(args.mempool_expiry or 0)
+        store.datadir_workers = int(args.datadir_workers or 0)
+        store.deadlock_retries = int(args.deadlock_retries or 0)
         store.module = __import__(args.dbtype)
+
+        # Outputs written by import_tx, keyed by (tx_hash, txout_pos),
+        # valued (txout_id, txout_value, source), dropped when spent.
+        store.txout_cache = None
+        if args.txout_cache_size:
+            store.txout_cache = util.LRUCache(int(args.txout_cache_size))
+
+        # Map pubkey_hash to pubkey_id.  Ids inserted by the current
+        # transaction wait in _new_pubkey_ids until commit.
+        store.pubkey_cache = None
+        if args.pubkey_cache_size:
+            store.pubkey_cache = util.LRUCache(int(args.pubkey_cache_size))
+        store._new_pubkey_ids = {}
+
+        # Functions called with (chain_id, fork_height) after a commit
+        # that disconnected blocks above fork_height from chain_id's
+        # longest branch.
+        store.reorg_listeners = []
+        store._pending_reorgs = []
+
+        # Map datadir_id to the set of memory pool transaction hashes
+        # (hex) imported or found at the last RPC catch-up.
+        store._mempool_seen = {}
+
         store.auto_reconnect = False
         store.init_conn()
-        store._blocks = {}
+        store._blocks = util.LRUCache(int(args.block_cache_size))
+
+        # Map chain_id to an array of the block_id at each height of
+        # the chain's longest branch, loaded on first use.
+        store._main_chains = None
+
+        # Map chain_id to the lowest height that the current
+        # transaction connected or disconnected.
+        store._main_chain_changes = {}
 
         # Read the CONFIG and CONFIGVAR tables if present.
         store.config = store._read_config()
@@ -199,14 +450,54 @@ class DataStore(object):
         else:
             store.commit_bytes = int(store.commit_bytes)
         store.bytes_since_commit = 0
+        store.import_stats = {"blocks": 0, "rows": 0, "seconds": 0.0}
 
         store.use_firstbits = (store.config['use_firstbits'] == "true")
 
+        store.tx_bloom = None
+        store.tx_bloom_file = args.tx_bloom_file
+        # Datadir workers share tx_bloom.
+        store._tx_bloom_lock = threading.Lock()
+        # tx_bloom may skip lookups only while catch_up holds
+        # _load_lock, the get_lock() connection that keeps other
+        # tx-bloom loaders out.  _tx_bloom_stale records that another
+        # process stored transactions the filter lacks anyway.
+        # _load_lock_conn keeps the connection between catch-ups.
+        store._load_lock = None
+        store._load_lock_conn = None
+        store._tx_bloom_lockable = True
+        store._tx_bloom_stale = False
+
+        store.blkindex = None
+        if args.blkfile_index:
+            store.blkindex = blkindex.BlockIndex(args.blkfile_index)
+        if args.tx_bloom_bytes:
+            store._init_tx_bloom(int(args.tx_bloom_bytes),
+                                 float(args.tx_bloom_fp_rate))
+
         for hex_tx in args.import_tx:
             store.maybe_import_binary_tx(str(hex_tx).decode('hex'))
 
         store.default_loader = args.default_loader
 
+        store.batch_insert = bool(args.batch_insert)
+
+        store.parse_workers = int(args.parse_workers or 0)
+        store._parse_pool = None
+
+        store.bulk_loading = store.config.get('bulk_load') == "true"
+        if args.bulk_load and not store.bulk_loading:
+            store.start_bulk_load()
+        elif store.bulk_loading:
+            store.log.info("Continuing bulk load.")
+
+        if args.id_block_size is not None and \
+                int(args.id_block_size) != store.id_block_size:
+            store.log.warning(
+                "Ignoring id-block-size=%s, the database uses %d."
+                "  Run Abe.reconfigure to change it.",
+                args.id_block_size, store.id_block_size)
+
         if store.in_transaction:
             store.commit()
 
@@ -215,6 +506,7 @@ class DataStore(object):
         store.conn = store.connect()
         store.cursor = store.conn.cursor()
         store.in_transaction = False
+        store._cursor_serial = 0
 
     def connect(store):
         cargs = store.args.connect_args
@@ -417,15 +709,26 @@ class DataStore(object):
             new_id = lambda key: store._new_id_update(key)
             create_sequence = lambda key: store._create_sequence_update(key)
             drop_sequence = lambda key: store._drop_sequence_update(key)
+            reserve_ids = lambda key, count: store._reserve_ids_update(
+                key, count)
+            set_sequence_increment = lambda key, count: None
 
         elif val == 'mysql':
             new_id = lambda key: store._new_id_mysql(key)
             create_sequence = lambda key: store._create_sequence_mysql(key)
             drop_sequence = lambda key: store._drop_sequence_mysql(key)
+            reserve_ids = lambda key, count: store._reserve_ids_mysql(
+                key, count)
+            set_sequence_increment = lambda key, count: None
 
         else:
             create_sequence = lambda key: store._create_sequence(key)
             drop_sequence = lambda key: store._drop_sequence(key)
+            # Native sequences of ID_BLOCK_KEYS increment by the block
+            # size, so each value starts a block of its own.
+            reserve_ids = lambda key, count: new_id(key)
+            set_sequence_increment = lambda key, count: \
+                store._set_sequence_increment(key, count)
 
             if val == 'oracle':
                 new_id = lambda key: store._new_id_oracle(key)
@@ -483,10 +786,18 @@ class DataStore(object):
         store.new_id      = new_id
         store.create_sequence = create_sequence
         store.drop_sequence = drop_sequence
+        store.reserve_ids = reserve_ids
+        store.set_sequence_increment = set_sequence_increment
+
+        store.id_block_size = int(store.config.get('id_block_size') or 1)
+        store._reserved_ids = {}
+        if store.id_block_size > 1:
+            store.new_id = lambda key: store._new_id_reserved(key, new_id)
 
-    def _execute(store, stmt, params):
+    def _execute(store, stmt, params, many=False):
+        method = "executemany" if many else "execute"
         try:
-            store.cursor.execute(stmt, params)
+            getattr(store.cursor, method)(stmt, params)
         except (store.module.OperationalError, store.module.InternalError,
                 store.module.ProgrammingError) as e:
             if store.in_transaction or not store.auto_reconnect:
@@ -500,13 +811,17 @@ class DataStore(object):
                 store.log.exception("Failed to reconnect")
                 raise e
 
-            store.cursor.execute(stmt, params)
+            getattr(store.cursor, method)(stmt, params)
 
-    def sql(store, stmt, params=()):
+    def _transform_cached(store, stmt):
         cached = store._sql_cache.get(stmt)
         if cached is None:
             cached = store.sql_transform(stmt)
             store._sql_cache[stmt] = cached
+        return cached
+
+    def sql(store, stmt, params=()):
+        cached = store._transform_cached(stmt)
         store.sqllog.info("EXEC: %s %s", cached, params)
         try:
             store._execute(cached, params)
@@ -516,6 +831,20 @@ class DataStore(object):
         finally:
             store.in_transaction = True
 
+    def sql_many(store, stmt, seq_of_params):
+        """Execute stmt once per parameter tuple using executemany."""
+        if not seq_of_params:
+            return
+        cached = store._transform_cached(stmt)
+        store.sqllog.info("EXECMANY: %s [%d rows]", cached, len(seq_of_params))
+        try:
+            store._execute(cached, seq_of_params, many=True)
+        except Exception, e:
+            store.sqllog.info("EXCEPTION: %s", e)
+            raise
+        finally:
+            store.in_transaction = True
+
     def ddl(store, stmt):
         if stmt.lstrip().startswith("CREATE TABLE "):
             stmt += store.config['create_table_epilogue']
@@ -642,6 +971,35 @@ class DataStore(object):
         store.sqllog.debug("FETCH: %s", ret)
         return ret
 
+    def selectiter(store, stmt, params=()):
+        """
+        Generate the rows of a query without LIMIT a few at a time.
+        The query has a cursor of its own, so other statements may run
+        between rows.
+        """
+        stmt = store._transform_cached(stmt)
+        store.sqllog.info("EXEC: %s %s", stmt, params)
+        cursor = store._new_select_cursor()
+        try:
+            store.in_transaction = True
+            cursor.execute(stmt, params)
+            while True:
+                rows = cursor.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def _new_select_cursor(store):
+        # psycopg2 fetches a named cursor's rows from the server as
+        # needed.  Other drivers may buffer the result in the client.
+        if hasattr(store.cursor, 'copy_expert'):
+            store._cursor_serial += 1
+            return store.conn.cursor("abe_select_%d" % store._cursor_serial)
+        return store.conn.cursor()
+
     def _selectall(store, stmt, params=()):
         store.sql(stmt, params)
         ret = store.cursor.fetchall()
@@ -764,6 +1122,13 @@ class DataStore(object):
         """
         Allocate a synthetic identifier by updating a table.
         """
+        return store._reserve_ids_update(key, 1)
+
+    def _reserve_ids_update(store, key, count):
+        """
+        Reserve count consecutive identifiers and return the first.
+        Rollback releases them, so DataStore.rollback forgets them.
+        """
         while True:
             row = store.selectrow(
                 "SELECT nextid FROM abe_sequences WHERE sequence_key = ?",
@@ -772,13 +1137,31 @@ class DataStore(object):
                 raise Exception("Sequence %s does not exist" % (key,))
 
             ret = row[0]
-            store.sql("UPDATE abe_sequences SET nextid = nextid + 1"
+            store.sql("UPDATE abe_sequences SET nextid = nextid + ?"
                       " WHERE sequence_key = ? AND nextid = ?",
-                      (key, ret))
+                      (count, key, ret))
             if store.cursor.rowcount == 1:
                 return ret
             store.log.info('Contention on abe_sequences %s:%d', key, ret)
 
+    def _new_id_reserved(store, key, new_id):
+        """
+        Allocate an identifier from a block of id_block_size reserved
+        by one statement.  Identifiers left unused when the process
+        exits are simply never used.
+        """
+        if key not in ID_BLOCK_KEYS:
+            return new_id(key)
+        ids = store._reserved_ids.get(key)
+        if not ids:
+            first = int(store.reserve_ids(key, store.id_block_size))
+            ids = range(first + store.id_block_size - 1, first - 1, -1)
+            store._reserved_ids[key] = ids
+        return ids.pop()
+
+    def _sequence_increment(store, key):
+        return store.id_block_size if key in ID_BLOCK_KEYS else 1
+
     def _get_sequence_initial_value(store, key):
         (ret,) = store.selectrow("SELECT MAX(" + key + "_id) FROM " + key)
         ret = 1 if ret is None else ret + 1
@@ -810,8 +1193,14 @@ class DataStore(object):
         return ret
 
     def _create_sequence(store, key):
-        store.ddl("CREATE SEQUENCE %s_seq START WITH %d"
-                  % (key, store._get_sequence_initial_value(key)))
+        increment = store._sequence_increment(key)
+        store.ddl("CREATE SEQUENCE %s_seq START WITH %d%s"
+                  % (key, store._get_sequence_initial_value(key),
+                     "" if increment == 1 else
+                     " INCREMENT BY %d" % (increment,)))
+
+    def _set_sequence_increment(store, key, increment):
+        store.ddl("ALTER SEQUENCE %s_seq INCREMENT BY %d" % (key, increment))
 
     def _drop_sequence(store, key):
         store.ddl("DROP SEQUENCE %s_seq" % (key,))
@@ -858,13 +1247,51 @@ class DataStore(object):
             store.sql("DELETE FROM " + key + "_seq WHERE id < ?", (ret,))
         return ret
 
+    def _reserve_ids_mysql(store, key, count):
+        # The rows of a multi-row INSERT need not get consecutive
+        # values when inserts run concurrently (innodb_autoinc_lock_mode
+        # 2).  Instead insert one row with auto_increment_increment set
+        # to count.  Every value then comes from the same series with
+        # step count, so the block starting at it overlaps no other.
+        if count > MYSQL_MAX_AUTO_INCREMENT_INCREMENT:
+            raise Exception("id-block-size may not exceed %d with MySQL"
+                            % (MYSQL_MAX_AUTO_INCREMENT_INCREMENT,))
+        store.sql("SET SESSION auto_increment_increment = %d" % (count,))
+        try:
+            store.sql("INSERT INTO " + key + "_seq () VALUES ()")
+            (ret,) = store.selectrow("SELECT LAST_INSERT_ID()")
+        finally:
+            store.sql("SET SESSION auto_increment_increment = 1")
+        store.sql("DELETE FROM " + key + "_seq WHERE id < ?", (ret,))
+        return ret
+
     def commit(store):
         store.sqllog.info("COMMIT")
         store.conn.commit()
         store.in_transaction = False
+        if store._new_pubkey_ids:
+            for pubkey_hash, pubkey_id in store._new_pubkey_ids.iteritems():
+                store.pubkey_cache[pubkey_hash] = pubkey_id
+            store._new_pubkey_ids = {}
+        store._main_chain_changes = {}
+        if store._pending_reorgs:
+            reorgs = store._pending_reorgs
+            store._pending_reorgs = []
+            for chain_id, fork_height in reorgs:
+                for listener in store.reorg_listeners:
+                    listener(chain_id, fork_height)
 
     def rollback(store):
         store.sqllog.info("ROLLBACK")
+        if store.config.get('sequence_type') in (None, 'update'):
+            # The rollback returns reserved identifiers to abe_sequences.
+            store._reserved_ids = {}
+        if store.txout_cache is not None:
+            # Cached outputs may belong to rolled-back rows.
+            store.txout_cache.clear()
+        store._truncate_main_chains()
+        store._new_pubkey_ids = {}
+        store._pending_reorgs = []
         try:
             store.conn.rollback()
             store.in_transaction = False
@@ -875,6 +1302,9 @@ class DataStore(object):
     def close(store):
         store.sqllog.info("CLOSE")
         store.conn.close()
+        if store._load_lock_conn is not None:
+            store.release_lock(store._load_lock_conn)
+            store._load_lock_conn = None
 
     def get_ddl(store, key):
         return store._ddl[key]
@@ -1187,6 +1617,64 @@ store._ddl['configvar'],
     FOREIGN KEY (out_block_id) REFERENCES block (block_id)
 )""",
 
+# Transactions imported from a memory pool, until seen in a block or
+# expired.
+"""CREATE TABLE mempool_tx (
+    tx_id         NUMERIC(26) NOT NULL PRIMARY KEY,
+    first_seen    NUMERIC(20) NOT NULL,
+    FOREIGN KEY (tx_id) REFERENCES tx (tx_id)
+)""",
+
+# Totals and counts of the outputs to each pubkey in a chain's
+# longest branch and of the inputs spending them there.  Updated as
+# blocks connect and disconnect, except during a bulk load.
+"""CREATE TABLE address_balance (
+    chain_id      NUMERIC(10) NOT NULL,
+    pubkey_id     NUMERIC(26) NOT NULL,
+    received      NUMERIC(30) NOT NULL,
+    sent          NUMERIC(30) NOT NULL,
+    txout_count   NUMERIC(20) NOT NULL,
+    txin_count    NUMERIC(20) NOT NULL,
+    PRIMARY KEY (chain_id, pubkey_id),
+    FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+    FOREIGN KEY (pubkey_id) REFERENCES pubkey (pubkey_id)
+)""",
+
+# Outputs to (is_in=0) and spends from (is_in=1) each pubkey in a
+# chain's longest branch, in the order of the key, with the pubkey's
+# balance in the chain after each.  Maintained like address_balance.
+"""CREATE TABLE address_history (
+    pubkey_id     NUMERIC(26) NOT NULL,
+    block_height  NUMERIC(14) NOT NULL,
+    tx_pos        NUMERIC(10) NOT NULL,
+    chain_id      NUMERIC(10) NOT NULL,
+    is_in         NUMERIC(1) NOT NULL,
+    io_pos        NUMERIC(10) NOT NULL,
+    block_id      NUMERIC(14) NOT NULL,
+    tx_id         NUMERIC(26) NOT NULL,
+    delta         NUMERIC(30) NOT NULL,
+    balance       NUMERIC(30) NOT NULL,
+    PRIMARY KEY (pubkey_id, block_height, tx_pos, chain_id, is_in, io_pos),
+    FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+    FOREIGN KEY (block_id) REFERENCES block (block_id),
+    FOREIGN KEY (tx_id) REFERENCES tx (tx_id)
+)""",
+"""CREATE INDEX x_address_history_block ON address_history (block_id)""",
+
+# Outputs to pubkeys that no transaction in a chain's longest branch
+# spends.  Maintained like address_balance.
+"""CREATE TABLE unspent_txout (
+    chain_id      NUMERIC(10) NOT NULL,
+    txout_id      NUMERIC(26) NOT NULL,
+    pubkey_id     NUMERIC(26) NOT NULL,
+    block_height  NUMERIC(14) NOT NULL,
+    PRIMARY KEY (chain_id, txout_id),
+    FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+    FOREIGN KEY (txout_id) REFERENCES txout (txout_id),
+    FOREIGN KEY (pubkey_id) REFERENCES pubkey (pubkey_id)
+)""",
+"""CREATE INDEX x_unspent_txout_pubkey ON unspent_txout (pubkey_id)""",
+
 store._ddl['chain_summary'],
 store._ddl['txout_detail'],
 store._ddl['txin_detail'],
@@ -1273,12 +1761,7 @@ store._ddl['txout_approx'],
         if store.version_below('Abe26'):
             return None
         conn = store.connect()
-        cur = conn.cursor()
-        cur.execute("UPDATE abe_lock SET pid = %d WHERE lock_id = 1"
-                    % (os.getpid(),))
-        if cur.rowcount != 1:
-            raise Exception("unexpected rowcount")
-        cur.close()
+        store._lock_connection(conn)
 
         # Check whether database supports concurrent updates.  Where it
         # doesn't (SQLite) we get exclusive access automatically.
@@ -1304,6 +1787,52 @@ store._ddl['txout_approx'],
             conn.rollback()
             conn.close()
 
+    def _lock_connection(store, conn):
+        cur = conn.cursor()
+        cur.execute("UPDATE abe_lock SET pid = %d WHERE lock_id = 1"
+                    % (os.getpid(),))
+        if cur.rowcount != 1:
+            raise Exception("unexpected rowcount")
+        cur.close()
+
+    def _acquire_load_lock(store):
+        """
+        Set _load_lock to a connection that holds the lock, or leave
+        it None where the database does not support concurrent
+        updates.  Only the first call goes through get_lock(), which
+        rolls back.  Later calls lock the same connection again, so
+        the current transaction and its caches survive.
+        """
+        conn = store._load_lock_conn
+        if conn is not None:
+            try:
+                store._lock_connection(conn)
+            except store.module.DatabaseError, e:
+                store.log.warning("Reconnecting load lock after: %s", e)
+                store._load_lock_conn = None
+                conn = None
+        if conn is None:
+            conn = store.get_lock()
+            if conn is None:
+                store.log.info("The database does not support concurrent"
+                               " updates; tx-bloom-bytes will not skip"
+                               " transaction lookups.")
+                store._tx_bloom_lockable = False
+                return
+            store._load_lock_conn = conn
+        store._load_lock = conn
+
+    def _release_load_lock(store):
+        """Release _load_lock but keep its connection for reuse."""
+        conn = store._load_lock
+        store._load_lock = None
+        if conn is not None:
+            try:
+                conn.rollback()
+            except store.module.DatabaseError, e:
+                store.log.warning("Dropping load lock after: %s", e)
+                store._load_lock_conn = None
+
     def version_below(store, vers):
         sv = store.config['schema_version'].replace('Abe', '')
         vers = vers.replace('Abe', '')
@@ -1320,6 +1849,7 @@ store._ddl['txout_approx'],
         store.configure_int_type()
         store.configure_sequence_type()
         store.configure_limit_style()
+        store.configure_id_block_size()
 
     def configure_binary_type(store):
         for val in (
@@ -1358,6 +1888,11 @@ store._ddl['txout_approx'],
                 return
         raise Exception("No known sequence type works")
 
+    def configure_id_block_size(store):
+        store.config['id_block_size'] = str(int(store.args.id_block_size or 1))
+        store._set_sql_flavour()
+        store.log.info("id_block_size=%s", store.config['id_block_size'])
+
     def _drop_if_exists(store, otype, name):
         try:
             store.sql("DROP " + otype + " " + name)
@@ -1376,6 +1911,16 @@ store._ddl['txout_approx'],
         except store.module.DatabaseError:
             store.rollback()
 
+    def drop_index_if_exists(store, table, name):
+        # MySQL requires the table name.
+        for stmt in ("DROP INDEX " + name,
+                     "DROP INDEX " + name + " ON " + table):
+            try:
+                store.ddl(stmt)
+                return
+            except store.module.DatabaseError:
+                store.rollback()
+
     def drop_column_if_exists(store, table, column):
         try:
             store.ddl("ALTER TABLE " + table + " DROP COLUMN " + column)
@@ -1651,10 +2196,7 @@ store._ddl['txout_approx'],
         assert isinstance(height, int), height
         assert prev_id is None or isinstance(prev_id, int)
         assert search_id is None or isinstance(search_id, int)
-        block = {
-            'height':    height,
-            'prev_id':   prev_id,
-            'search_id': search_id}
+        block = CachedBlock(height, prev_id, search_id)
         store._blocks[block_id] = block
         return block
 
@@ -1679,12 +2221,96 @@ store._ddl['txout_approx'],
             return None
         while True:
             block = store._load_block(descendant_id)
-            if block['height'] == height:
+            if block.height == height:
                 return descendant_id
-            descendant_id = block[
-                'search_id'
-                if util.get_search_height(block['height']) >= height else
-                'prev_id']
+            main = store._find_main_chain(descendant_id, block.height)
+            if main is not None:
+                return main[height]
+            if util.get_search_height(block.height) >= height:
+                descendant_id = block.search_id
+            else:
+                descendant_id = block.prev_id
+
+    def _load_main_chains(store):
+        store._main_chains = {}
+        for chain_id, height, block_id in store.selectall("""
+            SELECT chain_id, block_height, block_id
+              FROM chain_candidate
+             WHERE in_longest = 1
+             ORDER BY chain_id, block_height"""):
+            main = store._main_chains.setdefault(int(chain_id),
+                                                 array.array('l'))
+            if height is not None and int(height) == len(main):
+                main.append(int(block_id))
+
+    def _find_main_chain(store, block_id, height):
+        """
+        Return the array of the main chain that has block_id at height,
+        or None.  A block's ancestors do not change, so the array holds
+        the block's ancestors even if another process has since
+        reorganized the chain.
+        """
+        if store._main_chains is None:
+            store._load_main_chains()
+        for main in store._main_chains.itervalues():
+            if height < len(main) and main[height] == block_id:
+                return main
+        return None
+
+    def _main_chain_connect(store, block_id, chain_id):
+        block = store._load_block(block_id)
+        store._note_main_chain_change(chain_id, block.height)
+        if store._main_chains is None:
+            return
+        main = store._main_chains.setdefault(chain_id, array.array('l'))
+        del main[block.height:]
+        if block.height == len(main) and (
+                block.height == 0 or main[-1] == block.prev_id):
+            main.append(block_id)
+            return
+
+        # Our copy is out of date, probably because another process
+        # extended or reorganized the chain.  The block's ancestors
+        # are now the longest branch, so walk back to where they meet
+        # the array and replace what follows.
+        ids = [block_id]
+        while block.height > 0:
+            height = block.height - 1
+            prev_id = block.prev_id
+            if height < len(main) and main[height] == prev_id:
+                break
+            ids.append(prev_id)
+            block = store._load_block(prev_id)
+        del main[block.height:]
+        ids.reverse()
+        main.extend(ids)
+
+    def _main_chain_disconnect(store, block_id, chain_id):
+        height = store._load_block(block_id).height
+        store._note_main_chain_change(chain_id, height)
+        if store._main_chains is None:
+            return
+        main = store._main_chains.get(chain_id)
+        if main is not None:
+            del main[height:]
+
+    def _note_main_chain_change(store, chain_id, height):
+        changes = store._main_chain_changes
+        if chain_id not in changes or height < changes[chain_id]:
+            changes[chain_id] = height
+
+    def _truncate_main_chains(store):
+        """
+        Drop the heights that the rolled-back transaction connected or
+        disconnected.  The rest of each array still lists ancestors
+        of its last block.
+        """
+        if store._main_chains is not None:
+            for chain_id, height in store._main_chain_changes.iteritems():
+                main = store._main_chains.get(chain_id)
+                if main is not None:
+                    del main[height:]
+        store._main_chain_changes = {}
 
     def is_descended_from(store, block_id, ancestor_id):
 #        ret = store._is_descended_from(block_id, ancestor_id)
@@ -1693,12 +2319,12 @@ store._ddl['txout_approx'],
 #    def _is_descended_from(store, block_id, ancestor_id):
         block = store._load_block(block_id)
         ancestor = store._load_block(ancestor_id)
-        height = ancestor['height']
-        return block['height'] >= height and \
+        height = ancestor.height
+        return block.height >= height and \
             store.get_block_id_at_height(height, block_id) == ancestor_id
 
     def get_block_height(store, block_id):
-        return store._load_block(int(block_id))['height']
+        return store._load_block(int(block_id)).height
 
     def find_prev(store, hash):
         row = store.selectrow("""
@@ -1720,6 +2346,8 @@ store._ddl['txout_approx'],
                 int(nTime))
 
     def import_block(store, b, chain_ids=frozenset()):
+        start_time = time.time()
+        start_rows = store.import_stats['rows']
 
         # Import new transactions.
         b['value_in'] = 0
@@ -1731,22 +2359,39 @@ store._ddl['txout_approx'],
         # can avoid a query if we notice this.
         all_txins_linked = True
 
+        batch = ImportBatch() if store.batch_insert or store.bulk_loading \
+            else None
+
+        # Get a new block ID.
+        block_id = int(store.new_id("block"))
+        b['block_id'] = block_id
+        source = (block_id, b['nTime'])
+
         for pos in xrange(len(b['transactions'])):
             tx = b['transactions'][pos]
             if 'hash' not in tx:
                 tx['hash'] = util.double_sha256(tx['__data__'])
             tx_hash_array.append(tx['hash'])
-            tx['tx_id'] = store.tx_find_id_and_value(tx, pos == 0)
+            tx['tx_id'] = store.tx_find_known_id_and_value(tx, pos == 0)
 
             if tx['tx_id']:
                 all_txins_linked = False
+                # The outputs now belong to more than one block.
+                store.forget_cached_txouts(tx)
+            elif batch is not None:
+                tx['tx_id'] = store.import_tx(tx, pos == 0, batch, source)
+            elif store.commit_bytes == 0:
+                tx['tx_id'] = store.import_and_commit_tx(tx, pos == 0, source)
             else:
-                if store.commit_bytes == 0:
-                    tx['tx_id'] = store.import_and_commit_tx(tx, pos == 0)
-                else:
-                    tx['tx_id'] = store.import_tx(tx, pos == 0)
-                if tx.get('unlinked_count', 1) > 0:
-                    all_txins_linked = False
+                tx['tx_id'] = store.import_tx(tx, pos == 0, source=source)
+
+        if batch is not None:
+            store.import_and_commit_batch(batch)
+
+        for pos in xrange(len(b['transactions'])):
+            tx = b['transactions'][pos]
+            if tx.get('unlinked_count', 1) > 0:
+                all_txins_linked = False
 
             if tx['value_in'] is None:
                 b['value_in'] = None
@@ -1755,12 +2400,9 @@ store._ddl['txout_approx'],
             b['value_out'] += tx['value_out']
             b['value_destroyed'] += tx['value_destroyed']
 
-        # Get a new block ID.
-        block_id = int(store.new_id("block"))
-        b['block_id'] = block_id
-
-        # Verify Merkle root.
-        if b['hashMerkleRoot'] != util.merkle(tx_hash_array):
+        # Verify Merkle root, unless parse_blkfile_block did.
+        if not b.get('merkle_verified') and \
+                b['hashMerkleRoot'] != util.merkle(tx_hash_array):
             raise MerkleRootMismatch(b['hash'], tx_hash_array)
 
         # Look for the parent block.
@@ -1803,7 +2445,7 @@ store._ddl['txout_approx'],
 
         # Insert the block table row.
         try:
-            store.sql(
+            store._insert_row(None,
                 """INSERT INTO block (
                     block_id, block_hash, block_version, block_hashMerkleRoot,
                     block_nTime, block_nBits, block_nNonce, block_height,
@@ -1852,20 +2494,28 @@ store._ddl['txout_approx'],
         # List the block's transactions in block_tx.
         for tx_pos in xrange(len(b['transactions'])):
             tx = b['transactions'][tx_pos]
-            store.sql("""
+            store._insert_row(batch, """
                 INSERT INTO block_tx
                     (block_id, tx_id, tx_pos)
                 VALUES (?, ?, ?)""",
                       (block_id, tx['tx_id'], tx_pos))
             store.log.info("block_tx %d %d", block_id, tx['tx_id'])
+        if batch is not None:
+            store.flush_batch(batch)
 
-        if b['height'] is not None:
+        if b['height'] is not None and store.bulk_loading:
+            # finish_bulk_load populates block_txin and satoshi-seconds.
+            b['ss_destroyed'] = None
+            b['ss'] = None
+
+        elif b['height'] is not None:
             store._populate_block_txin(block_id)
 
             if all_txins_linked or not store._has_unlinked_txins(block_id):
-                b['ss_destroyed'] = store._get_block_ss_destroyed(
-                    block_id, b['nTime'],
-                    map(lambda tx: tx['tx_id'], b['transactions']))
+                b['ss_destroyed'] = store._get_imported_ss_destroyed(b)
+                if b['ss_destroyed'] is None:
+                    b['ss_destroyed'] = store._get_block_ss_destroyed(
+                        block_id, b['nTime'])
                 if ss_created is None or prev_ss is None:
                     b['ss'] = None
                 else:
@@ -1910,12 +2560,44 @@ store._ddl['txout_approx'],
         # attached above.
         store.offer_block_to_chains(b, chain_ids)
 
+        store.import_stats['blocks'] += 1
+        store.import_stats['seconds'] += time.time() - start_time
+        store.log.debug("block %d: %d rows in %.3fs", block_id,
+                        store.import_stats['rows'] - start_rows,
+                        time.time() - start_time)
         return block_id
 
     def _populate_block_txin(store, block_id):
         # Create rows in block_txin.  In case of duplicate transactions,
         # choose the one with the lowest block ID.  XXX For consistency,
         # it should be the lowest height instead of block ID.
+
+        # Insert in one statement the rows whose output is in this
+        # block or in the longest chain at or below its parent.
+        store.sql("""
+            INSERT INTO block_txin (block_id, txin_id, out_block_id)
+            SELECT ?, x.txin_id, x.out_block_id
+              FROM (SELECT txin.txin_id, MIN(obt.block_id) AS out_block_id
+                      FROM block_tx bt
+                      JOIN txin ON (txin.tx_id = bt.tx_id)
+                      JOIN txout ON (txin.txout_id = txout.txout_id)
+                      JOIN block_tx obt ON (txout.tx_id = obt.tx_id)
+                     WHERE bt.block_id = ?
+                     GROUP BY txin.txin_id) x
+             WHERE x.out_block_id = ?
+                OR EXISTS (
+                   SELECT 1
+                     FROM chain_candidate occ
+                     JOIN chain_candidate pcc ON (pcc.chain_id = occ.chain_id)
+                    WHERE occ.block_id = x.out_block_id
+                      AND occ.in_longest = 1
+                      AND pcc.block_id = ?
+                      AND pcc.in_longest = 1
+                      AND occ.block_height <= pcc.block_height)""",
+                  (block_id, block_id, block_id,
+                   store._load_block(block_id).prev_id))
+
+        # Check the rest, which spend side chain outputs, in Python.
         for row in store.selectall("""
             SELECT txin.txin_id, MIN(obt.block_id)
               FROM block_tx bt
@@ -1923,6 +2605,11 @@ store._ddl['txout_approx'],
               JOIN txout ON (txin.txout_id = txout.txout_id)
               JOIN block_tx obt ON (txout.tx_id = obt.tx_id)
              WHERE bt.block_id = ?
+               AND NOT EXISTS (
+                   SELECT 1
+                     FROM block_txin bti
+                    WHERE bti.block_id = bt.block_id
+                      AND bti.txin_id = txin.txin_id)
              GROUP BY txin.txin_id""", (block_id,)):
             (txin_id, oblock_id) = row
             if store.is_descended_from(block_id, int(oblock_id)):
@@ -1940,21 +2627,38 @@ store._ddl['txout_approx'],
              WHERE bt.block_id = ?""", (block_id,))
         return unlinked_count > 0
 
-    def _get_block_ss_destroyed(store, block_id, nTime, tx_ids):
-        block_ss_destroyed = 0
-        for tx_id in tx_ids:
-            destroyed = int(store.selectrow("""
-                SELECT COALESCE(SUM(txout_approx.txout_approx_value *
-                                    (? - b.block_nTime)), 0)
-                  FROM block_txin bti
-                  JOIN txin ON (bti.txin_id = txin.txin_id)
-                  JOIN txout_approx ON (txin.txout_id = txout_approx.txout_id)
-                  JOIN block_tx obt ON (txout_approx.tx_id = obt.tx_id)
-                  JOIN block b ON (obt.block_id = b.block_id)
-                 WHERE bti.block_id = ? AND txin.tx_id = ?""",
-                                            (nTime, block_id, tx_id))[0])
-            block_ss_destroyed += destroyed
-        return block_ss_destroyed
+    def _get_block_ss_destroyed(store, block_id, nTime):
+        return int(store.selectrow("""
+            SELECT COALESCE(SUM(txout_approx.txout_approx_value *
+                                (? - b.block_nTime)), 0)
+              FROM block_txin bti
+              JOIN txin ON (bti.txin_id = txin.txin_id)
+              JOIN txout_approx ON (txin.txout_id = txout_approx.txout_id)
+              JOIN block_tx obt ON (txout_approx.tx_id = obt.tx_id)
+              JOIN block b ON (obt.block_id = b.block_id)
+             WHERE bti.block_id = ?""", (nTime, block_id))[0])
+
+    def _get_imported_ss_destroyed(store, b):
+        """
+        Return the satoshi-seconds destroyed by block b, computed from
+        the spent outputs' values and block times noted by import_tx,
+        or None if some input's source is unknown.
+        """
+        by_block = {}
+        for tx in b['transactions']:
+            ss_from = tx.get('ss_destroyed_from')
+            if ss_from is None:
+                return None
+            for src_id, ss in ss_from.iteritems():
+                by_block[src_id] = by_block.get(src_id, 0) + ss
+
+        block_id = b['block_id']
+        for src_id in by_block:
+            if src_id != block_id and (
+                store.get_block_height(src_id) is None or
+                not store.is_descended_from(block_id, src_id)):
+                return None
+        return sum(by_block.itervalues())
 
     # Propagate cumulative values to descendant blocks.  Return info
     # about the longest chains containing b.  The returned dictionary
@@ -2096,19 +2800,13 @@ store._ddl['txout_approx'],
                      WHERE block_id = ?""",
                     (height, next_id))
 
-                store._populate_block_txin(int(next_id))
+                if not store.bulk_loading:
+                    store._populate_block_txin(int(next_id))
 
                 if b['ss'] is None or store._has_unlinked_txins(next_id):
                     pass
                 else:
-                    tx_ids = map(
-                        lambda row: row[0],
-                        store.selectall("""
-                            SELECT tx_id
-                              FROM block_tx
-                             WHERE block_id = ?""", (next_id,)))
-                    destroyed = store._get_block_ss_destroyed(
-                        next_id, nTime, tx_ids)
+                    destroyed = store._get_block_ss_destroyed(next_id, nTime)
                     ss = b['ss'] + b['satoshis'] * (nTime - b['nTime']) \
                         - destroyed
 
@@ -2177,19 +2875,106 @@ store._ddl['txout_approx'],
 
         return None
 
-    def import_tx(store, tx, is_coinbase):
+    def tx_find_known_id_and_value(store, tx, is_coinbase):
+        """
+        Like tx_find_id_and_value, but skip the query when tx_bloom
+        shows the transaction has never been stored and no other
+        process can have stored it since the filter was built.
+        """
+        if store.tx_bloom is not None and store._load_lock is not None \
+                and not store._tx_bloom_stale \
+                and tx['hash'] not in store.tx_bloom:
+            return None
+        return store.tx_find_id_and_value(tx, is_coinbase)
+
+    def _init_tx_bloom(store, nbytes, fp_rate):
+        """
+        Build tx_bloom from tx_bloom_file, if saved, and the tx table.
+        """
+        store.tx_bloom = bloom.BloomFilter(nbytes, fp_rate)
+        last_id = None
+        if store.tx_bloom_file is not None:
+            last_id = store.tx_bloom.load(store.tx_bloom_file)
+
+        store.sql("SELECT tx_hash FROM tx WHERE tx_id > ?",
+                  (-1 if last_id is None else last_id,))
+        while True:
+            rows = store.cursor.fetchmany(10000)
+            if not rows:
+                break
+            for (tx_hash,) in rows:
+                store.tx_bloom.add(store.hashout(tx_hash))
+
+        store.log.info("tx bloom filter: %d of %d hashes, %d bytes",
+                       store.tx_bloom.count, store.tx_bloom.capacity(),
+                       nbytes)
+        if store.tx_bloom.count > store.tx_bloom.capacity():
+            store.log.warning("tx-bloom-bytes is too small for a false"
+                              " positive rate of %s", fp_rate)
+
+    def save_tx_bloom(store):
+        """
+        Save tx_bloom for reuse by the next process.  Call with
+        _load_lock held, so no other process is adding transactions.
+        """
+        if store.tx_bloom is None or store.tx_bloom_file is None:
+            return
+        if store._tx_bloom_stale or store._load_lock is None:
+            # The filter may lack other processes' transactions.
+            try:
+                os.unlink(store.tx_bloom_file)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return
+        (last_id,) = store.selectrow("SELECT MAX(tx_id) FROM tx")
+        last_id = int(last_id or 0)
+        # This process may yet use reserved ids below last_id.
+        reserved = store._reserved_ids.get("tx")
+        if reserved:
+            last_id = min(last_id, min(reserved) - 1)
+        store.tx_bloom.save(store.tx_bloom_file, last_id)
+
+    def import_tx(store, tx, is_coinbase, batch=None, source=None):
+        """
+        Insert tx and its inputs and outputs.  If batch is given, add
+        the rows to it for a later flush_batch instead of executing
+        the INSERTs one at a time.  source is the (block_id, nTime) of
+        the block being imported, if any, and is remembered with the
+        cached outputs so that a later block can compute the
+        satoshi-seconds its inputs destroy without a query.
+        """
         tx_id = store.new_id("tx")
         dbhash = store.hashin(tx['hash'])
 
+        if store.tx_bloom is not None:
+            # Added before the INSERT, so duplicates that fail it and
+            # rows rolled back later are at worst false positives.
+            with store._tx_bloom_lock:
+                store.tx_bloom.add(tx['hash'])
+
         if 'size' not in tx:
             tx['size'] = len(tx['__data__'])
 
-        store.sql("""
+        if batch is not None:
+            batch.txs.append((tx, is_coinbase))
+
+        store._insert_row(batch, """
             INSERT INTO tx (tx_id, tx_hash, tx_version, tx_lockTime, tx_size)
             VALUES (?, ?, ?, ?, ?)""",
                   (tx_id, dbhash, store.intin(tx['version']),
                    store.intin(tx['lockTime']), tx['size']))
 
+        # Find inputs already stored that spend this transaction's
+        # outputs, one query per transaction rather than per output.
+        if batch is not None:
+            unlinked = {}
+            for txin_id, txout_pos in store.selectall("""
+                SELECT txin_id, txout_pos
+                  FROM unlinked_txin
+                 WHERE txout_tx_hash = ?""", (dbhash,)):
+                unlinked.setdefault(int(txout_pos), []).append(txin_id)
+
         # Import transaction outputs.
         tx['value_out'] = 0
         tx['value_destroyed'] = 0
@@ -2202,13 +2987,25 @@ store._ddl['txout_approx'],
             if pubkey_id is not None and pubkey_id <= 0:
                 tx['value_destroyed'] += txout['value']
 
-            store.sql("""
+            store._insert_row(batch, """
                 INSERT INTO txout (
                     txout_id, tx_id, txout_pos, txout_value,
                     txout_scriptPubKey, pubkey_id
                 ) VALUES (?, ?, ?, ?, ?, ?)""",
                       (txout_id, tx_id, pos, store.intin(txout['value']),
                        store.binin(txout['scriptPubKey']), pubkey_id))
+
+            if store.txout_cache is not None:
+                store.txout_cache[(tx['hash'], pos)] = (
+                    txout_id, txout['value'], source)
+
+            if batch is not None:
+                batch.outpoints[(tx['hash'], pos)] = (
+                    txout_id, txout['value'], source)
+                for txin_id in unlinked.get(pos, ()):
+                    batch.links.append((txout_id, txin_id))
+                continue
+
             for row in store.selectall("""
                 SELECT txin_id
                   FROM unlinked_txin
@@ -2219,10 +3016,13 @@ store._ddl['txout_approx'],
                           (txout_id, txin_id))
                 store.sql("DELETE FROM unlinked_txin WHERE txin_id = ?",
                           (txin_id,))
+                store._link_unspent_txouts([(txout_id, txin_id)])
 
         # Import transaction inputs.
         tx['value_in'] = 0
         tx['unlinked_count'] = 0
+        # Satoshi-seconds destroyed, keyed by the spent outputs' block.
+        ss_from = {} if source is not None else None
         for pos in xrange(len(tx['txIn'])):
             txin = tx['txIn'][pos]
             txin_id = store.new_id("txin")
@@ -2230,14 +3030,24 @@ store._ddl['txout_approx'],
             if is_coinbase:
                 txout_id = None
             else:
-                txout_id, value = store.lookup_txout(
-                    txin['prevout_hash'], txin['prevout_n'])
+                outpoint = (txin['prevout_hash'], txin['prevout_n'])
+                if batch is not None and outpoint in batch.outpoints:
+                    txout_id, value, out_source = batch.outpoints[outpoint]
+                    store.spend_txout(outpoint)
+                else:
+                    txout_id, value, out_source = store.spend_txout(outpoint)
                 if value is None:
                     tx['value_in'] = None
                 elif tx['value_in'] is not None:
                     tx['value_in'] += value
-
-            store.sql("""
+                if out_source is None:
+                    ss_from = None
+                elif ss_from is not None:
+                    out_block_id, out_nTime = out_source
+                    ss_from[out_block_id] = ss_from.get(out_block_id, 0) + \
+                        value * (source[1] - out_nTime)
+
+            store._insert_row(batch, """
                 INSERT INTO txin (
                     txin_id, tx_id, txin_pos, txout_id""" + (""",
                     txin_scriptSig, txin_sequence""" if store.keep_scriptsig
@@ -2250,21 +3060,197 @@ store._ddl['txout_approx'],
                       else (txin_id, tx_id, pos, txout_id))
             if not is_coinbase and txout_id is None:
                 tx['unlinked_count'] += 1
-                store.sql("""
+                store._insert_row(batch, """
                     INSERT INTO unlinked_txin (
                         txin_id, txout_tx_hash, txout_pos
                     ) VALUES (?, ?, ?)""",
                           (txin_id, store.hashin(txin['prevout_hash']),
                            store.intin(txin['prevout_n'])))
+                if batch is not None:
+                    batch.unlinked.setdefault(outpoint, []).append(txin_id)
+        tx['ss_destroyed_from'] = ss_from
 
         # XXX Could populate PUBKEY.PUBKEY with txin scripts...
         # or leave that to an offline process.  Nothing in this program
         # requires them.
         return tx_id
 
-    def import_and_commit_tx(store, tx, is_coinbase):
+    def _insert_row(store, batch, stmt, row):
+        store.import_stats['rows'] += 1
+        if batch is None:
+            store.sql(stmt, row)
+        else:
+            batch.add(stmt, row)
+
+    def flush_batch(store, batch):
+        """Write the rows collected in batch, one statement per table."""
+        copy = store.bulk_loading and store._can_copy()
+        for stmt in batch.stmts:
+            if copy and INSERT_RE.match(stmt):
+                store._copy_rows(stmt, batch.rows[stmt])
+            else:
+                store.sql_many(stmt, batch.rows[stmt])
+        batch.stmts = []
+        batch.rows = {}
+
+        # Inputs that preceded the outputs they spend within the batch.
+        for outpoint, txin_ids in batch.unlinked.iteritems():
+            if outpoint in batch.outpoints:
+                txout_id = batch.outpoints[outpoint][0]
+                batch.links += [(txout_id, txin_id) for txin_id in txin_ids]
+        batch.unlinked = {}
+
+        store.sql_many("UPDATE txin SET txout_id = ? WHERE txin_id = ?",
+                       batch.links)
+        store.sql_many("DELETE FROM unlinked_txin WHERE txin_id = ?",
+                       [(txin_id,) for txout_id, txin_id in batch.links])
+        store._link_unspent_txouts(batch.links)
+        batch.links = []
+
+    def _can_copy(store):
+        # psycopg2 cursors implement COPY FROM STDIN.  Rows must hold
+        # binary values as buffer or bytearray, or hex text.
+        return hasattr(store.cursor, 'copy_expert') and \
+            store.config.get('binary_type') in (
+                "buffer", "bytearray", "pg-bytea", "hex")
+
+    def _copy_rows(store, stmt, rows):
+        """Load rows with COPY instead of the INSERT statement stmt."""
+        match = INSERT_RE.match(stmt)
+        columns = [col.strip() for col in match.group(2).split(",")]
+        copy = "COPY %s (%s) FROM STDIN" % (match.group(1), ", ".join(columns))
+        data = StringIO.StringIO()
+        for row in rows:
+            data.write("\t".join(map(copy_text, row)))
+            data.write("\n")
+        data.seek(0)
+        store.sqllog.info("COPY: %s [%d rows]", copy, len(rows))
         try:
-            tx_id = store.import_tx(tx, is_coinbase)
+            store.cursor.copy_expert(copy, data)
+        except Exception, e:
+            store.sqllog.info("EXCEPTION: %s", e)
+            raise
+        finally:
+            store.in_transaction = True
+
+    def is_bulk_loading(store):
+        """
+        Return true if the address tables await finish_bulk_load.  A
+        bulk load may start or finish in another process after this
+        one reads bulk_loading, so readers of those tables check the
+        database each time.
+        """
+        row = store.selectrow("""
+            SELECT configvar_value
+              FROM configvar
+             WHERE configvar_name = 'bulk_load'""")
+        store.bulk_loading = row is not None and row[0] == "true"
+        return store.bulk_loading
+
+    def start_bulk_load(store):
+        """
+        Prepare an empty database for bulk loading: drop the indexes in
+        BULK_LOAD_INDEXES and remember that finish_bulk_load must run.
+        """
+        (count,) = store.selectrow("SELECT COUNT(1) FROM block")
+        if count:
+            store.log.warning("Ignoring bulk-load: the database has blocks.")
+            return
+        store.log.info("Starting bulk load.")
+        for table, name, ddl in BULK_LOAD_INDEXES:
+            store.drop_index_if_exists(table, name)
+        store.set_configvar("bulk_load", "true")
+        store.commit()
+        store.bulk_loading = True
+
+    def finish_bulk_load(store):
+        """
+        Create the indexes dropped by start_bulk_load, then populate
+        block_txin and satoshi-seconds for blocks with known height.
+        May be interrupted and run again.
+        """
+        store.log.info("Finishing bulk load: creating indexes.")
+        for table, name, ddl in BULK_LOAD_INDEXES:
+            store.drop_index_if_exists(table, name)
+            store.ddl(ddl)
+
+        store.log.info("Populating block_txin and satoshi-seconds.")
+        store.sql("DELETE FROM block_txin")
+        stats = {}
+        count = 0
+        for row in store.selectall("""
+            SELECT block_id, prev_block_id, block_nTime,
+                   block_total_satoshis
+              FROM block
+             WHERE block_height IS NOT NULL
+             ORDER BY block_height"""):
+            block_id, prev_id, nTime, satoshis = row
+            block_id = int(block_id)
+            nTime = int(nTime)
+            satoshis = None if satoshis is None else int(satoshis)
+
+            if prev_id is None:
+                prev_ss, prev_satoshis, prev_nTime = 0, 0, nTime
+            else:
+                prev_ss, prev_satoshis, prev_nTime = stats.get(
+                    int(prev_id), (None, None, None))
+
+            store._populate_block_txin(block_id)
+
+            if store._has_unlinked_txins(block_id):
+                destroyed = None
+                ss = None
+            else:
+                destroyed = store._get_block_ss_destroyed(block_id, nTime)
+                if prev_ss is None or prev_satoshis is None or \
+                        prev_satoshis < 0:
+                    ss = None
+                else:
+                    ss = prev_ss + prev_satoshis * (nTime - prev_nTime) \
+                        - destroyed
+
+            store.sql("""
+                UPDATE block
+                   SET block_satoshi_seconds = ?,
+                       block_ss_destroyed = ?
+                 WHERE block_id = ?""",
+                      (store.intin(ss), store.intin(destroyed), block_id))
+            stats[block_id] = (ss, satoshis, nTime)
+
+            count += 1
+            if count % 1000 == 0:
+                store.commit()
+                store.log.info("Updated %d blocks", count)
+
+        store.set_configvar("bulk_load", "false")
+        store.commit()
+        store.bulk_loading = False
+        store.rebuild_address_balance()
+        store.rebuild_address_history()
+        store.rebuild_unspent_txout()
+        store.log.info("Bulk load finished, %d blocks.", count)
+
+    def import_and_commit_batch(store, batch):
+        if store.commit_bytes != 0:
+            store.flush_batch(batch)
+            return
+        try:
+            store.flush_batch(batch)
+            store.commit()
+
+        except store.module.DatabaseError:
+            store.rollback()
+            # Perhaps another process imported some of these
+            # transactions.  Retry them one at a time.
+            store.log.info("Batch insert failed, retrying %d transactions",
+                           len(batch.txs))
+            for tx, is_coinbase in batch.txs:
+                tx['tx_id'] = store.import_and_commit_tx(tx, is_coinbase)
+        batch.txs = []
+
+    def import_and_commit_tx(store, tx, is_coinbase, source=None):
+        try:
+            tx_id = store.import_tx(tx, is_coinbase, source=source)
             store.commit()
 
         except store.module.DatabaseError:
@@ -2289,6 +3275,12 @@ store._ddl['txout_approx'],
 
     def export_tx(store, tx_id=None, tx_hash=None, decimals=8, format="api"):
         """Return a dict as seen by /rawtx or None if not found."""
+        tx_id, tx = store.export_tx_with_id(tx_id, tx_hash, decimals, format)
+        return tx
+
+    def export_tx_with_id(store, tx_id=None, tx_hash=None, decimals=8,
+                          format="api"):
+        """Like export_tx, but return (tx_id, tx) or (None, None)."""
 
         tx = {}
         is_bin = format == "binary"
@@ -2300,7 +3292,7 @@ store._ddl['txout_approx'],
                  WHERE tx_id = ?
             """, (tx_id,))
             if row is None:
-                return None
+                return None, None
             tx['hash'] = store.hashout_hex(row[0])
 
         elif tx_hash is not None:
@@ -2310,9 +3302,9 @@ store._ddl['txout_approx'],
                  WHERE tx_hash = ?
             """, (store.hashin_hex(tx_hash),))
             if row is None:
-                return None
+                return None, None
             tx['hash'] = tx_hash.decode('hex')[::-1] if is_bin else tx_hash
-            tx_id = row[0]
+            tx_id = int(row[0])
 
         else:
             raise ValueError("export_tx requires either tx_id or tx_hash.")
@@ -2387,7 +3379,78 @@ store._ddl['txout_approx'],
             tx['vin_sz'] = len(txins)
             tx['vout_sz'] = len(txouts)
 
-        return tx
+        return tx_id, tx
+
+    def export_known_txs(store, tx_hashes):
+        """
+        Return a dict mapping each of tx_hashes (hex) found in the
+        database to the transaction in export_tx's binary format.
+        Uses three queries per IN_LIST_MAX hashes.
+        """
+        ret = {}
+        for i in xrange(0, len(tx_hashes), IN_LIST_MAX):
+            ret.update(store._export_known_txs(
+                    tx_hashes[i : i + IN_LIST_MAX]))
+        return ret
+
+    def _export_known_txs(store, tx_hashes):
+        if not tx_hashes:
+            return {}
+        txs = {}
+        for tx_id, tx_hash, version, lockTime, size in store.selectall("""
+            SELECT tx_id, tx_hash, tx_version, tx_lockTime, tx_size
+              FROM tx
+             WHERE tx_hash IN (?""" + (",?" * (len(tx_hashes)-1)) + """)""",
+                                  map(store.hashin_hex, tx_hashes)):
+            txs[int(tx_id)] = {
+                'hash': store.hashout(tx_hash),
+                'version': int(version),
+                'lockTime': int(lockTime),
+                'size': int(size),
+                'txIn': [],
+                'txOut': []}
+        if not txs:
+            return {}
+
+        placeholders = "?" + (",?" * (len(txs)-1))
+        tx_ids = txs.keys()
+
+        for row in store.selectall("""
+            SELECT
+                txin.tx_id,
+                COALESCE(tx.tx_hash, uti.txout_tx_hash),
+                COALESCE(txout.txout_pos, uti.txout_pos)""" + (""",
+                txin_scriptSig,
+                txin_sequence""" if store.keep_scriptsig else "") + """
+            FROM txin
+            LEFT JOIN txout ON (txin.txout_id = txout.txout_id)
+            LEFT JOIN tx ON (txout.tx_id = tx.tx_id)
+            LEFT JOIN unlinked_txin uti ON (txin.txin_id = uti.txin_id)
+            WHERE txin.tx_id IN (""" + placeholders + """)
+            ORDER BY txin.tx_id, txin.txin_pos""", tx_ids):
+            if row[1] is None:
+                # Coinbase.
+                txin = {'prevout_hash': NULL_HASH, 'prevout_n': 0xffffffff}
+            else:
+                txin = {
+                    'prevout_hash': store.hashout(row[1]),
+                    'prevout_n': None if row[2] is None else int(row[2])}
+            if store.keep_scriptsig:
+                txin['scriptSig'] = store.binout(row[3])
+                txin['sequence'] = None if row[4] is None else int(row[4])
+            txs[int(row[0])]['txIn'].append(txin)
+
+        for tx_id, satoshis, scriptPubKey in store.selectall("""
+            SELECT tx_id, txout_value, txout_scriptPubKey
+              FROM txout
+             WHERE tx_id IN (""" + placeholders + """)
+            ORDER BY tx_id, txout_pos""", tx_ids):
+            txs[int(tx_id)]['txOut'].append({
+                    'value': int(satoshis),
+                    'scriptPubKey': store.binout(scriptPubKey)})
+
+        return dict((tx['hash'][::-1].encode('hex'), tx)
+                    for tx in txs.itervalues())
 
     # Called to indicate that the given block has the correct magic
     # number and policy for the given chains.  Updates CHAIN_CANDIDATE
@@ -2444,9 +3507,14 @@ store._ddl['txout_approx'],
                     store.disconnect_block(block_id, chain_id)
                 for block_id in to_connect:
                     store.connect_block(block_id, chain_id)
+                if to_disconnect:
+                    store._pending_reorgs.append(
+                        (chain_id, int(winner_height)))
 
             elif b['hashPrev'] == GENESIS_HASH_PREV:
                 in_longest = 1  # Assume only one genesis block per chain.  XXX
+                store._main_chain_connect(b['block_id'], chain_id)
+                store._update_address_tables(b['block_id'], chain_id, 1)
             else:
                 in_longest = 0
 
@@ -2542,6 +3610,8 @@ store._ddl['txout_approx'],
                SET in_longest = 0
              WHERE block_id = ? AND chain_id = ?""",
                   (block_id, chain_id))
+        store._main_chain_disconnect(block_id, chain_id)
+        store._update_address_tables(block_id, chain_id, -1)
 
     def connect_block(store, block_id, chain_id):
         store.sql("""
@@ -2549,8 +3619,375 @@ store._ddl['txout_approx'],
                SET in_longest = 1
              WHERE block_id = ? AND chain_id = ?""",
                   (block_id, chain_id))
+        store._main_chain_connect(block_id, chain_id)
+        store._update_address_tables(block_id, chain_id, 1)
+
+    def _update_address_tables(store, block_id, chain_id, sign):
+        """
+        Apply a block's connection (sign=1) to or disconnection
+        (sign=-1) from chain_id's longest branch to the tables indexed
+        by address.
+        """
+        # address_history continues the balances from before the block.
+        store._update_address_history(block_id, chain_id, sign)
+        store._update_address_balance(block_id, chain_id, sign)
+        store._update_unspent_txout(block_id, chain_id, sign)
+
+    def _update_unspent_txout(store, block_id, chain_id, sign):
+        if store.bulk_loading:
+            # finish_bulk_load populates unspent_txout.
+            return
+
+        if sign > 0:
+            store.sql("""
+                INSERT INTO unspent_txout (
+                    chain_id, txout_id, pubkey_id, block_height
+                )
+                SELECT ?, txout.txout_id, txout.pubkey_id, b.block_height
+                  FROM block b
+                  JOIN block_tx bt ON (bt.block_id = b.block_id)
+                  JOIN txout ON (txout.tx_id = bt.tx_id)
+                 WHERE b.block_id = ?
+                   AND txout.pubkey_id IS NOT NULL
+                   AND NOT EXISTS (
+                       SELECT 1
+                         FROM unspent_txout u
+                        WHERE u.chain_id = ?
+                          AND u.txout_id = txout.txout_id)""",
+                      (chain_id, block_id, chain_id))
+            store.sql("""
+                DELETE FROM unspent_txout
+                 WHERE chain_id = ?
+                   AND txout_id IN (
+                       SELECT txin.txout_id
+                         FROM block_tx bt
+                         JOIN txin ON (txin.tx_id = bt.tx_id)
+                        WHERE bt.block_id = ?)""", (chain_id, block_id))
+            return
+
+        # The block is no longer in_longest, so this restores only
+        # outputs from earlier blocks.
+        store.sql("""
+            INSERT INTO unspent_txout (
+                chain_id, txout_id, pubkey_id, block_height
+            )
+            SELECT ?, prevout.txout_id, prevout.pubkey_id,
+                   MIN(cc.block_height)
+              FROM block_tx bt
+              JOIN txin ON (txin.tx_id = bt.tx_id)
+              JOIN txout prevout ON (prevout.txout_id = txin.txout_id)
+              JOIN block_tx pbt ON (pbt.tx_id = prevout.tx_id)
+              JOIN chain_candidate cc ON (cc.block_id = pbt.block_id)
+             WHERE bt.block_id = ?
+               AND cc.chain_id = ?
+               AND cc.in_longest = 1
+               AND prevout.pubkey_id IS NOT NULL
+             GROUP BY prevout.txout_id, prevout.pubkey_id""",
+                  (chain_id, block_id, chain_id))
+        store.sql("""
+            DELETE FROM unspent_txout
+             WHERE chain_id = ?
+               AND txout_id IN (
+                   SELECT txout.txout_id
+                     FROM block_tx bt
+                     JOIN txout ON (txout.tx_id = bt.tx_id)
+                    WHERE bt.block_id = ?)""", (chain_id, block_id))
+
+    def _link_unspent_txouts(store, links):
+        """
+        Remove from unspent_txout the outputs in links, a list of
+        (txout_id, txin_id), whose inputs are in a longest chain.
+        """
+        if store.bulk_loading or not links:
+            return
+        store.sql_many("""
+            DELETE FROM unspent_txout
+             WHERE txout_id = ?
+               AND chain_id IN (
+                   SELECT cc.chain_id
+                     FROM txin
+                     JOIN block_tx bt ON (bt.tx_id = txin.tx_id)
+                     JOIN chain_candidate cc ON (cc.block_id = bt.block_id)
+                    WHERE txin.txin_id = ?
+                      AND cc.in_longest = 1)""", links)
+
+    def rebuild_unspent_txout(store):
+        """Recompute unspent_txout from the longest chains."""
+        store.log.info("Populating unspent_txout.")
+        store.sql("DELETE FROM unspent_txout")
+        for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+            chain_id = int(chain_id)
+            store.sql("""
+                INSERT INTO unspent_txout (
+                    chain_id, txout_id, pubkey_id, block_height
+                )
+                SELECT ?, txout.txout_id, txout.pubkey_id,
+                       MIN(cc.block_height)
+                  FROM chain_candidate cc
+                  JOIN block_tx bt ON (bt.block_id = cc.block_id)
+                  JOIN txout ON (txout.tx_id = bt.tx_id)
+                 WHERE cc.chain_id = ?
+                   AND cc.in_longest = 1
+                   AND txout.pubkey_id IS NOT NULL
+                   AND NOT EXISTS (
+                       SELECT 1
+                         FROM txin
+                         JOIN block_tx sbt ON (sbt.tx_id = txin.tx_id)
+                         JOIN chain_candidate scc
+                              ON (scc.block_id = sbt.block_id)
+                        WHERE txin.txout_id = txout.txout_id
+                          AND scc.chain_id = ?
+                          AND scc.in_longest = 1)
+                 GROUP BY txout.txout_id, txout.pubkey_id""",
+                      (chain_id, chain_id, chain_id))
+            store.log.info("Chain %d: %d unspent outputs",
+                           chain_id, store.cursor.rowcount)
+        store.commit()
+
+    def _update_address_history(store, block_id, chain_id, sign):
+        """
+        Add (sign=1) or remove (sign=-1) the address_history rows of a
+        block at the end of chain_id.  Call before
+        _update_address_balance, whose balances it continues.
+        """
+        if store.bulk_loading:
+            # finish_bulk_load populates address_history.
+            return
+
+        if sign < 0:
+            store.sql("""
+                DELETE FROM address_history
+                 WHERE block_id = ?
+                   AND chain_id = ?""", (block_id, chain_id))
+            return
+
+        rows = store._address_history_rows("""
+                 WHERE b.block_id = ?""", (block_id,))
+        pubkey_ids = list(set(row[0] for row in rows))
+        balance = {}
+        for i in xrange(0, len(pubkey_ids), IN_LIST_MAX):
+            chunk = pubkey_ids[i : i + IN_LIST_MAX]
+            for pubkey_id, received, sent in store.selectall("""
+                SELECT pubkey_id, received, sent
+                  FROM address_balance
+                 WHERE chain_id = ?
+                   AND pubkey_id IN (""" + ", ".join(["?"] * len(chunk)) + ")",
+                [chain_id] + chunk):
+                balance[int(pubkey_id)] = int(received) - int(sent)
+        store._insert_address_history(chain_id, rows, balance)
+
+    def _address_history_rows(store, where, params):
+        """
+        Return address_history rows, less chain_id and balance, for
+        transactions in blocks selected by where, an SQL condition on
+        block b and block_tx bt, in table key order.
+        """
+        rows = store.selectall("""
+            SELECT txout.pubkey_id, b.block_height, bt.tx_pos, 0,
+                   txout.txout_pos, b.block_id, bt.tx_id, txout.txout_value
+              FROM block b
+              JOIN block_tx bt ON (bt.block_id = b.block_id)
+              JOIN txout ON (txout.tx_id = bt.tx_id)""" + where + """
+               AND txout.pubkey_id IS NOT NULL""", params)
+        rows += store.selectall("""
+            SELECT prevout.pubkey_id, b.block_height, bt.tx_pos, 1,
+                   txin.txin_pos, b.block_id, bt.tx_id, -prevout.txout_value
+              FROM block b
+              JOIN block_tx bt ON (bt.block_id = b.block_id)
+              JOIN txin ON (txin.tx_id = bt.tx_id)
+              JOIN txout prevout ON (prevout.txout_id = txin.txout_id)""" +
+                                where + """
+               AND prevout.pubkey_id IS NOT NULL""", params)
+        rows = [tuple(map(int, row)) for row in rows]
+        rows.sort()
+        return rows
+
+    def _insert_address_history(store, chain_id, rows, balance):
+        """
+        Insert rows from _address_history_rows, continuing the running
+        balances in balance, a dict mapping pubkey_id to balance.
+        """
+        params = []
+        for (pubkey_id, height, tx_pos, is_in, io_pos, block_id, tx_id,
+             delta) in rows:
+            balance[pubkey_id] = balance.get(pubkey_id, 0) + delta
+            params.append((pubkey_id, height, tx_pos, chain_id, is_in,
+                           io_pos, block_id, tx_id, store.intin(delta),
+                           store.intin(balance[pubkey_id])))
+        store.sql_many("""
+            INSERT INTO address_history (
+                pubkey_id, block_height, tx_pos, chain_id, is_in, io_pos,
+                block_id, tx_id, delta, balance
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", params)
+
+    def rebuild_address_history(store):
+        """Recompute address_history from the longest chains."""
+        store.log.info("Populating address_history.")
+        store.sql("DELETE FROM address_history")
+        for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+            chain_id = int(chain_id)
+            balance = {}
+            count = 0
+            # One block at a time keeps memory use bounded.
+            for (block_id,) in store.selectall("""
+                SELECT block_id
+                  FROM chain_candidate
+                 WHERE chain_id = ?
+                   AND in_longest = 1
+                 ORDER BY block_height""", (chain_id,)):
+                rows = store._address_history_rows("""
+                 WHERE b.block_id = ?""", (block_id,))
+                store._insert_address_history(chain_id, rows, balance)
+                count += len(rows)
+            store.log.info("Chain %d: %d address_history rows",
+                           chain_id, count)
+        store.commit()
+
+    def _update_address_balance(store, block_id, chain_id, sign):
+        """
+        Add (sign=1) or subtract (sign=-1) the outputs and spends of
+        the block's transactions to and from address_balance.
+        """
+        if store.bulk_loading:
+            # finish_bulk_load populates address_balance.
+            return
+
+        deltas = {}
+        for pubkey_id, value, count in store.selectall("""
+            SELECT txout.pubkey_id, SUM(txout.txout_value), COUNT(1)
+              FROM block_tx bt
+              JOIN txout ON (txout.tx_id = bt.tx_id)
+             WHERE bt.block_id = ?
+               AND txout.pubkey_id IS NOT NULL
+             GROUP BY txout.pubkey_id""", (block_id,)):
+            deltas[int(pubkey_id)] = [int(value), 0, int(count), 0]
+        for pubkey_id, value, count in store.selectall("""
+            SELECT prevout.pubkey_id, SUM(prevout.txout_value), COUNT(1)
+              FROM block_tx bt
+              JOIN txin ON (txin.tx_id = bt.tx_id)
+              JOIN txout prevout ON (prevout.txout_id = txin.txout_id)
+             WHERE bt.block_id = ?
+               AND prevout.pubkey_id IS NOT NULL
+             GROUP BY prevout.pubkey_id""", (block_id,)):
+            delta = deltas.setdefault(int(pubkey_id), [0, 0, 0, 0])
+            delta[1] = int(value)
+            delta[3] = int(count)
+        store._add_address_balances(chain_id, deltas, sign)
+
+    def _add_address_balances(store, chain_id, deltas, sign=1):
+        """
+        Add deltas, a dict mapping pubkey_id to [received, sent,
+        txout_count, txin_count], times sign to chain_id's
+        address_balance rows.
+        """
+        pubkey_ids = deltas.keys()
+        existing = set()
+        for i in xrange(0, len(pubkey_ids), IN_LIST_MAX):
+            chunk = pubkey_ids[i : i + IN_LIST_MAX]
+            existing.update(int(pubkey_id) for (pubkey_id,) in store.selectall(
+                """
+                SELECT pubkey_id
+                  FROM address_balance
+                 WHERE chain_id = ?
+                   AND pubkey_id IN (""" + ", ".join(["?"] * len(chunk)) + ")",
+                [chain_id] + chunk))
+
+        updates = []
+        inserts = []
+        for pubkey_id, (received, sent, txouts, txins) in \
+                deltas.iteritems():
+            if pubkey_id in existing:
+                updates.append((store.intin(sign * received),
+                                store.intin(sign * sent),
+                                store.intin(sign * txouts),
+                                store.intin(sign * txins),
+                                chain_id, pubkey_id))
+            else:
+                inserts.append((chain_id, pubkey_id,
+                                store.intin(sign * received),
+                                store.intin(sign * sent),
+                                store.intin(sign * txouts),
+                                store.intin(sign * txins)))
+        store.sql_many("""
+            UPDATE address_balance
+               SET received = received + ?,
+                   sent = sent + ?,
+                   txout_count = txout_count + ?,
+                   txin_count = txin_count + ?
+             WHERE chain_id = ?
+               AND pubkey_id = ?""", updates)
+        store.sql_many("""
+            INSERT INTO address_balance (
+                chain_id, pubkey_id, received, sent, txout_count,
+                txin_count
+            ) VALUES (?, ?, ?, ?, ?, ?)""", inserts)
+
+    def rebuild_address_balance(store):
+        """Recompute address_balance from the longest chains."""
+        store.log.info("Populating address_balance.")
+        store.sql("DELETE FROM address_balance")
+        for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+            chain_id = int(chain_id)
+            deltas = {}
+            for pubkey_id, value, count in store.selectall("""
+                SELECT txout.pubkey_id, SUM(txout.txout_value), COUNT(1)
+                  FROM chain_candidate cc
+                  JOIN block_tx bt ON (bt.block_id = cc.block_id)
+                  JOIN txout ON (txout.tx_id = bt.tx_id)
+                 WHERE cc.chain_id = ?
+                   AND cc.in_longest = 1
+                   AND txout.pubkey_id IS NOT NULL
+                 GROUP BY txout.pubkey_id""", (chain_id,)):
+                deltas[int(pubkey_id)] = [int(value), 0, int(count), 0]
+            for pubkey_id, value, count in store.selectall("""
+                SELECT prevout.pubkey_id, SUM(prevout.txout_value), COUNT(1)
+                  FROM chain_candidate cc
+                  JOIN block_tx bt ON (bt.block_id = cc.block_id)
+                  JOIN txin ON (txin.tx_id = bt.tx_id)
+                  JOIN txout prevout ON (prevout.txout_id = txin.txout_id)
+                 WHERE cc.chain_id = ?
+                   AND cc.in_longest = 1
+                   AND prevout.pubkey_id IS NOT NULL
+                 GROUP BY prevout.pubkey_id""", (chain_id,)):
+                delta = deltas.setdefault(int(pubkey_id), [0, 0, 0, 0])
+                delta[1] = int(value)
+                delta[3] = int(count)
+            store._add_address_balances(chain_id, deltas)
+            store.log.info("Chain %d: %d addresses", chain_id, len(deltas))
+        store.commit()
 
     def lookup_txout(store, tx_hash, txout_pos):
+        """
+        Return the txout_id and value of an output, or (None, None) if
+        not found.  Consult txout_cache first.
+        """
+        if store.txout_cache is not None:
+            ret = store.txout_cache.get((tx_hash, txout_pos))
+            if ret is not None:
+                return ret[:2]
+        return store._select_txout(tx_hash, txout_pos)
+
+    def spend_txout(store, outpoint):
+        """
+        Return the txout_id, value, and source block (block_id, nTime)
+        of the output spent by an input, dropping it from txout_cache.
+        The source is None unless the output was cached by a block
+        import.
+        """
+        if store.txout_cache is not None:
+            ret = store.txout_cache.pop(outpoint)
+            if ret is not None:
+                return ret
+        return store._select_txout(outpoint[0], outpoint[1]) + (None,)
+
+    def forget_cached_txouts(store, tx):
+        if store.txout_cache is not None:
+            for pos in xrange(len(tx['txOut'])):
+                key = (tx['hash'], pos)
+                if key in store.txout_cache:
+                    del store.txout_cache[key]
+
+    def _select_txout(store, tx_hash, txout_pos):
         row = store.selectrow("""
             SELECT txout.txout_id, txout.txout_value
               FROM txout, tx
@@ -2606,18 +4043,32 @@ store._ddl['txout_approx'],
         return store._pubkey_id(pubkey_hash, pubkey)
 
     def _pubkey_id(store, pubkey_hash, pubkey):
+        cache = store.pubkey_cache
+        if cache is not None:
+            pubkey_id = store._new_pubkey_ids.get(pubkey_hash)
+            if pubkey_id is None:
+                pubkey_id = cache.get(pubkey_hash)
+            if pubkey_id is not None:
+                return pubkey_id
+
         dbhash = store.binin(pubkey_hash)  # binin, not hashin for 160-bit
         row = store.selectrow("""
             SELECT pubkey_id
               FROM pubkey
              WHERE pubkey_hash = ?""", (dbhash,))
         if row:
+            # Rows inserted by this transaction are in _new_pubkey_ids,
+            # so this one is committed.
+            if cache is not None:
+                cache[pubkey_hash] = row[0]
             return row[0]
         pubkey_id = store.new_id("pubkey")
         store.sql("""
             INSERT INTO pubkey (pubkey_id, pubkey_hash, pubkey)
             VALUES (?, ?, ?)""",
                   (pubkey_id, dbhash, store.binin(pubkey)))
+        if cache is not None:
+            store._new_pubkey_ids[pubkey_hash] = pubkey_id
         return pubkey_id
 
     def flush(store):
@@ -2632,7 +4083,40 @@ store._ddl['txout_approx'],
             store.flush()
 
     def catch_up(store):
+        if store.tx_bloom is not None and store._tx_bloom_lockable and \
+                not store._tx_bloom_stale:
+            store._acquire_load_lock()
+        try:
+            if store.datadir_workers > 1 and len(store.datadirs) > 1:
+                ok = store._catch_up_parallel()
+            else:
+                ok = store._catch_up_serial()
+            store.save_tx_bloom()
+        finally:
+            store._release_load_lock()
+
+        if store.bulk_loading:
+            if not ok:
+                store.log.warning("Bulk load will continue next time.")
+            else:
+                store.finish_bulk_load()
+
+    def _catch_up_serial(store):
+        ok = True
         for dircfg in store.datadirs:
+            if not store._catch_up_datadir(dircfg):
+                ok = False
+        return ok
+
+    def _catch_up_datadir(store, dircfg):
+        """
+        Load new blocks from dircfg and return True, or log the error
+        and return False.  Retry up to deadlock_retries times after
+        errors that concurrent loaders can cause.
+        """
+        stats = store.import_stats.copy()
+        retries = 0
+        while True:
             try:
                 loader = dircfg['loader'] or store.default_loader
                 if loader == "blkfile":
@@ -2646,11 +4130,181 @@ store._ddl['txout_approx'],
                 else:
                     raise Exception("Unknown datadir loader: %s" % loader)
 
+                if store.blkindex is not None:
+                    store.repair_gaps()
                 store.flush()
+                ok = True
 
             except Exception, e:
-                store.log.exception("Failed to catch up %s", dircfg)
                 store.rollback()
+                # Memory pool transactions may have been rolled back.
+                store._mempool_seen.pop(dircfg['id'], None)
+
+                if store._load_lock is not None and \
+                        not store._tx_bloom_stale and \
+                        isinstance(e, store.module.IntegrityError):
+                    # Perhaps another process stored a transaction that
+                    # tx_bloom reported new.  Look them all up instead.
+                    store.log.warning("Retrying %s without skipping"
+                                      " transaction lookups after: %s",
+                                      dircfg['dirname'], e)
+                    store._tx_bloom_stale = True
+                    store._reset_dircfg(dircfg)
+                    continue
+
+                if retries < store.deadlock_retries and \
+                        store._is_lock_conflict(e):
+                    retries += 1
+                    store.log.warning("Retrying %s after: %s",
+                                      dircfg['dirname'], e)
+                    time.sleep(random.uniform(0, retries))
+                    store._reset_dircfg(dircfg)
+                    continue
+
+                store.log.exception("Failed to catch up %s", dircfg)
+                ok = False
+
+            store.log_import_stats(dircfg, stats)
+            return ok
+
+    def _is_lock_conflict(store, e):
+        """
+        Return true if e is a deadlock, serialization failure, or lock
+        wait timeout, which another connection can cause, so that the
+        transaction may succeed if retried.
+        """
+        if not isinstance(e, store.module.DatabaseError):
+            return False
+        name = store.module.__name__
+        if name == "sqlite3":
+            return str(e) in SQLITE_LOCK_CONFLICTS
+        if name == "psycopg2":
+            code = getattr(e, 'pgcode', None)
+        elif name == "cx_Oracle":
+            code = getattr(e.args[0], 'code', None) if e.args else None
+        else:
+            code = e.args[0] if e.args else None
+        return code in LOCK_CONFLICT_CODES.get(name, ())
+
+    def _reset_dircfg(store, dircfg):
+        """Move dircfg back to its last committed block file position."""
+        row = store.selectrow("""
+            SELECT blkfile_number, blkfile_offset
+              FROM datadir
+             WHERE dirname = ?""", (dircfg['dirname'],))
+        if row:
+            dircfg['blkfile_number'], dircfg['blkfile_offset'] = map(int, row)
+
+    def _catch_up_parallel(store):
+        """
+        Load datadirs in up to datadir_workers threads, each with its
+        own connection.  Datadirs of the same chain, or of unknown
+        chain, load in the same thread one after another, so workers
+        do not race to import the same blocks.  Return True if all
+        succeed.
+        """
+        # catch_up may hold the lock already.
+        lock = store._load_lock
+        if lock is None:
+            lock = store.get_lock()
+        if lock is None:
+            store.log.info("The database does not support concurrent"
+                           " updates; loading datadirs serially.")
+            store.datadir_workers = 0
+            return store._catch_up_serial()
+
+        try:
+            groups = collections.OrderedDict()
+            for dircfg in store.datadirs:
+                groups.setdefault(dircfg['chain_id'], []).append(dircfg)
+            queue = Queue.Queue()
+            for group in groups.itervalues():
+                queue.put(group)
+            if store.parse_workers:
+                store._get_parse_pool()
+
+            workers = []
+            results = []
+
+            def work():
+                try:
+                    worker = store._new_worker()
+                except Exception:
+                    store.log.exception("Failed to start datadir worker")
+                    results.append(False)
+                    return
+                workers.append(worker)
+                try:
+                    while True:
+                        try:
+                            group = queue.get_nowait()
+                        except Queue.Empty:
+                            break
+                        for dircfg in group:
+                            results.append(worker._catch_up_datadir(dircfg))
+                finally:
+                    worker.close()
+
+            threads = [threading.Thread(target=work, name="DatadirWorker")
+                       for i in xrange(min(store.datadir_workers,
+                                           len(groups)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for worker in workers:
+                for key in store.import_stats:
+                    store.import_stats[key] += worker.import_stats[key]
+                if worker._tx_bloom_stale:
+                    store._tx_bloom_stale = True
+
+            # Other connections changed the chains.
+            store.rollback()
+            return queue.empty() and all(results)
+
+        finally:
+            if lock is not store._load_lock:
+                store.release_lock(lock)
+
+    def _new_worker(store):
+        """
+        Return a new DataStore with its own connection and caches for
+        use by the calling thread.  It shares datadirs, the block
+        index, tx_bloom and its state, and the memory pool state with
+        store.
+        """
+        args = secondary_args(store.args)
+        args.func_dict['blkfile_index'] = None
+        worker = new(args)
+        worker.datadirs = store.datadirs
+        worker.reorg_listeners = store.reorg_listeners
+        worker._mempool_seen = store._mempool_seen
+        worker.blkindex = store.blkindex
+        worker.tx_bloom = store.tx_bloom
+        worker._tx_bloom_lock = store._tx_bloom_lock
+        worker._tx_bloom_stale = store._tx_bloom_stale
+        worker._load_lock = store._load_lock
+        worker._parse_pool = store._parse_pool
+        return worker
+
+    def log_import_stats(store, dircfg, since):
+        blocks = store.import_stats['blocks'] - since['blocks']
+        if blocks == 0:
+            return
+        rows = store.import_stats['rows'] - since['rows']
+        seconds = store.import_stats['seconds'] - since['seconds']
+        store.log.info(
+            "Imported %d blocks, %d rows in %.1f seconds (%.0f rows/s,"
+            " batch-insert %s) from %s", blocks, rows, seconds,
+            rows / seconds if seconds > 0 else 0,
+            "on" if store.batch_insert or store.bulk_loading else "off",
+            dircfg['dirname'])
+        if store.txout_cache is not None:
+            store.log.info("txout cache: %s", store.txout_cache.stats())
+        if store.pubkey_cache is not None:
+            store.log.info("pubkey cache: %s", store.pubkey_cache.stats())
+        store.log.info("block cache: %s", store._blocks.stats())
 
     def catch_up_rpc(store, dircfg):
         """
@@ -2685,9 +4339,13 @@ store._ddl['txout_approx'],
         url = "http://" + rpcuser + ":" + rpcpassword + "@" + rpcconnect \
             + ":" + rpcport
 
+        # One client for the whole catch-up reuses its connections.
+        client = util.JsonrpcClient(url, timeout=store.rpc_timeout,
+                                    pool_size=store.rpc_pool_size)
+
         def rpc(func, *params):
             store.rpclog.info("RPC>> %s %s", func, params)
-            ret = util.jsonrpc(url, func, *params)
+            ret = client.call(func, *params)
 
             if (store.rpclog.isEnabledFor(logging.INFO)):
                 store.rpclog.info("RPC<< %s",
@@ -2708,9 +4366,10 @@ store._ddl['txout_approx'],
              WHERE chain_id = ?""", (chain_id,))
         height = 0 if max_height is None else int(max_height) + 1
 
-        def get_tx(rpc_tx_hash):
+        def get_tx(rpc_tx_hash, rpc_tx_hex=None):
             try:
-                rpc_tx_hex = rpc("getrawtransaction", rpc_tx_hash)
+                if rpc_tx_hex is None:
+                    rpc_tx_hex = rpc("getrawtransaction", rpc_tx_hash)
 
             except util.JsonrpcException, e:
                 if e.code != -5:  # -5: transaction not in index.
@@ -2738,6 +4397,82 @@ store._ddl['txout_approx'],
             tx['hash'] = tx_hash
             return tx
 
+        def import_rpc_block(rpc_block, height, raw_txs):
+            """
+            Import a block as returned by getblock.  raw_txs maps
+            transaction hashes to prefetched hex data.  Return false
+            if a transaction is unavailable.
+            """
+            hash = rpc_block['hash'].decode('hex')[::-1]
+            prev_hash = \
+                rpc_block['previousblockhash'].decode('hex')[::-1] \
+                if 'previousblockhash' in rpc_block \
+                else GENESIS_HASH_PREV
+
+            block = {
+                'hash':     hash,
+                'version':  int(rpc_block['version']),
+                'hashPrev': prev_hash,
+                'hashMerkleRoot':
+                    rpc_block['merkleroot'].decode('hex')[::-1],
+                'nTime':    int(rpc_block['time']),
+                'nBits':    int(rpc_block['bits'], 16),
+                'nNonce':   int(rpc_block['nonce']),
+                'transactions': [],
+                'size':     int(rpc_block['size']),
+                'height':   height,
+                }
+
+            if util.block_hash(block) != hash:
+                raise InvalidBlock('block hash mismatch')
+
+            known = store.export_known_txs([
+                    str(rpc_tx_hash) for rpc_tx_hash in rpc_block['tx']
+                    if raw_txs.get(rpc_tx_hash) is None])
+
+            for rpc_tx_hash in rpc_block['tx']:
+                rpc_tx_hex = raw_txs.get(rpc_tx_hash)
+                if rpc_tx_hex is not None:
+                    tx = get_tx(rpc_tx_hash, rpc_tx_hex)
+                else:
+                    tx = known.get(rpc_tx_hash)
+                    if tx is None:
+                        tx = get_tx(rpc_tx_hash)
+                        if tx is None:
+                            return False
+
+                block['transactions'].append(tx)
+
+            store.import_block(block, chain_ids = chain_ids)
+            store.imported_bytes(block['size'])
+            return True
+
+        def get_raw_block(rpc_hash):
+            """
+            Return the block's hex serialization, or None if the
+            daemon does not support getblock with verbose false.
+            """
+            try:
+                ret = rpc("getblock", rpc_hash, False)
+            except util.JsonrpcException, e:
+                store.log.debug("getblock %s false: %s", rpc_hash, e)
+                return None
+            return ret if isinstance(ret, basestring) else None
+
+        def import_raw_block(rpc_hash, rpc_block_hex, height):
+            ds = BCDataStream.BCDataStream()
+            ds.input = rpc_block_hex.decode('hex')
+            ds.read_cursor = 0
+            block = store.parse_block(ds, chain_id)
+            block['hash'] = util.block_hash(block)
+            if block['hash'] != rpc_hash.decode('hex')[::-1]:
+                raise InvalidBlock('block hash mismatch')
+            block['size'] = len(ds.input)
+            block['height'] = height
+            store.import_block(block, chain_ids = chain_ids)
+            store.imported_bytes(block['size'])
+
+        prefetcher = None
         try:
 
             # Get block hash at height, and at the same time, test
@@ -2768,67 +4503,86 @@ store._ddl['txout_approx'],
                 next_hash = hash
                 height -= 1
 
-            # Import new blocks.
-            rpc_hash = next_hash or get_blockhash(height)
+            # Import new blocks, whole if the daemon can serialize
+            # them, otherwise transaction by transaction.
+            raw_block = None
+            if store.rpc_raw_blocks and next_hash is not None:
+                raw_block = get_raw_block(next_hash)
+                if raw_block is None:
+                    store.log.info("RPC service does not return raw blocks")
+            raw_blocks = raw_block is not None
+
+            if store.rpc_prefetch:
+                # Fetch ahead in another thread while importing.  Skip
+                # transactions probably stored already, such as those
+                # imported from the memory pool; import_rpc_block
+                # looks up and if need be fetches them.
+                seen = store._mempool_seen.get(dircfg['id'], frozenset())
+                bloom = store.tx_bloom
+                def known(rpc_tx_hash):
+                    return rpc_tx_hash in seen or (
+                        bloom is not None and
+                        rpc_tx_hash.decode('hex')[::-1] in bloom)
+                prefetcher = RpcPrefetcher(
+                    client, height, store.rpc_batch_size,
+                    store.rpc_prefetch, store.rpclog, raw_blocks, known)
+                prefetcher.start()
+                for height, rpc_hash, rpc_block, raw_txs in prefetcher:
+                    hash = rpc_hash.decode('hex')[::-1]
+                    if store.offer_existing_block(hash, chain_id):
+                        pass
+                    elif raw_blocks:
+                        import_raw_block(rpc_hash, rpc_block, height)
+                    elif not import_rpc_block(rpc_block, height, raw_txs):
+                        return False
+                height = prefetcher.height
+
+            rpc_hash = None if prefetcher is not None else \
+                next_hash or get_blockhash(height)
             while rpc_hash is not None:
                 hash = rpc_hash.decode('hex')[::-1]
 
                 if store.offer_existing_block(hash, chain_id):
                     rpc_hash = get_blockhash(height + 1)
+                elif raw_blocks:
+                    if raw_block is None:
+                        raw_block = rpc("getblock", rpc_hash, False)
+                    import_raw_block(rpc_hash, raw_block, height)
+                    raw_block = None
+                    rpc_hash = get_blockhash(height + 1)
                 else:
                     rpc_block = rpc("getblock", rpc_hash)
                     assert rpc_hash == rpc_block['hash']
-
-                    prev_hash = \
-                        rpc_block['previousblockhash'].decode('hex')[::-1] \
-                        if 'previousblockhash' in rpc_block \
-                        else GENESIS_HASH_PREV
-
-                    block = {
-                        'hash':     hash,
-                        'version':  int(rpc_block['version']),
-                        'hashPrev': prev_hash,
-                        'hashMerkleRoot':
-                            rpc_block['merkleroot'].decode('hex')[::-1],
-                        'nTime':    int(rpc_block['time']),
-                        'nBits':    int(rpc_block['bits'], 16),
-                        'nNonce':   int(rpc_block['nonce']),
-                        'transactions': [],
-                        'size':     int(rpc_block['size']),
-                        'height':   height,
-                        }
-
-                    if util.block_hash(block) != hash:
-                        raise InvalidBlock('block hash mismatch')
-
-                    for rpc_tx_hash in rpc_block['tx']:
-                        tx = store.export_tx(tx_hash = str(rpc_tx_hash),
-                                             format = "binary")
-                        if tx is None:
-                            tx = get_tx(rpc_tx_hash)
-                            if tx is None:
-                                return False
-
-                        block['transactions'].append(tx)
-
-                    store.import_block(block, chain_ids = chain_ids)
-                    store.imported_bytes(block['size'])
+                    if not import_rpc_block(rpc_block, height, {}):
+                        return False
                     rpc_hash = rpc_block.get('nextblockhash')
 
                 height += 1
 
-            # Import the memory pool.
-            for rpc_tx_hash in rpc("getrawmempool"):
+            # Import the memory pool's transactions not seen by the
+            # last catch-up.
+            mempool = rpc("getrawmempool")
+            seen = store._mempool_seen.get(dircfg['id'], ())
+            now = int(time.time())
+            for rpc_tx_hash in mempool:
+                if rpc_tx_hash in seen:
+                    continue
                 tx = get_tx(rpc_tx_hash)
                 if tx is None:
                     return False
 
                 # XXX Race condition in low isolation levels.
-                tx_id = store.tx_find_id_and_value(tx, False)
+                tx_id = store.tx_find_known_id_and_value(tx, False)
                 if tx_id is None:
                     tx_id = store.import_tx(tx, False)
+                    store.sql("""
+                        INSERT INTO mempool_tx (tx_id, first_seen)
+                        VALUES (?, ?)""", (tx_id, now))
                     store.log.info("mempool tx %d", tx_id)
                     store.imported_bytes(tx['size'])
+            store._mempool_seen[dircfg['id']] = set(mempool)
+
+            store.expire_mempool_txs()
 
         except util.JsonrpcMethodNotFound, e:
             store.log.debug("bitcoind %s not supported", e.method)
@@ -2838,8 +4592,79 @@ store._ddl['txout_approx'],
             store.log.debug("RPC data not understood: %s", e)
             return False
 
+        finally:
+            if prefetcher is not None:
+                # Let a request in progress finish before closing.
+                prefetcher.stop()
+                prefetcher.join()
+            client.close()
+
         return True
 
+    def expire_mempool_txs(store):
+        """
+        Stop tracking memory pool transactions found in a block.
+        Delete those first seen over mempool_expiry seconds ago that
+        left the memory pool and whose outputs are unspent in the
+        database.
+        """
+        store.sql("""
+            DELETE FROM mempool_tx
+             WHERE EXISTS (
+                   SELECT 1
+                     FROM block_tx bt
+                    WHERE bt.tx_id = mempool_tx.tx_id)""")
+        if not store.mempool_expiry:
+            return
+
+        live = set()
+        # Datadir workers may add entries meanwhile.
+        for hashes in store._mempool_seen.values():
+            live.update(hashes)
+
+        cutoff = int(time.time()) - store.mempool_expiry
+        deleted = 0
+        while True:
+            # Spenders go first, which frees the transactions they spend.
+            tx_ids = [tx_id for tx_id, tx_hash in store.selectall("""
+                SELECT mt.tx_id, tx.tx_hash
+                  FROM mempool_tx mt
+                  JOIN tx ON (mt.tx_id = tx.tx_id)
+                 WHERE mt.first_seen < ?
+                   AND NOT EXISTS (
+                       SELECT 1
+                         FROM txout
+                         JOIN txin ON (txin.txout_id = txout.txout_id)
+                        WHERE txout.tx_id = mt.tx_id)""", (cutoff,))
+                      if store.hashout_hex(tx_hash) not in live]
+            if not tx_ids:
+                break
+            for tx_id in tx_ids:
+                store._delete_mempool_tx(tx_id)
+            deleted += len(tx_ids)
+
+        if deleted:
+            store.log.info("Expired %d memory pool transactions", deleted)
+            store.commit()
+
+    def _delete_mempool_tx(store, tx_id):
+        if store.txout_cache is not None:
+            for tx_hash, txout_pos in store.selectall("""
+                SELECT tx.tx_hash, txout.txout_pos
+                  FROM tx
+                  JOIN txout ON (tx.tx_id = txout.tx_id)
+                 WHERE tx.tx_id = ?""", (tx_id,)):
+                key = (store.hashout(tx_hash), int(txout_pos))
+                if key in store.txout_cache:
+                    del store.txout_cache[key]
+        store.sql("""
+            DELETE FROM unlinked_txin WHERE txin_id IN (
+                SELECT txin_id FROM txin WHERE tx_id = ?)""", (tx_id,))
+        store.sql("DELETE FROM txin WHERE tx_id = ?", (tx_id,))
+        store.sql("DELETE FROM txout WHERE tx_id = ?", (tx_id,))
+        store.sql("DELETE FROM mempool_tx WHERE tx_id = ?", (tx_id,))
+        store.sql("DELETE FROM tx WHERE tx_id = ?", (tx_id,))
+
     # Load all blocks starting at the current file and offset.
     def catch_up_dir(store, dircfg):
         def open_blkfile(number):
@@ -2941,8 +4766,199 @@ store._ddl['txout_approx'],
 
     # Load all blocks from the given data stream.
     def import_blkdat(store, dircfg, ds, filename="[unknown]"):
+        blocks = store._scan_blkdat(dircfg, ds, filename)
+        blocks = store._skip_known_blocks(blocks, ds)
+        if store.parse_workers:
+            blocks = store._parse_blocks_in_workers(blocks, filename)
+
+        for hash, chain_id, magic, length, end, result in blocks:
+            if not store.offer_existing_block(hash, chain_id):
+                if result is None:
+                    ds.read_cursor = end - length
+                    b = store.parse_block(ds, chain_id, magic, length)
+                    parsed_end = ds.read_cursor
+                else:
+                    b, parsed_end = result.get()
+                b["hash"] = hash
+                chain_ids = frozenset([] if chain_id is None else [chain_id])
+                store.import_block(b, chain_ids = chain_ids)
+                if parsed_end != end:
+                    store.log.debug("Skipped %d bytes at block end",
+                                    end - parsed_end)
+
+            store.bytes_since_commit += length
+            if store.bytes_since_commit >= store.commit_bytes:
+                store.save_blkfile_offset(dircfg, end)
+                store.flush()
+                store._refresh_dircfg(dircfg)
+
+        if ds.read_cursor != dircfg['blkfile_offset']:
+            store.save_blkfile_offset(dircfg, ds.read_cursor)
+        if store.blkindex is not None:
+            store.blkindex.save()
+
+    def _skip_known_blocks(store, blocks, ds):
+        """
+        Pass along the blocks from _scan_blkdat except those already
+        in the database and, where the block has a chain, in that
+        chain.  Check up to IN_LIST_MAX blocks per query.  The caller
+        must position ds before parsing a block.  ds.read_cursor is
+        left where the scan ended.
+        """
+        pending = []
+        for block in blocks:
+            pending.append(block)
+            if len(pending) == IN_LIST_MAX:
+                for block in store._unknown_blocks(pending):
+                    yield block
+                pending = []
+        scan_end = ds.read_cursor
+        for block in store._unknown_blocks(pending):
+            yield block
+        ds.read_cursor = scan_end
+
+    def _unknown_blocks(store, blocks):
+        if not blocks:
+            return []
+        hashes = [block[0] for block in blocks]
+        known = set()
+        for block_hash, chain_id in store.selectall("""
+            SELECT b.block_hash, cc.chain_id
+              FROM block b
+              LEFT JOIN chain_candidate cc ON (cc.block_id = b.block_id)
+             WHERE b.block_hash IN (""" + ", ".join(["?"] * len(hashes)) +
+                                                    ")",
+                                                    map(store.hashin, hashes)):
+            block_hash = store.hashout(block_hash)
+            known.add((block_hash, None))
+            if chain_id is not None:
+                known.add((block_hash, int(chain_id)))
+        return [block for block in blocks
+                if (block[0], block[1]) not in known]
+
+    def repair_gaps(store):
+        """
+        Import the missing ancestors of orphan blocks that
+        blkfile_index can locate in a datadir's block files, oldest
+        first.  Return the number imported.
+        """
+        dircfgs = dict((int(dircfg['id']), dircfg)
+                       for dircfg in store.datadirs)
+        def find(hash):
+            loc = store.blkindex.find(hash)
+            if loc is None or loc[0] not in dircfgs or store.selectrow(
+                "SELECT 1 FROM block WHERE block_hash = ?",
+                (store.hashin(hash),)):
+                return None
+            return loc
+
+        count = 0
+        for (hash_prev,) in store.selectall("""
+            SELECT DISTINCT ob.block_hashPrev
+              FROM orphan_block ob
+             WHERE NOT EXISTS (
+                   SELECT 1
+                     FROM block b
+                    WHERE b.block_hash = ob.block_hashPrev)"""):
+            missing = []
+            hash = store.hashout(hash_prev)
+            loc = find(hash)
+            while loc is not None:
+                missing.append((hash, loc))
+                hash = loc[4]
+                loc = find(hash)
+
+            for hash, loc in reversed(missing):
+                if not store._import_indexed_block(hash, dircfgs[loc[0]],
+                                                   *loc[1:4]):
+                    break
+                count += 1
+        return count
+
+    def _import_indexed_block(store, hash, dircfg, number, offset, length):
+        filename = store.blkfile_name(dircfg, number)
+        f = open(filename, "rb")
+        try:
+            f.seek(offset)
+            data = f.read(8 + length)
+        finally:
+            f.close()
+        if len(data) != 8 + length or \
+                util.double_sha256(data[8:88]) != hash:
+            store.log.warning("Reindexing changed block file %s", filename)
+            store.blkindex.discard(dircfg['id'], number)
+            return False
+
+        magic = data[:4]
+        chain_id = dircfg['chain_id']
+        if chain_id is None:
+            chain_id = store._chain_id_for_magic(magic)
+        ds = BCDataStream.BCDataStream()
+        ds.input = data
+        ds.read_cursor = 8
+        b = store.parse_block(ds, chain_id, magic, length)
+        b["hash"] = hash
+        store.log.info("Repairing gap with block %s from %s",
+                       hash[::-1].encode('hex'), filename)
+        store.import_block(b, chain_ids = frozenset(
+                [] if chain_id is None else [chain_id]))
+        store.commit()
+        return True
+
+    def _chain_id_for_magic(store, magic):
+        rows = store.selectall("""
+            SELECT chain.chain_id
+              FROM chain
+              JOIN magic ON (chain.magic_id = magic.magic_id)
+             WHERE magic.magic = ?""",
+                               (store.binin(magic),))
+        return int(rows[0][0]) if len(rows) == 1 else None
+
+    def _scan_blkdat(store, dircfg, ds, filename):
+        """
+        Generate (hash, chain_id, magic, length, end, None) for each
+        complete block in ds from the saved offset.  ds.read_cursor is
+        at the block's header while the caller has the tuple.
+
+        With blkfile_index, take the blocks that it covers from there
+        and add those read after them.
+        """
         filenum = dircfg['blkfile_number']
-        ds.read_cursor = dircfg['blkfile_offset']
+        first = dircfg['blkfile_offset']
+        ds.read_cursor = first
+        index = store.blkindex
+
+        chain_ids = {}
+        def chain_id_for_magic(magic):
+            if magic not in chain_ids:
+                chain_ids[magic] = store._chain_id_for_magic(magic)
+            return chain_ids[magic]
+
+        if index is not None:
+            if not index.check(dircfg['id'], filenum, ds.input):
+                store.log.warning("Reindexing changed block file %s",
+                                  filename)
+                index.discard(dircfg['id'], filenum)
+
+            for offset, length, hash, prev, magic in index.blocks(
+                    dircfg['id'], filenum, first):
+                chain_id = dircfg['chain_id']
+                if chain_id is None:
+                    chain_id = chain_id_for_magic(magic)
+                end = offset + 8 + length
+                ds.read_cursor = offset + 8
+                yield hash, chain_id, magic, length, end, None
+                ds.read_cursor = end
+                first = end
+                if filenum != dircfg['blkfile_number']:
+                    return
+
+            # Read headers after the indexed part, but yield only
+            # blocks at or after first.  Where the index ends before
+            # first, as when it is new to a loaded database, this
+            # indexes the blocks in between, so that it covers the
+            # file from offset 0 for a later rescan.
+            ds.read_cursor = index.end(dircfg['id'], filenum)
 
         while filenum == dircfg['blkfile_number']:
             if ds.read_cursor + 8 > len(ds.input):
@@ -2972,14 +4988,7 @@ store._ddl['txout_approx'],
             # Assume blocks obey the respective policy if they get here.
             chain_id = dircfg['chain_id']
             if chain_id is None:
-                rows = store.selectall("""
-                    SELECT chain.chain_id
-                      FROM chain
-                      JOIN magic ON (chain.magic_id = magic.magic_id)
-                     WHERE magic.magic = ?""",
-                                       (store.binin(magic),))
-                if len(rows) == 1:
-                    chain_id = rows[0][0]
+                chain_id = chain_id_for_magic(magic)
 
             if chain_id is None:
                 store.log.warning(
@@ -3026,39 +5035,50 @@ store._ddl['txout_approx'],
             # CPU-mined chains that use different proof-of-work
             # algorithms.  Time to resurrect policy_id?
 
-            if not store.offer_existing_block(hash, chain_id):
-                b = store.parse_block(ds, chain_id, magic, length)
-                b["hash"] = hash
-                chain_ids = frozenset([] if chain_id is None else [chain_id])
-                store.import_block(b, chain_ids = chain_ids)
-                if ds.read_cursor != end:
-                    store.log.debug("Skipped %d bytes at block end",
-                                    end - ds.read_cursor)
-
+            if index is not None:
+                index.add(dircfg['id'], filenum, offset, length, hash,
+                          ds.input[ds.read_cursor + 4 : ds.read_cursor + 36],
+                          magic)
+            if offset >= first:
+                yield hash, chain_id, magic, length, end, None
             ds.read_cursor = end
 
-            store.bytes_since_commit += length
-            if store.bytes_since_commit >= store.commit_bytes:
-                store.save_blkfile_offset(dircfg, ds.read_cursor)
-                store.flush()
-                store._refresh_dircfg(dircfg)
+        if index is not None and filenum == dircfg['blkfile_number']:
+            index.set_end(dircfg['id'], filenum, ds.read_cursor)
 
-        if ds.read_cursor != dircfg['blkfile_offset']:
-            store.save_blkfile_offset(dircfg, ds.read_cursor)
+    def _parse_blocks_in_workers(store, blocks, filename):
+        """
+        Pass blocks from _scan_blkdat to the parse-workers processes
+        and generate them in the same order with an AsyncResult in
+        place of None.  The result's value is (block, parsed_end) as
+        from parse_blkfile_block.
+        """
+        pool = store._get_parse_pool()
+
+        pending = collections.deque()
+        for hash, chain_id, magic, length, end, result in blocks:
+            result = pool.apply_async(parse_blkfile_block, (
+                    filename, end - length, length,
+                    chain_id not in store.no_bit8_chain_ids))
+            pending.append((hash, chain_id, magic, length, end, result))
+            if len(pending) > store.parse_workers * PARSE_BLOCKS_PER_WORKER:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def _get_parse_pool(store):
+        if store._parse_pool is None:
+            import multiprocessing
+            store._parse_pool = multiprocessing.Pool(store.parse_workers)
+        return store._parse_pool
 
     def parse_block(store, ds, chain_id=None, magic=None, length=None):
-        d = deserialize.parse_BlockHeader(ds)
-        if d['version'] & (1 << 8):
-            if chain_id in store.no_bit8_chain_ids:
-                store.log.debug(
-                    "Ignored bit8 in version 0x%08x of chain_id %d",
-                    d['version'], chain_id)
-            else:
-                d['auxpow'] = deserialize.parse_AuxPow(ds)
-        d['transactions'] = []
-        nTransactions = ds.read_compact_size()
-        for i in xrange(nTransactions):
-            d['transactions'].append(deserialize.parse_Transaction(ds))
+        allow_auxpow = chain_id not in store.no_bit8_chain_ids
+        d = parse_block(ds, allow_auxpow)
+        if d['version'] & (1 << 8) and not allow_auxpow:
+            store.log.debug(
+                "Ignored bit8 in version 0x%08x of chain_id %d",
+                d['version'], chain_id)
         return d
 
     def parse_tx(store, bytes):
@@ -3151,6 +5171,8 @@ store._ddl['txout_approx'],
                                (dbhash, chain_id, block_height, chain_id))
 
     def get_received(store, chain_id, pubkey_hash, block_height = None):
+        if block_height is None and not store.is_bulk_loading():
+            return store.get_address_balance(chain_id, pubkey_hash)[0]
         return store.get_received_and_last_block_id(
             chain_id, pubkey_hash, block_height)[0]
 
@@ -3183,10 +5205,112 @@ store._ddl['txout_approx'],
                                (dbhash, chain_id, block_height, chain_id))
 
     def get_sent(store, chain_id, pubkey_hash, block_height = None):
+        if block_height is None and not store.is_bulk_loading():
+            return store.get_address_balance(chain_id, pubkey_hash)[1]
         return store.get_sent_and_last_block_id(
             chain_id, pubkey_hash, block_height)[0]
 
+    def get_address_balance(store, chain_id, pubkey_hash):
+        """
+        Return the amounts received and sent by pubkey_hash in the
+        chain's longest branch and its number of outputs there.
+        """
+        row = store.selectrow("""
+            SELECT ab.received, ab.sent, ab.txout_count
+              FROM pubkey
+              JOIN address_balance ab ON (ab.pubkey_id = pubkey.pubkey_id)
+             WHERE pubkey.pubkey_hash = ?
+               AND ab.chain_id = ?""", (store.binin(pubkey_hash), chain_id))
+        return (0, 0, 0) if row is None else tuple(map(int, row))
+
+    def get_pubkey_id(store, dbhash):
+        """Return the pubkey_id of a binin pubkey hash, or None."""
+        row = store.selectrow("""
+            SELECT pubkey_id
+              FROM pubkey
+             WHERE pubkey_hash = ?""", (dbhash,))
+        return None if row is None else int(row[0])
+
+    def get_address_history(store, pubkey_id, after=None, limit=None):
+        """
+        Generate up to limit address_history rows of pubkey_id, in
+        order, that follow the transaction position after=(block_height,
+        tx_pos), as dicts.  A transaction's rows are never split, so
+        the last row's position may serve as the next page's after.
+        Without a limit, rows are fetched as needed.
+        """
+        where = ""
+        params = [pubkey_id]
+        if after is not None:
+            where = """
+               AND (ah.block_height > ? OR
+                    (ah.block_height = ? AND ah.tx_pos > ?))"""
+            params += [after[0], after[0], after[1]]
+        sql = """
+            SELECT ah.chain_id, ah.block_height, ah.tx_pos, ah.is_in,
+                   ah.io_pos, b.block_hash, b.block_nTime, tx.tx_hash,
+                   ah.delta, ah.balance
+              FROM address_history ah
+              JOIN block b ON (b.block_id = ah.block_id)
+              JOIN tx ON (tx.tx_id = ah.tx_id)
+             WHERE ah.pubkey_id = ?"""
+        order = """
+             ORDER BY ah.block_height, ah.tx_pos, ah.chain_id, ah.is_in,
+                   ah.io_pos"""
+        if limit is None:
+            rows = store.selectiter(sql + where + order, params)
+        else:
+            rows = store.selectall(sql + where + order + """
+             LIMIT ?""", params + [limit])
+            if len(rows) == limit:
+                # Finish the last transaction.
+                (chain_id, height, tx_pos, is_in, io_pos) = rows[-1][:5]
+                rows += store.selectall(sql + """
+               AND ah.block_height = ?
+               AND ah.tx_pos = ?
+               AND (ah.chain_id > ? OR
+                    (ah.chain_id = ? AND ah.is_in > ?) OR
+                    (ah.chain_id = ? AND ah.is_in = ? AND ah.io_pos > ?))""" +
+                                        order,
+                                        [pubkey_id, height, tx_pos,
+                                         chain_id, chain_id, is_in,
+                                         chain_id, is_in, io_pos])
+        return ({
+                "chain_id": int(chain_id),
+                "height":   int(height),
+                "tx_pos":   int(tx_pos),
+                "is_in":    int(is_in),
+                "pos":      int(io_pos),
+                "blk_hash": store.hashout_hex(block_hash),
+                "nTime":    int(nTime),
+                "tx_hash":  store.hashout_hex(tx_hash),
+                "value":    int(delta),
+                "balance":  int(balance),
+                }
+                for (chain_id, height, tx_pos, is_in, io_pos, block_hash,
+                     nTime, tx_hash, delta, balance) in rows)
+
+    def get_address_totals(store, pubkey_id):
+        """
+        Return a dict mapping chain_id to (received, sent, txout_count,
+        txin_count) for the chains where pubkey_id has history.
+        """
+        totals = {}
+        for row in store.selectall("""
+            SELECT chain_id, received, sent, txout_count, txin_count
+              FROM address_balance
+             WHERE pubkey_id = ?
+               AND txout_count > 0""", (pubkey_id,)):
+            totals[int(row[0])] = tuple(map(int, row[1:]))
+        return totals
+
     def get_balance(store, chain_id, pubkey_hash):
+        if not store.is_bulk_loading():
+            received, sent, count = store.get_address_balance(
+                chain_id, pubkey_hash)
+            return received - sent
+
+        # finish_bulk_load populates address_balance.
         sent, last_block_id = store.get_sent_and_last_block_id(
             chain_id, pubkey_hash)
         received, last_block_id_2 = store.get_received_and_last_block_id(
@@ -3200,7 +5324,7 @@ store._ddl['txout_approx'],
             store.log.debug("Requerying balance: %d != %d",
                           last_block_id, last_block_id_2)
 
-            received, last_block_id_2 = store.get_received(
+            received, last_block_id_2 = store.get_received_and_last_block_id(
                 chain_id, pubkey_hash, store.get_block_height(last_block_id))
 
             if last_block_id == last_block_id_2:
@@ -3209,7 +5333,7 @@ store._ddl['txout_approx'],
             store.log.info("Balance query affected by reorg? %d != %d",
                            last_block_id, last_block_id_2)
 
-            sent, last_block_id = store.get_sent(
+            sent, last_block_id = store.get_sent_and_last_block_id(
                 chain_id, pubkey_hash, store.get_block_height(last_block_id_2))
 
         if last_block_id != last_block_id_2:
@@ -3414,5 +5538,66 @@ store._ddl['txout_approx'],
                 ret = fb
         return ret
 
+def parse_block(ds, allow_auxpow=True):
+    d = deserialize.parse_BlockHeader(ds)
+    if d['version'] & (1 << 8) and allow_auxpow:
+        d['auxpow'] = deserialize.parse_AuxPow(ds)
+    d['transactions'] = []
+    nTransactions = ds.read_compact_size()
+    for i in xrange(nTransactions):
+        d['transactions'].append(deserialize.parse_Transaction(ds))
+    return d
+
+def copy_text(value):
+    """Format value for PostgreSQL COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (buffer, bytearray)):
+        return "\\\\x" + str(value).encode('hex')
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+# Block file mapped by this parse-workers process.
+_worker_blkfile = {}
+
+def parse_blkfile_block(filename, offset, length, allow_auxpow):
+    """
+    Parse the block at offset in filename, hash its transactions, and
+    check its Merkle root, in a parse-workers process.  Return the
+    block and the offset where parsing ended.
+    """
+    ds = _worker_blkfile.get(filename)
+    if ds is None or offset + length > len(ds.input):
+        for old in _worker_blkfile.values():
+            old.close_file()
+        _worker_blkfile.clear()
+        ds = BCDataStream.BCDataStream()
+        file = open(filename, "rb")
+        try:
+            ds.map_file(file, 0)
+        finally:
+            file.close()
+        _worker_blkfile[filename] = ds
+
+    ds.read_cursor = offset
+    b = parse_block(ds, allow_auxpow)
+    tx_hash_array = []
+    for tx in b['transactions']:
+        tx['hash'] = util.double_sha256(tx['__data__'])
+        tx_hash_array.append(tx['hash'])
+    b['merkle_verified'] = b['hashMerkleRoot'] == util.merkle(tx_hash_array)
+    return b, ds.read_cursor
+
 def new(args): 
     return DataStore(args)
+
+def secondary_args(args):
+    """
+    Return a copy of args for opening another DataStore on the same
+    database without repeating the first one's rescan, upgrade,
+    import-tx, bulk load start, or Bloom filter construction.
+    """
+    conf = args.func_dict.copy()
+    conf.update(rescan=None, upgrade=None, import_tx=[], bulk_load=None,
+                tx_bloom_bytes=None)
+    return readconf.parse_argv([], conf)[0]
@@ -27,10 +27,14 @@ import calendar
 import math
 import logging
 import json
+import types
+import itertools
 
 import version
 import DataStore
 import readconf
+import loader
+import pagecache
 
 # bitcointools -- modified deserialize.py to return raw transaction
 import deserialize
@@ -97,6 +101,10 @@ ADDR_PREFIX_RE = re.compile('[1-9A-HJ-NP-Za-km-z]{6,}\\Z')
 HEIGHT_RE = re.compile('(?:0|[1-9][0-9]*)\\Z')
 HASH_PREFIX_RE = re.compile('[0-9a-fA-F]{0,64}\\Z')
 HASH_PREFIX_MIN = 6
+# Bytes of a streamed page collected before passing them to the server.
+STREAM_CHUNK_BYTES = 16384
+
+HISTORY_CURSOR_RE = re.compile('((?:0|[1-9][0-9]*)):((?:0|[1-9][0-9]*))\\Z')
 
 NETHASH_HEADER = """\
 blockNumber:          height of last block in interval + 1
@@ -153,10 +161,15 @@ MAX_UNSPENT_ADDRESSES = 200
 
 def make_store(args):
     store = DataStore.new(args)
-    if (not args.no_load):
+    if (not args.no_load) and not background_load(args):
         store.catch_up()
     return store
 
+def background_load(args):
+    """True if a Loader thread, not page requests, loads blocks."""
+    return args.load_interval is not None and not args.no_serve \
+        and not args.no_load
+
 class NoSuchChainError(Exception):
     """Thrown when a chain lookup fails"""
 
@@ -171,9 +184,10 @@ class Streamed(Exception):
     returned by start_response."""
 
 class Abe:
-    def __init__(abe, store, args):
+    def __init__(abe, store, args, loader=None):
         abe.store = store
         abe.args = args
+        abe.loader = loader
         abe.htdocs = args.document_root or find_htdocs()
         abe.static_path = '' if args.static_path is None else args.static_path
         abe.template_vars = args.template_vars.copy()
@@ -190,6 +204,16 @@ class Abe:
         abe.base_url = args.base_url
         abe.address_history_rows_max = int(
             args.address_history_rows_max or 1000)
+        abe.address_history_page_size = int(
+            args.address_history_page_size or 100)
+        abe.page_cache_depth = int(args.page_cache_depth or 100)
+
+        abe.page_cache = None
+        if args.page_cache_bytes is not None:
+            abe.page_cache = pagecache.PageCache(int(args.page_cache_bytes))
+            store.reorg_listeners.append(abe.page_cache.invalidate)
+            if loader is not None:
+                loader.reorg_listeners.append(abe.page_cache.invalidate)
 
         if args.shortlink_type is None:
             abe.shortlink_type = ("firstbits" if store.use_firstbits else
@@ -229,6 +253,16 @@ class Abe:
             abe.log.debug("fixed path_info")
             return redirect(page)
 
+        if abe.page_cache is not None:
+            cache_key = wsgiref.util.request_uri(env)
+            cache_serial = abe.page_cache.serial
+            cached = abe.page_cache.get(cache_key)
+            if cached is not None:
+                content_type, content = cached
+                start_response(status, [('Content-type', content_type),
+                                        ('Cache-Control', 'max-age=30')])
+                return content
+
         cmd = wsgiref.util.shift_path_info(env)
         handler = abe.get_handler(cmd)
 
@@ -236,10 +270,9 @@ class Abe:
             if handler is None:
                 return abe.serve_static(cmd + env['PATH_INFO'], start_response)
 
-            if (not abe.args.no_load):
+            if not abe.args.no_load and abe.loader is None:
                 # Always be up-to-date, even if we means having to wait
-                # for a response!  XXX Could use threads, timers, or a
-                # cron job.
+                # for a response!  Use load-interval to avoid the wait.
                 abe.store.catch_up()
 
             tvars = abe.template_vars.copy()
@@ -264,23 +297,130 @@ class Abe:
             abe.store.rollback()
             raise
 
-        abe.store.rollback()  # Close imlicitly opened transaction.
-
-        start_response(status, [('Content-type', page['content_type']),
-                                ('Cache-Control', 'max-age=30')])
+        # A body containing generators reads the database as it is
+        # sent, so its transaction ends in stream_page.
+        streamed = is_streamed(page['body'])
+        cacheable = (abe.page_cache is not None and status == '200 OK' and
+                     not streamed and 'immutable' in page and
+                     abe.is_buried(page['immutable']))
+        if not streamed:
+            abe.store.rollback()  # Close imlicitly opened transaction.
 
         tvars['title'] = flatten(page['title'])
         tvars['h1'] = flatten(page.get('h1') or page['title'])
-        tvars['body'] = flatten(page['body'])
         if abe.args.auto_agpl:
             tvars['download'] = (
                 ' <a href="' + page['dotdot'] + 'download">Source</a>')
 
+        if streamed:
+            # An error in the first chunk may still change the status.
+            chunks = abe.stream_page(page, tvars)
+            first = next(chunks, '')
+            start_response(status, [('Content-type', page['content_type']),
+                                    ('Cache-Control', 'max-age=30')])
+            return itertools.chain([first], chunks)
+
+        start_response(status, [('Content-type', page['content_type']),
+                                ('Cache-Control', 'max-age=30')])
+
+        tvars['body'] = flatten(page['body'])
         content = page['template'] % tvars
         if isinstance(content, unicode):
             content = content.encode('UTF-8')
+        if cacheable:
+            abe.page_cache.put(cache_key, (page['content_type'], content),
+                               len(content), page['immutable'], cache_serial)
         return content
 
+    def stream_page(abe, page, tvars):
+        """
+        Generate the page in chunks of about STREAM_CHUNK_BYTES, sending
+        the template around the body as the body's generators run.
+        Errors after the first chunk, when the status has gone out, are
+        logged and end the page early.
+        """
+        sent = False
+        try:
+            head, sep, tail = page['template'].partition('%(body)s')
+            if sep:
+                parts = [head % tvars, page['body'], tail % tvars]
+            else:
+                tvars['body'] = flatten(page['body'])
+                parts = [page['template'] % tvars]
+            buf = []
+            size = 0
+            for s in iter_flatten(parts):
+                if isinstance(s, unicode):
+                    s = s.encode('UTF-8')
+                buf.append(s)
+                size += len(s)
+                if size >= STREAM_CHUNK_BYTES:
+                    yield ''.join(buf)
+                    sent = True
+                    buf = []
+                    size = 0
+            if buf:
+                yield ''.join(buf)
+        except Exception:
+            if not sent:
+                raise
+            abe.log.exception("Truncated %s after an error",
+                              wsgiref.util.request_uri(page['env']))
+        finally:
+            abe.store.rollback()
+
+    def mark_immutable(abe, page, chain_id, height):
+        """
+        Let the page be cached once the block at height on chain_id's
+        longest branch has page_cache_depth confirmations.  A height
+        of None keeps the page out of the cache.
+        """
+        if abe.page_cache is not None:
+            page.setdefault('immutable', []).append((chain_id, height))
+
+    def mark_tx_immutable(abe, page, tx_id, spent):
+        """
+        Mark the page as showing the transaction's blocks and, if
+        spent is true, the blocks that spend each of its outputs.
+        Transactions outside the longest branch are not cached.
+        """
+        if abe.page_cache is None:
+            return
+        rows = abe.store.selectall("""
+            SELECT cc.chain_id, cc.block_height
+              FROM block_tx bt
+              JOIN chain_candidate cc ON (cc.block_id = bt.block_id)
+             WHERE bt.tx_id = ?
+               AND cc.in_longest = 1""", (tx_id,))
+        if not rows:
+            return
+        if spent:
+            rows += abe.store.selectall("""
+                SELECT cc.chain_id, cc.block_height
+                  FROM txout
+                  LEFT JOIN txin ON (txin.txout_id = txout.txout_id)
+                  LEFT JOIN block_tx bt ON (bt.tx_id = txin.tx_id)
+                  LEFT JOIN chain_candidate cc
+                         ON (cc.block_id = bt.block_id AND cc.in_longest = 1)
+                 WHERE txout.tx_id = ?""", (tx_id,))
+        for chain_id, height in rows:
+            abe.mark_immutable(page, chain_id, height)
+
+    def is_buried(abe, immutable):
+        # Read the loader's tips instead of the database.  They trail
+        # it by at most one catch-up.
+        tips = {}
+        if abe.loader is not None:
+            tips = abe.loader.tips.copy()
+        for chain_id, height in immutable:
+            if height is None:
+                return False
+            if chain_id not in tips:
+                tips[chain_id] = abe.store.get_block_number(chain_id)
+            if tips[chain_id] - int(height) + 1 < abe.page_cache_depth:
+                return False
+        return True
+
     def get_handler(abe, cmd):
         return getattr(abe, 'handle_' + cmd, None)
 
@@ -578,6 +718,8 @@ class Abe:
             None if row[16] is None else int(row[16]),
             int(row[17]),
             )
+        if chain is not None:
+            abe.mark_immutable(page, chain['id'], height)
 
         next_list = abe.store.selectall("""
             SELECT DISTINCT n.block_hash, cc.in_longest
@@ -956,6 +1098,9 @@ class Abe:
 
         body += ['</table>\n']
 
+        # Outputs may yet be spent, so wait for that.
+        abe.mark_tx_immutable(page, tx_id, True)
+
     def handle_rawtx(abe, page):
         abe.do_raw(page, abe.do_rawtx)
 
@@ -965,9 +1110,10 @@ class Abe:
                 or not is_hash_prefix(tx_hash):
             return 'ERROR: Not in correct format'  # BBE compatible
 
-        tx = abe.store.export_tx(tx_hash=tx_hash.lower())
+        tx_id, tx = abe.store.export_tx_with_id(tx_hash=tx_hash.lower())
         if tx is None:
             return 'ERROR: Transaction does not exist.'  # BBE compatible
+        abe.mark_tx_immutable(page, tx_id, False)
         return json.dumps(tx, sort_keys=True, indent=2)
 
     def handle_address(abe, page):
@@ -983,112 +1129,40 @@ class Abe:
             return
 
         dbhash = abe.store.binin(binaddr)
+        if abe.store.is_bulk_loading():
+            body += ['<p>Address history is unavailable during a bulk'
+                     ' load.</p>']
+            return
 
+        after = abe.history_cursor(page)
+        pubkey_id = abe.store.get_pubkey_id(dbhash)
+        totals = {} if pubkey_id is None else \
+            abe.store.get_address_totals(pubkey_id)
+        if not totals:
+            body += ['<p>Address not seen on the network.</p>']
+            return
+
+        chain_ids = sorted(totals)
         chains = {}
         balance = {}
         received = {}
         sent = {}
         count = [0, 0]
-        chain_ids = []
-        def adj_balance(txpoint):
-            chain_id = txpoint['chain_id']
-            value = txpoint['value']
-            if chain_id not in balance:
-                chain_ids.append(chain_id)
-                chains[chain_id] = abe.chain_lookup_by_id(chain_id)
-                balance[chain_id] = 0
-                received[chain_id] = 0
-                sent[chain_id] = 0
-            balance[chain_id] += value
-            if value > 0:
-                received[chain_id] += value
-            else:
-                sent[chain_id] -= value
-            count[txpoint['is_in']] += 1
-
-        txpoints = []
-        max_rows = abe.address_history_rows_max
-        in_rows = abe.store.selectall("""
-            SELECT
-                b.block_nTime,
-                cc.chain_id,
-                b.block_height,
-                1,
-                b.block_hash,
-                tx.tx_hash,
-                txin.txin_pos,
-                -prevout.txout_value
-              FROM chain_candidate cc
-              JOIN block b ON (b.block_id = cc.block_id)
-              JOIN block_tx ON (block_tx.block_id = b.block_id)
-              JOIN tx ON (tx.tx_id = block_tx.tx_id)
-              JOIN txin ON (txin.tx_id = tx.tx_id)
-              JOIN txout prevout ON (txin.txout_id = prevout.txout_id)
-              JOIN pubkey ON (pubkey.pubkey_id = prevout.pubkey_id)
-             WHERE pubkey.pubkey_hash = ?
-               AND cc.in_longest = 1""" + ("" if max_rows < 0 else """
-             LIMIT ?"""),
-                      (dbhash,)
-                      if max_rows < 0 else
-                      (dbhash, max_rows + 1))
-
-        too_many = False
-        if max_rows >= 0 and len(in_rows) > max_rows:
-            too_many = True
-
-        if not too_many:
-            out_rows = abe.store.selectall("""
-                SELECT
-                    b.block_nTime,
-                    cc.chain_id,
-                    b.block_height,
-                    0,
-                    b.block_hash,
-                    tx.tx_hash,
-                    txout.txout_pos,
-                    txout.txout_value
-                  FROM chain_candidate cc
-                  JOIN block b ON (b.block_id = cc.block_id)
-                  JOIN block_tx ON (block_tx.block_id = b.block_id)
-                  JOIN tx ON (tx.tx_id = block_tx.tx_id)
-                  JOIN txout ON (txout.tx_id = tx.tx_id)
-                  JOIN pubkey ON (pubkey.pubkey_id = txout.pubkey_id)
-                 WHERE pubkey.pubkey_hash = ?
-                   AND cc.in_longest = 1""" + ("" if max_rows < 0 else """
-                 LIMIT ?"""),
-                          (dbhash, max_rows + 1)
-                          if max_rows >= 0 else
-                          (dbhash,))
-            if max_rows >= 0 and len(out_rows) > max_rows:
-                too_many = True
-
-        if too_many:
-            body += ["<p>I'm sorry, this address has too many records"
-                     " to display.</p>"]
-            return
-
-        rows = []
-        rows += in_rows
-        rows += out_rows
-        rows.sort()
-        for row in rows:
-            nTime, chain_id, height, is_in, blk_hash, tx_hash, pos, value = row
-            txpoint = {
-                    "nTime":    int(nTime),
-                    "chain_id": int(chain_id),
-                    "height":   int(height),
-                    "is_in":    int(is_in),
-                    "blk_hash": abe.store.hashout_hex(blk_hash),
-                    "tx_hash":  abe.store.hashout_hex(tx_hash),
-                    "pos":      int(pos),
-                    "value":    int(value),
-                    }
-            adj_balance(txpoint)
-            txpoints.append(txpoint)
-
-        if (not chain_ids):
-            body += ['<p>Address not seen on the network.</p>']
-            return
+        for chain_id in chain_ids:
+            chains[chain_id] = abe.chain_lookup_by_id(chain_id)
+            received[chain_id], sent[chain_id], txouts, txins = \
+                totals[chain_id]
+            balance[chain_id] = received[chain_id] - sent[chain_id]
+            count[0] += txouts
+            count[1] += txins
+
+        page_size = abe.address_history_page_size
+        if page_size < 0:
+            # Stream the whole history.
+            txpoints = abe.store.get_address_history(pubkey_id, after)
+        else:
+            txpoints = list(abe.store.get_address_history(
+                    pubkey_id, after, page_size))
 
         def format_amounts(amounts, link):
             ret = []
@@ -1121,9 +1195,6 @@ class Abe:
 
         body += ['<p>Balance: '] + format_amounts(balance, True)
 
-        for chain_id in chain_ids:
-            balance[chain_id] = 0  # Reset for history traversal.
-
         body += ['<br />\n',
                  'Transactions in: ', count[0], '<br />\n',
                  'Received: ', format_amounts(received, False), '<br />\n',
@@ -1136,24 +1207,45 @@ class Abe:
                  '<th>Approx. Time</th><th>Amount</th><th>Balance</th>'
                  '<th>Currency</th></tr>\n']
 
-        for elt in txpoints:
-            chain = chains[elt['chain_id']]
-            balance[elt['chain_id']] += elt['value']
-            body += ['<tr><td><a href="../tx/', elt['tx_hash'],
-                     '#', 'i' if elt['is_in'] else 'o', elt['pos'],
-                     '">', elt['tx_hash'][:10], '...</a>',
-                     '</td><td><a href="../block/', elt['blk_hash'],
-                     '">', elt['height'], '</a></td><td>',
-                     format_time(elt['nTime']), '</td><td>']
-            if elt['value'] < 0:
-                body += ['(', format_satoshis(-elt['value'], chain), ')']
-            else:
-                body += [format_satoshis(elt['value'], chain)]
-            body += ['</td><td>',
-                     format_satoshis(balance[elt['chain_id']], chain),
-                     '</td><td>', escape(chain['code3']),
-                     '</td></tr>\n']
-        body += ['</table>\n']
+        def rows():
+            for elt in txpoints:
+                chain = chains[elt['chain_id']]
+                row = ['<tr><td><a href="../tx/', elt['tx_hash'],
+                       '#', 'i' if elt['is_in'] else 'o', elt['pos'],
+                       '">', elt['tx_hash'][:10], '...</a>',
+                       '</td><td><a href="../block/', elt['blk_hash'],
+                       '">', elt['height'], '</a></td><td>',
+                       format_time(elt['nTime']), '</td><td>']
+                if elt['value'] < 0:
+                    row += ['(', format_satoshis(-elt['value'], chain), ')']
+                else:
+                    row += [format_satoshis(elt['value'], chain)]
+                row += ['</td><td>',
+                        format_satoshis(elt['balance'], chain),
+                        '</td><td>', escape(chain['code3']),
+                        '</td></tr>\n']
+                yield row
+        body += [rows(), '</table>\n']
+
+        nav = []
+        if after is not None:
+            nav += ['<a href="', escape(address), '">First</a>']
+        if page_size >= 0 and len(txpoints) >= page_size:
+            if nav:
+                nav += [' ']
+            nav += ['<a href="', escape(address), '?after=',
+                    txpoints[-1]['height'], ':', txpoints[-1]['tx_pos'],
+                    '">Next</a>']
+        if nav:
+            body += ['<p>'] + nav + ['</p>\n']
+
+    def history_cursor(abe, page):
+        """
+        Return the transaction position HEIGHT:TX_POS from the "after"
+        query parameter as a pair, or None if absent or malformed.
+        """
+        m = HISTORY_CURSOR_RE.match(page['params'].get('after', [''])[0])
+        return None if m is None else (int(m.group(1)), int(m.group(2)))
 
     def search_form(abe, page):
         q = (page['params'].get('q') or [''])[0]
@@ -1407,12 +1499,7 @@ class Abe:
             return 'Number of addresses must be between 1 and ' + \
                 str(MAX_UNSPENT_ADDRESSES)
 
-        if chain:
-            chain_id = chain['id']
-            bind = [chain_id]
-        else:
-            chain_id = None
-            bind = []
+        chain_id = chain['id'] if chain else None
 
         hashes = []
         good_addrs = []
@@ -1424,87 +1511,138 @@ class Abe:
             except:
                 pass
         addrs = good_addrs
-        bind += hashes
+        bind = hashes[:]
 
         if len(hashes) == 0:  # Address(es) are invalid.
             return 'Error getting unspent outputs'  # blockchain.info compatible
 
+        if abe.store.is_bulk_loading():
+            return 'ERROR: please try again'
+
         placeholders = "?" + (",?" * (len(hashes)-1))
 
+        if chain_id is not None:
+            bind += [chain_id]
         max_rows = abe.address_history_rows_max
         if max_rows >= 0:
             bind += [max_rows + 1]
 
-        spent = set()
-        for txout_id, spent_chain_id in abe.store.selectall("""
-            SELECT txin.txout_id, cc.chain_id
-              FROM chain_candidate cc
-              JOIN block_tx ON (block_tx.block_id = cc.block_id)
-              JOIN txin ON (txin.tx_id = block_tx.tx_id)
-              JOIN txout prevout ON (txin.txout_id = prevout.txout_id)
-              JOIN pubkey ON (pubkey.pubkey_id = prevout.pubkey_id)
-             WHERE cc.in_longest = 1""" + ("" if chain_id is None else """
-               AND cc.chain_id = ?""") + """
-               AND pubkey.pubkey_hash IN (""" + placeholders + """)""" + (
-                "" if max_rows < 0 else """
-             LIMIT ?"""), bind):
-            spent.add((int(txout_id), int(spent_chain_id)))
-
-        abe.log.debug('spent: %s', spent)
-
-        received_rows = abe.store.selectall("""
+        select = abe.store.selectall if max_rows >= 0 else \
+            abe.store.selectiter
+        rows = iter(select("""
             SELECT
-                txout.txout_id,
-                cc.chain_id,
                 tx.tx_hash,
                 txout.txout_pos,
                 txout.txout_scriptPubKey,
                 txout.txout_value,
-                cc.block_height
-              FROM chain_candidate cc
-              JOIN block_tx ON (block_tx.block_id = cc.block_id)
-              JOIN tx ON (tx.tx_id = block_tx.tx_id)
-              JOIN txout ON (txout.tx_id = tx.tx_id)
-              JOIN pubkey ON (pubkey.pubkey_id = txout.pubkey_id)
-             WHERE cc.in_longest = 1""" + ("" if chain_id is None else """
-               AND cc.chain_id = ?""") + """
-               AND pubkey.pubkey_hash IN (""" + placeholders + """)""" + (
+                u.block_height
+              FROM unspent_txout u
+              JOIN pubkey ON (pubkey.pubkey_id = u.pubkey_id)
+              JOIN txout ON (txout.txout_id = u.txout_id)
+              JOIN tx ON (tx.tx_id = txout.tx_id)""" + (
                 "" if max_rows < 0 else """
-             ORDER BY cc.block_height,
+              JOIN chain_candidate cc ON (cc.chain_id = u.chain_id AND
+                                          cc.block_height = u.block_height AND
+                                          cc.in_longest = 1)
+              JOIN block_tx ON (block_tx.block_id = cc.block_id AND
+                                block_tx.tx_id = txout.tx_id)""") + """
+             WHERE pubkey.pubkey_hash IN (""" + placeholders + """)""" + (
+                "" if chain_id is None else """
+               AND u.chain_id = ?""") + (
+                "" if max_rows < 0 else """
+             ORDER BY u.block_height,
                    block_tx.tx_pos,
                    txout.txout_pos
-             LIMIT ?"""), bind)
-
-        if max_rows >= 0 and len(received_rows) > max_rows:
-            return "ERROR: too many records to process"
+             LIMIT ?"""), bind))
 
-        rows = []
-        for row in received_rows:
-            key = (int(row[0]), int(row[1]))
-            if key in spent:
-                continue
-            rows.append(row[2:])
+        if max_rows >= 0:
+            rows = list(rows)
+            if len(rows) > max_rows:
+                return "ERROR: too many records to process"
+            rows = iter(rows)
 
-        if len(rows) == 0:
+        first = next(rows, None)
+        if first is None:
             return 'No free outputs to spend [' + '|'.join(addrs) + ']'
 
-        out = []
-        for row in rows:
-            tx_hash, out_pos, script, value, height = row
-            tx_hash = abe.store.hashout_hex(tx_hash)
-            out_pos = None if out_pos is None else int(out_pos)
-            script = abe.store.binout_hex(script)
-            value = None if value is None else int(value)
-            height = None if height is None else int(height)
-            out.append({
+        def outputs():
+            for row in itertools.chain([first], rows):
+                tx_hash, out_pos, script, value, height = row
+                tx_hash = abe.store.hashout_hex(tx_hash)
+                out_pos = None if out_pos is None else int(out_pos)
+                script = abe.store.binout_hex(script)
+                value = None if value is None else int(value)
+                height = None if height is None else int(height)
+                yield {
                     'tx_hash': tx_hash,
                     'tx_output_n': out_pos,
                     'script': script,
                     'value': value,
                     'value_hex': None if value is None else "%x" % value,
-                    'block_number': height})
+                    'block_number': height}
+
+        return ['{\n  "unspent_outputs": ', json_array(outputs(), 1), '\n}']
+
+    def handle_addresshistory(abe, page):
+        abe.do_raw(page, abe.do_addresshistory)
+
+    def do_addresshistory(abe, page, chain):
+        """
+        JSON history of /addresshistory/ADDRESS, a page at a time.
+        Query parameter after=HEIGHT:TX_POS continues from a previous
+        page's "next" value, and limit sets the page size.
+        """
+        address = wsgiref.util.shift_path_info(page['env'])
+        if address is None or not util.possible_address(address):
+            return 'ERROR: address invalid'
+        if abe.store.is_bulk_loading():
+            return 'ERROR: please try again'
+
+        page_size = abe.address_history_page_size
+        limit = page['params'].get('limit', [''])[0]
+        if HEIGHT_RE.match(limit) and int(limit) > 0:
+            limit = int(limit)
+            if page_size >= 0:
+                limit = min(limit, page_size)
+        else:
+            limit = None if page_size < 0 else page_size
 
-        return json.dumps({ 'unspent_outputs': out }, sort_keys=True, indent=2)
+        version, binaddr = util.decode_address(address)
+        pubkey_id = abe.store.get_pubkey_id(abe.store.binin(binaddr))
+        txpoints = [] if pubkey_id is None else \
+            abe.store.get_address_history(
+                pubkey_id, abe.history_cursor(page), limit)
+
+        chains = {}
+        count = [0]
+        last = [None]
+        def history():
+            for elt in txpoints:
+                count[0] += 1
+                last[0] = elt
+                chain_id = elt['chain_id']
+                if chain_id not in chains:
+                    chains[chain_id] = abe.chain_lookup_by_id(chain_id)
+                yield {
+                    'chain': chains[chain_id]['name'],
+                    'block_number': elt['height'],
+                    'block_hash': elt['blk_hash'],
+                    'time': elt['nTime'],
+                    'tx_hash': elt['tx_hash'],
+                    'tx_pos': elt['tx_pos'],
+                    'is_input': elt['is_in'],
+                    'pos': elt['pos'],
+                    'value': elt['value'],
+                    'balance': elt['balance']}
+
+        def cursor():
+            # Runs after history() has generated every row.
+            more = limit is not None and count[0] >= limit
+            yield ', \n  "next": %s\n}' % json.dumps(
+                "%d:%d" % (last[0]['height'], last[0]['tx_pos'])
+                if more else None)
+
+        return ['{\n  "history": ', json_array(history(), 1), cursor()]
 
     def do_raw(abe, page, func):
         page['content_type'] = 'text/plain'
@@ -1715,7 +1853,10 @@ class Abe:
         if stop is not None:
             stop_ix = (stop - start) / interval
 
-        rows = abe.store.selectall("""
+        if fmt not in ("csv", "json", "jsonp", "svg"):
+            return "ERROR: unknown format: " + fmt
+
+        rows = abe.store.selectiter("""
             SELECT b.block_height,
                    b.block_nTime,
                    b.block_chain_work,
@@ -1734,73 +1875,68 @@ class Abe:
                                    (interval, start, chain['id'])
                                    if stop is None else
                                    (interval, start, chain['id'], stop_ix))
-        if fmt == "csv":
-            ret = NETHASH_HEADER
-
-        elif fmt in ("json", "jsonp"):
-            ret = []
-
-        elif fmt == "svg":
-            page['template'] = NETHASH_SVG_TEMPLATE
-            ret = ""
-
-        else:
-            return "ERROR: unknown format: " + fmt
 
-        prev_nTime, prev_chain_work = 0, -1
+        def lines():
+            prev_nTime, prev_chain_work = 0, -1
+            first = True
+            sep = ""
 
-        for row in rows:
-            height, nTime, chain_work, nBits = row
-            nTime            = float(nTime)
-            nBits            = int(nBits)
-            target           = util.calculate_target(nBits)
-            difficulty       = util.target_to_difficulty(target)
-            work             = util.target_to_work(target)
-            chain_work       = abe.store.binout_int(chain_work) - work
-
-            if row is not rows[0] or fmt == "svg":
-                height           = int(height)
-                interval_work    = chain_work - prev_chain_work
-                avg_target       = util.work_to_target(
-                    interval_work / float(interval))
-                #if avg_target == target - 1:
-                #    avg_target = target
-                interval_seconds = nTime - prev_nTime
-                if interval_seconds <= 0:
-                    nethash = 'Infinity'
-                else:
-                    nethash = "%.0f" % (interval_work / interval_seconds,)
+            for row in rows:
+                height, nTime, chain_work, nBits = row
+                nTime            = float(nTime)
+                nBits            = int(nBits)
+                target           = util.calculate_target(nBits)
+                difficulty       = util.target_to_difficulty(target)
+                work             = util.target_to_work(target)
+                chain_work       = abe.store.binout_int(chain_work) - work
+
+                if not first or fmt == "svg":
+                    height           = int(height)
+                    interval_work    = chain_work - prev_chain_work
+                    avg_target       = util.work_to_target(
+                        interval_work / float(interval))
+                    #if avg_target == target - 1:
+                    #    avg_target = target
+                    interval_seconds = nTime - prev_nTime
+                    if interval_seconds <= 0:
+                        nethash = 'Infinity'
+                    else:
+                        nethash = "%.0f" % (interval_work / interval_seconds,)
 
-                if fmt == "csv":
-                    ret += "%d,%d,%d,%d,%.3f,%d,%.0f,%s\n" % (
-                        height, nTime, target, avg_target, difficulty, work,
-                        interval_seconds / interval, nethash)
+                    if fmt == "csv":
+                        yield "%d,%d,%d,%d,%.3f,%d,%.0f,%s\n" % (
+                            height, nTime, target, avg_target, difficulty,
+                            work, interval_seconds / interval, nethash)
 
-                elif fmt in ("json", "jsonp"):
-                    ret.append([
-                            height, int(nTime), target, avg_target,
-                            difficulty, work, chain_work])
+                    elif fmt in ("json", "jsonp"):
+                        yield sep + json.dumps([
+                                height, int(nTime), target, avg_target,
+                                difficulty, work, chain_work])
+                        sep = ", "
 
-                elif fmt == "svg":
-                    ret += '<abe:nethash t="%d" d="%.3f"' \
-                        ' w="%d"/>\n' % (nTime, difficulty, interval_work)
+                    elif fmt == "svg":
+                        yield '<abe:nethash t="%d" d="%.3f"' \
+                            ' w="%d"/>\n' % (nTime, difficulty, interval_work)
 
-            prev_nTime, prev_chain_work = nTime, chain_work
+                first = False
+                prev_nTime, prev_chain_work = nTime, chain_work
 
+        # Output streams row by row, so set the page type first.
         if fmt == "csv":
-            return ret
+            return [NETHASH_HEADER, lines()]
 
         elif fmt == "json":
             page['content_type'] = 'application/json'
-            return json.dumps(ret)
+            return ["[", lines(), "]"]
 
         elif fmt == "jsonp":
             page['content_type'] = 'application/javascript'
-            return (jsonp or "jsonp") + "(" + json.dumps(ret) + ")"
+            return [(jsonp or "jsonp") + "([", lines(), "])"]
 
         elif fmt == "svg":
+            page['template'] = NETHASH_SVG_TEMPLATE
             page['content_type'] = 'image/svg+xml'
-            return ret
+            return lines()
 
     def q_totalbc(abe, page, chain):
         """shows the amount of currency ever mined."""
@@ -2089,7 +2225,7 @@ def is_hash_prefix(s):
     return HASH_PREFIX_RE.match(s) and len(s) >= HASH_PREFIX_MIN
 
 def flatten(l):
-    if isinstance(l, list):
+    if isinstance(l, (list, types.GeneratorType)):
         return ''.join(map(flatten, l))
     if l is None:
         raise Exception('NoneType in HTML conversion')
@@ -2097,6 +2233,38 @@ def flatten(l):
         return l
     return str(l)
 
+def iter_flatten(l):
+    """Generate the strings that make up flatten(l)."""
+    if isinstance(l, (list, types.GeneratorType)):
+        for elt in l:
+            for s in iter_flatten(elt):
+                yield s
+    else:
+        yield flatten(l)
+
+def is_streamed(l):
+    """Return true if flattening l would run a generator."""
+    if isinstance(l, types.GeneratorType):
+        return True
+    if isinstance(l, list):
+        for elt in l:
+            if is_streamed(elt):
+                return True
+    return False
+
+def json_array(items, depth):
+    """
+    Generate a JSON array of items nested depth levels deep as
+    json.dumps(..., sort_keys=True, indent=2) would.
+    """
+    pad = "  " * (depth + 1)
+    sep = "[\n"
+    for item in items:
+        yield sep + pad + json.dumps(item, sort_keys=True, indent=2).replace(
+            "\n", "\n" + pad)
+        sep = ", \n"
+    yield "[]" if sep == "[\n" else "\n" + "  " * depth + "]"
+
 def redirect(page):
     uri = wsgiref.util.request_uri(page['env'])
     page['start_response'](
@@ -2109,7 +2277,17 @@ def redirect(page):
 
 def serve(store):
     args = store.args
-    abe = Abe(store, args)
+    bg_loader = None
+    if background_load(args):
+        bg_loader = loader.Loader(args, float(args.load_interval),
+                                  store.tx_bloom)
+        bg_loader.start()
+        if args.notify_address:
+            loader.NotifyListener(bg_loader, args.notify_address).start()
+        if args.watch_blkfiles:
+            loader.BlkfileWatcher(bg_loader,
+                                  float(args.watch_blkfiles)).start()
+    abe = Abe(store, args, bg_loader)
     if args.host or args.port:
         # HTTP server.
         if args.host is None:
@@ -2174,7 +2352,13 @@ def main(argv):
         "base_url":                 None,
         "logging":                  None,
         "address_history_rows_max": None,
+        "address_history_page_size": None,
+        "page_cache_bytes":         None,
+        "page_cache_depth":         None,
         "shortlink_type":           None,
+        "load_interval":            None,
+        "notify_address":           None,
+        "watch_blkfiles":           None,
 
         "template":     DEFAULT_TEMPLATE,
         "template_vars": {
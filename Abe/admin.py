@@ -52,6 +52,11 @@ def link_txin(store):
     log_rowcount(store, "Deleted %d unlinked_txin.")
     commit(store)
 
+    # Newly linked inputs may spend from addresses in a chain.
+    store.rebuild_address_balance()
+    store.rebuild_address_history()
+    store.rebuild_unspent_txout()
+
 def delete_tx(store, id_or_hash):
     try:
         tx_id = int(id_or_hash)
@@ -70,9 +75,18 @@ def delete_tx(store, id_or_hash):
     store.sql("DELETE FROM txin WHERE tx_id = ?", (tx_id,))
     log_rowcount(store, "Deleted %d from txin.")
 
+    store.sql("""
+        DELETE FROM unspent_txout WHERE txout_id IN (
+            SELECT txout_id FROM txout WHERE tx_id = ?)""",
+              (tx_id,))
+    log_rowcount(store, "Deleted %d from unspent_txout.")
+
     store.sql("DELETE FROM txout WHERE tx_id = ?", (tx_id,))
     log_rowcount(store, "Deleted %d from txout.")
 
+    store.sql("DELETE FROM mempool_tx WHERE tx_id = ?", (tx_id,))
+    log_rowcount(store, "Deleted %d from mempool_tx.")
+
     store.sql("DELETE FROM tx WHERE tx_id = ?", (tx_id,))
     log_rowcount(store, "Deleted %d from tx.")
 
@@ -138,6 +152,14 @@ def del_chain_blocks_1(store, name, chain_id):
     log_rowcount(store, "Deleted %d from block_txin.")
     commit(store)
 
+    store.sql("DELETE FROM address_balance WHERE chain_id = ?", (chain_id,))
+    log_rowcount(store, "Deleted %d from address_balance.")
+    store.sql("DELETE FROM address_history WHERE chain_id = ?", (chain_id,))
+    log_rowcount(store, "Deleted %d from address_history.")
+    store.sql("DELETE FROM unspent_txout WHERE chain_id = ?", (chain_id,))
+    log_rowcount(store, "Deleted %d from unspent_txout.")
+    commit(store)
+
     if store.use_firstbits:
         store.sql("""
             DELETE FROM abe_firstbits WHERE block_id IN (
@@ -197,6 +219,15 @@ def delete_chain_transactions(store, name, chain_id = None):
     log_rowcount(store, "Deleted %d from txout.")
     commit(store)
 
+    store.sql("""
+        DELETE FROM mempool_tx WHERE tx_id IN (
+            SELECT bt.tx_id
+              FROM chain_candidate cc
+              JOIN block_tx bt ON (cc.block_id = bt.block_id)
+             WHERE cc.chain_id = ?)""", (chain_id,))
+    log_rowcount(store, "Deleted %d from mempool_tx.")
+    commit(store)
+
     tx_ids = []
     for row in store.selectall("""
         SELECT tx_id
@@ -0,0 +1,165 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Index of block locations in block files."""
+
+import bisect
+import os
+import struct
+import threading
+
+import util
+
+MAGIC = "AbeBlkIndex1\n"
+
+# Record kind, datadir_id, file number, offset, length, block hash,
+# previous block hash, magic number.
+RECORD = struct.Struct("<cIIII32s32s4s")
+
+BLOCK = "B"    # A block's magic number is at offset.
+END = "E"      # The file is indexed up to offset.
+DISCARD = "D"  # Forget the file's earlier records.
+
+class BlockIndex(object):
+    """
+    Locations of the blocks in each datadir's block files, saved to
+    an append-only file.  Records for a file cover it contiguously
+    from offset 0 to end(), so a scan may take blocks from here up to
+    there and read headers only after it.  Block files are assumed
+    to be only appended to; discard() a file found otherwise.
+    """
+    def __init__(index, filename):
+        index.filename = filename
+        # Map (datadir_id, number) to a list of offsets and a parallel
+        # list of (length, hash, prev_hash, magic).
+        index._offsets = {}
+        index._blocks = {}
+        index._end = {}
+        # Map block hash to (datadir_id, number, offset, length,
+        # prev_hash).
+        index._by_hash = {}
+        index._pending = []
+        index._lock = threading.Lock()
+        index._load()
+
+    def _load(index):
+        try:
+            f = open(index.filename, "rb")
+        except IOError:
+            return
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                return
+            data = f.read()
+        finally:
+            f.close()
+        # Ignore a partial record left by an interrupted write.
+        for pos in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+            index._apply(RECORD.unpack_from(data, pos))
+
+    def _apply(index, record):
+        kind, datadir_id, number, offset, length, hash, prev, magic = record
+        key = (datadir_id, number)
+        if kind == BLOCK:
+            offsets = index._offsets.setdefault(key, [])
+            if offsets and offset <= offsets[-1]:
+                return
+            offsets.append(offset)
+            index._blocks.setdefault(key, []).append(
+                (length, hash, prev, magic))
+            index._by_hash[hash] = (datadir_id, number, offset, length,
+                                    prev)
+        elif kind == END:
+            index._end[key] = offset
+        elif kind == DISCARD:
+            for length, hash, prev, magic in index._blocks.pop(key, ()):
+                loc = index._by_hash.get(hash)
+                if loc is not None and loc[:2] == key:
+                    del index._by_hash[hash]
+            index._offsets.pop(key, None)
+            index._end.pop(key, None)
+
+    def _record(index, *record):
+        with index._lock:
+            index._apply(record)
+            index._pending.append(RECORD.pack(*record))
+
+    def end(index, datadir_id, number):
+        """Return how far the file is indexed."""
+        return index._end.get((int(datadir_id), number), 0)
+
+    def add(index, datadir_id, number, offset, length, hash, prev, magic):
+        """Record a block whose magic number is at offset."""
+        index._record(BLOCK, int(datadir_id), number, offset, length,
+                      hash, prev, magic)
+
+    def set_end(index, datadir_id, number, end):
+        """Record that the file's blocks before end are indexed."""
+        if end > index.end(datadir_id, number):
+            index._record(END, int(datadir_id), number, end, 0,
+                          "", "", "")
+
+    def discard(index, datadir_id, number):
+        index._record(DISCARD, int(datadir_id), number, 0, 0, "", "", "")
+
+    def blocks(index, datadir_id, number, start):
+        """
+        Generate (offset, length, hash, prev_hash, magic) for the
+        file's indexed blocks at or after start, in file order.
+        """
+        key = (int(datadir_id), number)
+        offsets = index._offsets.get(key, [])
+        blocks = index._blocks.get(key, [])
+        for i in xrange(bisect.bisect_left(offsets, start), len(offsets)):
+            length, hash, prev, magic = blocks[i]
+            yield offsets[i], length, hash, prev, magic
+
+    def check(index, datadir_id, number, data):
+        """
+        Return true if data, the file's contents, still holds the last
+        indexed block where recorded.
+        """
+        key = (int(datadir_id), number)
+        if index._end.get(key, 0) > len(data):
+            return False
+        offsets = index._offsets.get(key)
+        if not offsets:
+            return True
+        offset = offsets[-1]
+        length, hash, prev, magic = index._blocks[key][-1]
+        return (data[offset : offset + 4] == magic and
+                struct.unpack("<i", data[offset + 4 : offset + 8])[0]
+                == length and
+                util.double_sha256(data[offset + 8 : offset + 88]) == hash)
+
+    def find(index, hash):
+        """Return (datadir_id, number, offset, length, prev_hash) or None."""
+        return index._by_hash.get(hash)
+
+    def save(index):
+        """Append records added since the last save."""
+        with index._lock:
+            if not index._pending:
+                return
+            exists = os.path.exists(index.filename)
+            f = open(index.filename, "ab")
+            try:
+                if not exists:
+                    f.write(MAGIC)
+                f.write("".join(index._pending))
+            finally:
+                f.close()
+            index._pending = []
@@ -0,0 +1,101 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Bloom filter of 256-bit hashes."""
+
+import math
+import os
+import struct
+
+MAGIC = "AbeBloom1"
+
+class BloomFilter(object):
+    """
+    Set of hashes that may report false positives but never false
+    negatives.  Keys must be uniformly distributed strings of at
+    least 16 bytes, such as transaction hashes; their bytes are used
+    as the hash functions' values.
+    """
+    __slots__ = ('nbits', 'nhashes', 'count', 'bits')
+
+    def __init__(bloom, nbytes, fp_rate):
+        bloom.nbits = max(1, int(nbytes)) * 8
+        bloom.nhashes = max(1, int(round(-math.log(fp_rate, 2))))
+        bloom.count = 0
+        bloom.bits = bytearray(bloom.nbits >> 3)
+
+    def capacity(bloom):
+        """Number of keys that keeps the false positive rate in bounds."""
+        return int(bloom.nbits * math.log(2) / bloom.nhashes)
+
+    def _positions(bloom, key):
+        h1, h2 = struct.unpack("<QQ", key[:16])
+        h2 |= 1
+        nbits = bloom.nbits
+        return [(h1 + i * h2) % nbits for i in xrange(bloom.nhashes)]
+
+    def add(bloom, key):
+        bits = bloom.bits
+        for pos in bloom._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        bloom.count += 1
+
+    def __contains__(bloom, key):
+        bits = bloom.bits
+        for pos in bloom._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(bloom, filename, last_id):
+        """
+        Write the filter to filename.  last_id records how far the
+        caller has added keys, for use on load.
+        """
+        tmp = filename + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            f.write("%s %d %d %d %d\n" % (MAGIC, bloom.nbits, bloom.nhashes,
+                                          bloom.count, last_id))
+            f.write(str(bloom.bits))
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def load(bloom, filename):
+        """
+        Replace the filter's contents with those saved in filename and
+        return the last_id passed to save.  Return None if the file is
+        missing or was saved with different parameters.
+        """
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+        try:
+            header = f.readline().split()
+            if len(header) != 5 or header[0] != MAGIC or \
+                    int(header[1]) != bloom.nbits or \
+                    int(header[2]) != bloom.nhashes:
+                return None
+            bits = bytearray(f.read())
+        finally:
+            f.close()
+        if len(bits) != len(bloom.bits):
+            return None
+        bloom.bits = bits
+        bloom.count = int(header[3])
+        return int(header[4])
@@ -0,0 +1,173 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Load blocks in the background while Abe serves pages."""
+
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+
+import DataStore
+
+class Loader(threading.Thread):
+    """
+    Thread that catches up a DataStore of its own every interval
+    seconds, or as soon as possible after trigger().  Triggers that
+    arrive during a catch-up cause one more catch-up, not one each.
+
+    The serving store, opened with the same args, has already done
+    the startup work described in DataStore.secondary_args, so the
+    loader's store skips it.  It adopts tx_bloom, the serving store's
+    filter, instead of building another.
+
+    tips maps chain_id to the height of its last block after the
+    latest catch-up, and tip_serial increases whenever a tip changes.
+    Request handlers may read both without locking.  The loader's
+    DataStore calls the functions in reorg_listeners as described in
+    DataStore.
+    """
+    def __init__(loader, args, interval, tx_bloom=None):
+        threading.Thread.__init__(loader, name="Loader")
+        loader.daemon = True
+        loader.args = args
+        loader.interval = interval
+        loader.tx_bloom = tx_bloom
+        loader.log = logging.getLogger(__name__)
+        loader.tips = {}
+        loader.tip_serial = 0
+        loader.store = None
+        loader.reorg_listeners = []
+        loader._wake = threading.Event()
+
+    def trigger(loader):
+        loader._wake.set()
+
+    def run(loader):
+        store = DataStore.new(DataStore.secondary_args(loader.args))
+        store.tx_bloom = loader.tx_bloom
+        store.reorg_listeners = loader.reorg_listeners
+        loader.store = store
+        while True:
+            loader._wake.clear()
+            try:
+                store.catch_up()
+                loader._check_tips(store)
+            except Exception:
+                loader.log.exception("Background load failed")
+                store.rollback()
+            loader._wake.wait(loader.interval)
+
+    def _check_tips(loader, store):
+        tips = dict((int(chain_id), int(height))
+                    for chain_id, height in store.selectall("""
+                        SELECT c.chain_id, b.block_height
+                          FROM chain c
+                          JOIN block b ON (b.block_id = c.chain_last_block_id)
+                    """))
+        # End the read transaction.
+        store.commit()
+        if tips != loader.tips:
+            # Replace, not update, so readers see one or the other.
+            loader.tips = tips
+            loader.tip_serial += 1
+            loader.log.info("New chain tips, serial %d", loader.tip_serial)
+
+class NotifyListener(threading.Thread):
+    """
+    Thread that triggers loader whenever a client connects to address,
+    for use by bitcoind's -blocknotify and -walletnotify commands.  An
+    address containing "/" names a Unix socket to create; otherwise it
+    is HOST:PORT.  The reply is an empty HTTP response, so any of these
+    commands work:
+
+        curl -s http://127.0.0.1:PORT/
+        nc -U /path/to/socket < /dev/null
+    """
+    def __init__(listener, loader, address):
+        threading.Thread.__init__(listener, name="NotifyListener")
+        listener.daemon = True
+        listener.loader = loader
+        listener.log = logging.getLogger(__name__)
+
+        if "/" in address:
+            try:
+                os.unlink(address)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            listener.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.sock.bind(address)
+        else:
+            host, port = address.rsplit(":", 1)
+            listener.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.sock.bind((host or "127.0.0.1", int(port)))
+        listener.sock.listen(5)
+        listener.log.info("Listening for load triggers on %s", address)
+
+    def run(listener):
+        while True:
+            conn, addr = listener.sock.accept()
+            listener.loader.trigger()
+            try:
+                conn.settimeout(1)
+                try:
+                    conn.recv(4096)
+                except socket.error:
+                    pass
+                conn.sendall("HTTP/1.0 204 No Content\r\n\r\n")
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+class BlkfileWatcher(threading.Thread):
+    """
+    Thread that triggers loader when the size or modification time of
+    a datadir's current or next block file changes.  Checks every
+    interval seconds.
+    """
+    def __init__(watcher, loader, interval):
+        threading.Thread.__init__(watcher, name="BlkfileWatcher")
+        watcher.daemon = True
+        watcher.loader = loader
+        watcher.interval = interval
+        watcher.seen = {}
+
+    def run(watcher):
+        while True:
+            time.sleep(watcher.interval)
+            store = watcher.loader.store
+            if store is None:
+                continue
+            changed = False
+            for dircfg in store.datadirs:
+                number = dircfg['blkfile_number']
+                for filename in (store.blkfile_name(dircfg, number),
+                                 store.blkfile_name(dircfg, number + 1)):
+                    try:
+                        st = os.stat(filename)
+                        state = (st.st_size, st.st_mtime)
+                    except OSError:
+                        state = None
+                    if watcher.seen.get(filename, state) != state:
+                        changed = True
+                    watcher.seen[filename] = state
+            if changed:
+                watcher.loader.trigger()
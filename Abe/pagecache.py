@@ -0,0 +1,75 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Cache of rendered pages that do not change."""
+
+import collections
+import threading
+
+class PageCache(object):
+    """
+    Rendered pages holding at most max_bytes of keys and content,
+    evicting the least recently used first.  Each page is tagged with
+    the (chain_id, block_height) of the blocks it shows, and
+    invalidate() drops pages showing blocks above a fork.  Safe for
+    use by several threads.
+    """
+    def __init__(cache, max_bytes):
+        cache.max_bytes = max_bytes
+        cache.size = 0
+        # Increases on invalidate(), so put() can refuse pages rendered
+        # from data since reorganized.
+        cache.serial = 0
+        # Map key to (value, nbytes, tags), oldest first.
+        cache._pages = collections.OrderedDict()
+        cache._lock = threading.Lock()
+
+    def get(cache, key):
+        with cache._lock:
+            entry = cache._pages.pop(key, None)
+            if entry is None:
+                return None
+            cache._pages[key] = entry
+            return entry[0]
+
+    def put(cache, key, value, nbytes, tags, serial):
+        """
+        Store value, whose content is nbytes long, under key unless
+        the cache was invalidated after serial was read.
+        """
+        nbytes += len(key)
+        with cache._lock:
+            if serial != cache.serial or nbytes > cache.max_bytes:
+                return
+            old = cache._pages.pop(key, None)
+            if old is not None:
+                cache.size -= old[1]
+            cache._pages[key] = (value, nbytes, tags)
+            cache.size += nbytes
+            while cache.size > cache.max_bytes:
+                key, entry = cache._pages.popitem(last=False)
+                cache.size -= entry[1]
+
+    def invalidate(cache, chain_id, fork_height):
+        """Drop pages showing chain_id's blocks above fork_height."""
+        with cache._lock:
+            cache.serial += 1
+            for key, entry in cache._pages.items():
+                for tag_chain_id, height in entry[2]:
+                    if tag_chain_id == chain_id and height > fork_height:
+                        del cache._pages[key]
+                        cache.size -= entry[1]
+                        break
@@ -49,6 +49,29 @@ def keep_scriptsig_reconfigure(store, args):
     finally:
         store.release_lock(lock)
 
+def id_block_size_reconfigure(store, args):
+    if args.id_block_size is None:
+        return
+    have = store.id_block_size
+    want = int(args.id_block_size)
+    if have == want:
+        return
+    if want < 1 or (store.config.get('sequence_type') == 'mysql' and
+                    want > DataStore.MYSQL_MAX_AUTO_INCREMENT_INCREMENT):
+        store.log.warn("Invalid id-block-size: %d", want)
+        return
+    lock = store.get_lock()
+    try:
+        # Loaders must not run while shrinking native sequence
+        # increments, or the next values may fall in a reserved block.
+        for key in DataStore.ID_BLOCK_KEYS:
+            store.set_sequence_increment(key, want)
+        store.set_configvar("id_block_size", str(want))
+        store.commit()
+        store._set_sql_flavour()
+    finally:
+        store.release_lock(lock)
+
 def main(argv):
     conf = {
         "debug":                    None,
@@ -68,6 +91,7 @@ Apply configuration changes to an existing Abe database, if possible.
   --use-firstbits {true|false}
                             Turn Firstbits support on or off.
   --keep-scriptsig false    Remove input validation scripts from the database.
+  --id-block-size N         Reserve table identifiers N at a time.
 
 All configuration variables may be given as command arguments.""")
         return 0
@@ -83,6 +107,7 @@ All configuration variables may be given as command arguments.""")
     store = DataStore.new(args)
     firstbits.reconfigure(store, args)
     keep_scriptsig_reconfigure(store, args)
+    id_block_size_reconfigure(store, args)
     return 0
 
 if __name__ == '__main__':
@@ -19,6 +19,7 @@
 
 import os
 import sys
+import time
 import DataStore
 import util
 
@@ -889,6 +890,84 @@ def populate_pubkeys(store):
                 count += 1
         store.log.info("Found %d", count)
 
+def create_mempool_tx(store):
+    store.ddl("""CREATE TABLE mempool_tx (
+        tx_id         NUMERIC(26) NOT NULL PRIMARY KEY,
+        first_seen    NUMERIC(20) NOT NULL,
+        FOREIGN KEY (tx_id) REFERENCES tx (tx_id)
+    )""")
+
+def populate_mempool_tx(store):
+    # Transactions in no block came from the memory pool or import_tx.
+    # Track them as if first seen now, so they may expire.
+    store.sql("""
+        INSERT INTO mempool_tx (tx_id, first_seen)
+        SELECT tx.tx_id, ?
+          FROM tx
+         WHERE NOT EXISTS (
+               SELECT 1
+                 FROM block_tx bt
+                WHERE bt.tx_id = tx.tx_id)""", (int(time.time()),))
+
+def create_address_balance(store):
+    store.ddl("""CREATE TABLE address_balance (
+        chain_id      NUMERIC(10) NOT NULL,
+        pubkey_id     NUMERIC(26) NOT NULL,
+        received      NUMERIC(30) NOT NULL,
+        sent          NUMERIC(30) NOT NULL,
+        txout_count   NUMERIC(20) NOT NULL,
+        txin_count    NUMERIC(20) NOT NULL,
+        PRIMARY KEY (chain_id, pubkey_id),
+        FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+        FOREIGN KEY (pubkey_id) REFERENCES pubkey (pubkey_id)
+    )""")
+
+def populate_address_balance(store):
+    if store.config.get('bulk_load') != "true":
+        store.rebuild_address_balance()
+
+def create_address_history(store):
+    store.ddl("""CREATE TABLE address_history (
+        pubkey_id     NUMERIC(26) NOT NULL,
+        block_height  NUMERIC(14) NOT NULL,
+        tx_pos        NUMERIC(10) NOT NULL,
+        chain_id      NUMERIC(10) NOT NULL,
+        is_in         NUMERIC(1) NOT NULL,
+        io_pos        NUMERIC(10) NOT NULL,
+        block_id      NUMERIC(14) NOT NULL,
+        tx_id         NUMERIC(26) NOT NULL,
+        delta         NUMERIC(30) NOT NULL,
+        balance       NUMERIC(30) NOT NULL,
+        PRIMARY KEY (pubkey_id, block_height, tx_pos, chain_id, is_in, io_pos),
+        FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+        FOREIGN KEY (block_id) REFERENCES block (block_id),
+        FOREIGN KEY (tx_id) REFERENCES tx (tx_id)
+    )""")
+    store.ddl("""CREATE INDEX x_address_history_block
+        ON address_history (block_id)""")
+
+def populate_address_history(store):
+    if store.config.get('bulk_load') != "true":
+        store.rebuild_address_history()
+
+def create_unspent_txout(store):
+    store.ddl("""CREATE TABLE unspent_txout (
+        chain_id      NUMERIC(10) NOT NULL,
+        txout_id      NUMERIC(26) NOT NULL,
+        pubkey_id     NUMERIC(26) NOT NULL,
+        block_height  NUMERIC(14) NOT NULL,
+        PRIMARY KEY (chain_id, txout_id),
+        FOREIGN KEY (chain_id) REFERENCES chain (chain_id),
+        FOREIGN KEY (txout_id) REFERENCES txout (txout_id),
+        FOREIGN KEY (pubkey_id) REFERENCES pubkey (pubkey_id)
+    )""")
+    store.ddl("""CREATE INDEX x_unspent_txout_pubkey
+        ON unspent_txout (pubkey_id)""")
+
+def populate_unspent_txout(store):
+    if store.config.get('bulk_load') != "true":
+        store.rebuild_unspent_txout()
+
 upgrades = [
     ('6',    add_block_value_in),
     ('6.1',  add_block_value_out),
@@ -971,7 +1050,15 @@ upgrades = [
     ('Abe32.2', drop_tmp_datadir),       # Fast
     ('Abe33',   add_datadir_loader),     # Fast
     ('Abe34',   populate_pubkeys),       # Minutes?
-    ('Abe35', None)
+    ('Abe35',   create_mempool_tx),      # Fast
+    ('Abe35.1', populate_mempool_tx),    # Seconds
+    ('Abe36',   create_address_balance), # Fast
+    ('Abe36.1', populate_address_balance), # Minutes
+    ('Abe37',   create_address_history), # Fast
+    ('Abe37.1', populate_address_history), # Minutes to hours
+    ('Abe38',   create_unspent_txout), # Fast
+    ('Abe38.1', populate_unspent_txout), # Minutes
+    ('Abe39', None)
 ]
 
 def upgrade_schema(store):
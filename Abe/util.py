@@ -3,6 +3,7 @@
 #
 
 import re
+import sys
 import base58
 import Crypto.Hash.SHA256 as SHA256
 
@@ -137,12 +138,221 @@ def jsonrpc(url, method, *params):
                            "method": method, "params": params, "id": "x"})
     respdata = urllib.urlopen(url, postdata).read()
     resp = json.loads(respdata)
+    return _jsonrpc_result(resp, method, params)
+
+def _jsonrpc_result(resp, method, params):
     if resp.get('error') is not None:
         if resp['error']['code'] == -32601:
             raise JsonrpcMethodNotFound(resp['error'], method, params)
         raise JsonrpcException(resp['error'], method, params)
     return resp['result']
 
+class JsonrpcClient(object):
+    """
+    JSON-RPC client that keeps up to pool_size HTTP/1.1 connections
+    open between calls.  Threads may share a client.  A request that
+    fails on a pooled connection, which the server may have closed
+    while idle, is sent once more on a new connection, so methods
+    called through a client should be safe to repeat.
+    """
+    def __init__(client, url, timeout=None, pool_size=2):
+        import base64, urllib, urlparse, threading
+        parts = urlparse.urlsplit(url)
+        client.host = parts.hostname
+        client.port = parts.port
+        client.path = parts.path or "/"
+        client.timeout = timeout
+        client.pool_size = pool_size
+        client.headers = {"Content-Type": "application/json"}
+        if parts.username is not None:
+            client.headers["Authorization"] = "Basic " + base64.b64encode(
+                urllib.unquote(parts.username) + ":" +
+                urllib.unquote(parts.password or ""))
+        client._idle = []
+        client._lock = threading.Lock()
+
+    def call(client, method, *params):
+        import json
+        resp = client._post(json.dumps({
+                    "jsonrpc": "2.0", "method": method, "params": params,
+                    "id": "x"}))
+        return _jsonrpc_result(resp, method, params)
+
+    def batch(client, calls):
+        """
+        Send calls, a sequence of (method, params) pairs, in one
+        request.  Return their results in the same order, with a
+        JsonrpcException in place of the result of each call that
+        failed.
+        """
+        import json
+        if not calls:
+            return []
+        resp = client._post(json.dumps([
+                    {"jsonrpc": "2.0", "method": method, "params": params,
+                     "id": i}
+                    for i, (method, params) in enumerate(calls)]))
+        if not isinstance(resp, list):
+            # The server rejected the request as a whole.
+            _jsonrpc_result(resp, "batch", calls)
+            raise IOError("JSON-RPC server did not return a batch response")
+
+        results = [None] * len(calls)
+        for r in resp:
+            i = r.get('id')
+            method, params = calls[i]
+            try:
+                results[i] = _jsonrpc_result(r, method, params)
+            except JsonrpcException, e:
+                results[i] = e
+        return results
+
+    def close(client):
+        with client._lock:
+            idle, client._idle = client._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _connect(client):
+        import httplib
+        return httplib.HTTPConnection(client.host, client.port,
+                                      timeout=client.timeout)
+
+    def _send(client, conn, body):
+        conn.request("POST", client.path, body, client.headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def _post(client, body):
+        import httplib, json, socket
+        with client._lock:
+            conn = client._idle.pop() if client._idle else None
+        try:
+            if conn is None:
+                conn = client._connect()
+                resp, data = client._send(conn, body)
+            else:
+                try:
+                    resp, data = client._send(conn, body)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    conn = client._connect()
+                    resp, data = client._send(conn, body)
+        except:
+            # _connect itself may have failed.
+            if conn is not None:
+                conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            with client._lock:
+                if len(client._idle) < client.pool_size:
+                    client._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise IOError("JSON-RPC server returned HTTP %d %s" %
+                          (resp.status, resp.reason))
+
 def is_coinbase_tx(tx):
     return len(tx['txIn']) == 1 and tx['txIn'][0]['prevout_hash'] == \
         "\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0"
+
+# Rough size of a dict slot holding an entry's key and value.
+DICT_ENTRY_BYTES = 48
+
+class LRUCache(object):
+    """
+    Mapping of at most max_size entries that evicts the least recently
+    used entry when full.  Counts hits and misses for tuning max_size.
+    """
+    # Each entry is a circular list node [prev, next, key, value].
+    __slots__ = ('max_size', 'hits', 'misses', '_map', '_root')
+
+    def __init__(cache, max_size):
+        cache.max_size = max_size
+        cache.hits = 0
+        cache.misses = 0
+        cache.clear()
+
+    def clear(cache):
+        root = []
+        root[:] = [root, root, None, None]
+        cache._root = root
+        cache._map = {}
+
+    def __len__(cache):
+        return len(cache._map)
+
+    def __contains__(cache, key):
+        return key in cache._map
+
+    def _unlink(cache, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(cache, link):
+        root = cache._root
+        link[0] = root[0]
+        link[1] = root
+        root[0][1] = link
+        root[0] = link
+
+    def get(cache, key, default=None):
+        link = cache._map.get(key)
+        if link is None:
+            cache.misses += 1
+            return default
+        cache.hits += 1
+        cache._unlink(link)
+        cache._append(link)
+        return link[3]
+
+    def pop(cache, key, default=None):
+        link = cache._map.pop(key, None)
+        if link is None:
+            cache.misses += 1
+            return default
+        cache.hits += 1
+        cache._unlink(link)
+        return link[3]
+
+    def __setitem__(cache, key, value):
+        link = cache._map.get(key)
+        if link is not None:
+            link[3] = value
+            cache._unlink(link)
+        else:
+            if len(cache._map) >= cache.max_size:
+                oldest = cache._root[1]
+                cache._unlink(oldest)
+                del cache._map[oldest[2]]
+            link = [None, None, key, value]
+            cache._map[key] = link
+        cache._append(link)
+
+    def __delitem__(cache, key):
+        cache._unlink(cache._map.pop(key))
+
+    def memory_use(cache):
+        """Estimate bytes used, assuming entries resemble the newest."""
+        if not cache._map:
+            return 0
+        link = cache._root[0]
+        entry = sys.getsizeof(link) + sys.getsizeof(link[2]) + \
+            sys.getsizeof(link[3]) + DICT_ENTRY_BYTES
+        return sys.getsizeof(cache._map) + len(cache._map) * entry
+
+    def stats(cache):
+        lookups = cache.hits + cache.misses
+        return "%d hits, %d misses (%.1f%% hits), %d of %d entries," \
+            " about %d KiB" % (
+            cache.hits, cache.misses,
+            100.0 * cache.hits / lookups if lookups else 0,
+            len(cache._map), cache.max_size, cache.memory_use() / 1024)
@@ -0,0 +1,54 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Test configuration.  Run "py.test test" from the top directory."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from Abe import DataStore, readconf
+
+@pytest.fixture
+def datadir(tmpdir):
+    """A directory for blk0001.dat."""
+    return tmpdir.mkdir("data")
+
+@pytest.fixture
+def new_store(tmpdir, datadir):
+    """
+    Function returning a new DataStore for an SQLite database in
+    tmpdir that loads datadir.  Arguments are extra options, as on
+    the command line.  Stores are closed after the test.
+    """
+    stores = []
+    def new_store(*argv):
+        conf = DataStore.CONFIG_DEFAULTS.copy()
+        args, argv = readconf.parse_argv(
+            ["--dbtype", "sqlite3",
+             "--connect-args", str(tmpdir.join("abe.sqlite")),
+             "--datadir", str(datadir),
+             "--default-loader", "blkfile"] + list(argv), conf)
+        assert argv == []
+        store = DataStore.new(args)
+        stores.append(store)
+        return store
+    yield new_store
+    for store in stores:
+        store.close()
@@ -0,0 +1,162 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Made-up Testnet block chains written as block files."""
+
+import hashlib
+import random
+import struct
+
+from Abe import BCDataStream, util
+
+MAGIC = "\xfa\xbf\xb5\xda"  # Testnet
+NBITS = 0x207fffff
+COIN = 10 ** 8
+
+ADDRESSES = [hashlib.sha256("address %d" % i).digest()[:20]
+             for i in xrange(8)]
+PUBKEYS = ["\x04" + hashlib.sha256("pubkey %d" % i).digest() * 2
+           for i in xrange(3)]
+
+def p2pkh(pubkey_hash):
+    return "\x76\xa9\x14" + pubkey_hash + "\x88\xac"
+
+def p2pk(pubkey):
+    return chr(len(pubkey)) + pubkey + "\xac"
+
+def serialize_tx(tx):
+    ds = BCDataStream.BCDataStream()
+    ds.write_int32(1)
+    ds.write_compact_size(len(tx['txIn']))
+    for txin in tx['txIn']:
+        ds.write(txin['prevout_hash'])
+        ds.write_uint32(txin['prevout_n'])
+        ds.write_string(txin['scriptSig'])
+        ds.write_uint32(0xffffffff)
+    ds.write_compact_size(len(tx['txOut']))
+    for txout in tx['txOut']:
+        ds.write_int64(txout['value'])
+        ds.write_string(txout['scriptPubKey'])
+    ds.write_uint32(0)
+    return ds.input
+
+class Chain(object):
+    """
+    Blocks made on demand, each spending outputs of its ancestors and
+    of earlier transactions in the same block.  Outputs pay a few
+    fixed addresses, so their balances and histories are interesting.
+    """
+    def __init__(chain, seed=1):
+        chain.rnd = random.Random(seed)
+        # Map hash to (data, height, unspent outputs, transactions).
+        chain.blocks = {}
+        chain.tip = None
+        chain.time = 1300000000
+
+    def height(chain, block_hash):
+        return chain.blocks[block_hash][1]
+
+    def txs(chain, block_hash):
+        """Return the block's serialized transactions."""
+        return chain.blocks[block_hash][3]
+
+    def block(chain, prev=None, ntx=4, tag=""):
+        """
+        Make a block after prev, by default the last block made, and
+        return its hash.  tag distinguishes blocks of competing
+        branches at the same height.
+        """
+        if prev is None:
+            prev = chain.tip
+        if prev is None:
+            height, unspent, prev_hash = 0, [], "\0" * 32
+        else:
+            height = chain.blocks[prev][1] + 1
+            unspent = list(chain.blocks[prev][2])
+            prev_hash = prev
+        rnd = chain.rnd
+
+        coinbase = {
+            'txIn': [{'prevout_hash': "\0" * 32, 'prevout_n': 0xffffffff,
+                      'scriptSig': struct.pack("<I", height) + tag}],
+            'txOut': [{'value': 50 * COIN, 'scriptPubKey':
+                           p2pk(rnd.choice(PUBKEYS)) if height % 3 == 0
+                       else p2pkh(rnd.choice(ADDRESSES))}]}
+        txs = [coinbase]
+        fees = 0
+        for i in xrange(ntx):
+            if not unspent:
+                break
+            spent = [unspent.pop(rnd.randrange(len(unspent)))
+                     for j in xrange(min(len(unspent), rnd.randint(1, 3)))]
+            fee = 1000
+            remaining = sum(value for (h, n, value) in spent) - fee
+            nout = rnd.randint(1, 3)
+            outs = []
+            for j in xrange(nout):
+                value = remaining if j == nout - 1 else remaining / (nout - j)
+                remaining -= value
+                outs.append({'value': value, 'scriptPubKey':
+                                 p2pkh(rnd.choice(ADDRESSES))})
+            tx = {'txIn': [{'prevout_hash': h, 'prevout_n': n,
+                            'scriptSig': "\x01\x02"} for (h, n, v) in spent],
+                  'txOut': outs}
+            txs.append(tx)
+            fees += fee
+            tx_hash = util.double_sha256(serialize_tx(tx))
+            unspent += [(tx_hash, n, out['value'])
+                        for n, out in enumerate(outs)]
+        coinbase['txOut'][0]['value'] += fees
+        unspent.append((util.double_sha256(serialize_tx(coinbase)), 0,
+                        coinbase['txOut'][0]['value']))
+
+        raw_txs = map(serialize_tx, txs)
+        chain.time += 600
+        header = {
+            'version': 1, 'hashPrev': prev_hash,
+            'hashMerkleRoot': util.merkle(map(util.double_sha256, raw_txs)),
+            'nTime': chain.time, 'nBits': NBITS, 'nNonce': height}
+        ds = BCDataStream.BCDataStream()
+        ds.write_int32(header['version'])
+        ds.write(header['hashPrev'])
+        ds.write(header['hashMerkleRoot'])
+        ds.write_uint32(header['nTime'])
+        ds.write_uint32(header['nBits'])
+        ds.write_uint32(header['nNonce'])
+        ds.write_compact_size(len(raw_txs))
+        block_hash = util.block_hash(header)
+        chain.blocks[block_hash] = (ds.input + "".join(raw_txs), height,
+                                    unspent, raw_txs)
+        chain.tip = block_hash
+        return block_hash
+
+    def branch(chain, count, prev=None, **kwargs):
+        """Make count blocks after prev and return their hashes."""
+        hashes = []
+        for i in xrange(count):
+            prev = chain.block(prev, **kwargs)
+            hashes.append(prev)
+        return hashes
+
+    def write(chain, filename, hashes):
+        """Append the blocks to filename in the order given."""
+        f = open(filename, "ab")
+        try:
+            for block_hash in hashes:
+                data = chain.blocks[block_hash][0]
+                f.write(MAGIC + struct.pack("<i", len(data)) + data)
+        finally:
+            f.close()
@@ -0,0 +1,140 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import hashlib
+import json
+import StringIO
+
+import pytest
+
+from Abe import abe, util
+import datagen
+
+TESTNET_VERSION = "\x6f"
+
+@pytest.fixture
+def serve(monkeypatch, tmpdir, datadir):
+    """
+    Function that loads datadir, requests each of paths, and returns
+    a list of (status, body) or ("error", exception).  Arguments
+    after paths are extra options.
+    """
+    def serve(paths, *argv):
+        responses = []
+        def serve_store(store):
+            app = abe.Abe(store, store.args)
+            try:
+                for path in paths:
+                    path, sep, query = path.partition("?")
+                    env = {
+                        'PATH_INFO': path, 'QUERY_STRING': query,
+                        'SCRIPT_NAME': '', 'REQUEST_METHOD': 'GET',
+                        'wsgi.url_scheme': 'http', 'HTTP_HOST': 'localhost',
+                        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                        'wsgi.input': StringIO.StringIO()}
+                    status = []
+                    try:
+                        body = "".join(app(env, lambda s, h: status.append(s)))
+                        responses.append((status[0], body))
+                    except Exception, e:
+                        store.rollback()
+                        responses.append(("error", e))
+            finally:
+                store.close()
+        monkeypatch.setattr(abe, "serve", serve_store)
+        assert abe.main(["--dbtype", "sqlite3",
+                         "--connect-args", str(tmpdir.join("abe.sqlite")),
+                         "--datadir", str(datadir),
+                         "--default-loader", "blkfile"] + list(argv)) == 0
+        return responses
+    return serve
+
+@pytest.fixture
+def chain(datadir):
+    chain = datagen.Chain()
+    chain.write(str(datadir.join("blk0001.dat")), chain.branch(12, ntx=6))
+    return chain
+
+def address(pubkey_hash):
+    return util.hash_to_address(TESTNET_VERSION, pubkey_hash)
+
+UNUSED = address(hashlib.sha256("unused").digest()[:20])
+
+def reformat(body):
+    return json.dumps(json.loads(body), sort_keys=True, indent=2)
+
+@pytest.mark.parametrize("items", [
+        [], [1], [1, "two"], [{"b": [1, {"c": None}], "a": {}}, []]])
+@pytest.mark.parametrize("depth", [0, 1, 2])
+def test_json_array(items, depth):
+    value = items
+    for i in xrange(depth):
+        value = {"k": value}
+    prefix = "".join('{\n' + '  ' * (i + 1) + '"k": ' for i in xrange(depth))
+    suffix = "".join('\n' + '  ' * i + '}' for i in reversed(xrange(depth)))
+    assert prefix + "".join(abe.json_array(iter(items), depth)) + suffix == \
+        json.dumps(value, sort_keys=True, indent=2)
+
+@pytest.mark.parametrize("page_size", ["100", "5", "-1"])
+def test_addresshistory_json(serve, chain, page_size):
+    used = address(datagen.ADDRESSES[0])
+    responses = serve(["/addresshistory/" + UNUSED,
+                       "/addresshistory/" + used,
+                       "/addresshistory/" + used + "?limit=3"],
+                      "--address-history-page-size", page_size)
+    empty, full, limited = responses
+    assert empty == ("200 OK", json.dumps(
+            {"history": [], "next": None}, sort_keys=True, indent=2))
+    for status, body in (full, limited):
+        assert status == "200 OK"
+        assert body == reformat(body)
+    history = json.loads(full[1])["history"]
+    assert len(history) > 3
+    assert (json.loads(full[1])["next"] is None) == (page_size != "5")
+    # Pages end between transactions.
+    page = json.loads(limited[1])["history"]
+    assert len(page) >= 3 and page == history[:len(page)]
+    assert json.loads(limited[1])["next"] is not None
+
+def test_unspent_json(serve, chain):
+    addrs = "|".join(address(pubkey_hash)
+                     for pubkey_hash in datagen.ADDRESSES[:3])
+    for max_rows in ["1000", "-1"]:
+        ((status, body),) = serve(["/unspent/" + addrs],
+                                  "--address-history-rows-max", max_rows)
+        assert status == "200 OK"
+        assert json.loads(body)["unspent_outputs"]
+        assert body == reformat(body)
+
+def boom(size):
+    yield "x" * size
+    raise ValueError("boom")
+
+def test_stream_error_before_first_chunk(serve, chain, monkeypatch):
+    def handle_boom(app, page):
+        page['body'] = [boom(10)]
+    monkeypatch.setattr(abe.Abe, "handle_boom", handle_boom, raising=False)
+    ((status, e),) = serve(["/boom"])
+    assert status == "error" and str(e) == "boom"
+
+def test_stream_error_after_first_chunk(serve, chain, monkeypatch, caplog):
+    def handle_boom(app, page):
+        page['body'] = [boom(abe.STREAM_CHUNK_BYTES)]
+    monkeypatch.setattr(abe.Abe, "handle_boom", handle_boom, raising=False)
+    ((status, body),) = serve(["/boom"])
+    assert status == "200 OK"
+    assert "x" * abe.STREAM_CHUNK_BYTES in body
+    assert "Truncated http://localhost/boom" in caplog.text
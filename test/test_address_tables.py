@@ -0,0 +1,146 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Tables that loading maintains, checked against their definitions."""
+
+import pytest
+
+import datagen
+
+def load_stages(store, blkfile):
+    """
+    Load a chain, then a longer branch from its third block, then the
+    first branch grown longer again.  Yield the name of each stage
+    after loading it.
+    """
+    chain = datagen.Chain()
+    first = chain.branch(6, ntx=6)
+    chain.write(blkfile, first)
+    store.catch_up()
+    yield "connect"
+
+    second = chain.branch(5, prev=first[2], ntx=6, tag="b")
+    chain.write(blkfile, second)
+    store.catch_up()
+    yield "reorg"
+
+    chain.write(blkfile, chain.branch(4, prev=first[-1], ntx=6))
+    store.catch_up()
+    yield "reorg back"
+
+@pytest.fixture
+def stages(new_store, datadir):
+    store = new_store()
+    return store, load_stages(store, str(datadir.join("blk0001.dat")))
+
+def chain_ids(store):
+    return [int(chain_id) for (chain_id,) in
+            store.selectall("SELECT chain_id FROM chain")]
+
+def address_balances(store):
+    return set(tuple(int(value) for value in row)
+               for row in store.selectall("""
+                   SELECT chain_id, pubkey_id, received, sent, txout_count,
+                          txin_count
+                     FROM address_balance
+                    WHERE txout_count > 0"""))
+
+def side_blocks(store):
+    return store.selectrow("""
+        SELECT COUNT(1)
+          FROM chain_candidate
+         WHERE in_longest = 0""")[0]
+
+def test_stages(stages):
+    store, loading = stages
+    sides = []
+    for stage in loading:
+        sides.append(side_blocks(store))
+    assert sides == [0, 3, 5]
+
+def test_address_balance(stages):
+    store, loading = stages
+    for stage in loading:
+        pubkeys = [(int(pubkey_id), store.binout(pubkey_hash))
+                   for pubkey_id, pubkey_hash in store.selectall("""
+                       SELECT pubkey_id, pubkey_hash FROM pubkey""")]
+        for chain_id in chain_ids(store):
+            for pubkey_id, pubkey_hash in pubkeys:
+                received = store.get_received_and_last_block_id(
+                    chain_id, pubkey_hash)[0]
+                sent = store.get_sent_and_last_block_id(
+                    chain_id, pubkey_hash)[0]
+                assert (store.get_received(chain_id, pubkey_hash),
+                        store.get_sent(chain_id, pubkey_hash)) == \
+                        (int(received), int(sent)), stage
+
+        maintained = address_balances(store)
+        assert maintained, stage
+        for pubkey_id, pubkey_hash in pubkeys:
+            txins = dict(
+                (int(chain_id), int(count))
+                for chain_id, count in store.selectall("""
+                    SELECT chain_id, COUNT(1)
+                      FROM address_history
+                     WHERE pubkey_id = ?
+                       AND is_in = 1
+                     GROUP BY chain_id""", (pubkey_id,)))
+            totals = store.get_address_totals(pubkey_id)
+            assert dict((chain_id, total[3]) for chain_id, total in
+                        totals.iteritems() if total[3]) == txins, stage
+        store.rebuild_address_balance()
+        assert address_balances(store) == maintained, stage
+
+def test_bulk_load_in_other_store(new_store, datadir):
+    chain = datagen.Chain()
+    chain.write(str(datadir.join("blk0001.dat")), chain.branch(5))
+    reader = new_store()
+    assert not reader.is_bulk_loading()
+
+    loader = new_store("--bulk-load")
+    assert reader.is_bulk_loading()
+    loader.catch_up()
+    assert not reader.is_bulk_loading()
+    assert address_balances(reader)
+
+def address_history(store):
+    return sorted(tuple(int(value) for value in row)
+                  for row in store.selectall("""
+                      SELECT pubkey_id, block_height, tx_pos, chain_id,
+                             is_in, io_pos, block_id, tx_id, delta, balance
+                        FROM address_history"""))
+
+def test_address_history(stages):
+    store, loading = stages
+    for stage in loading:
+        maintained = address_history(store)
+        assert maintained, stage
+        store.rebuild_address_history()
+        assert address_history(store) == maintained, stage
+
+def unspent_txout(store):
+    return sorted(tuple(int(value) for value in row)
+                  for row in store.selectall("""
+                      SELECT chain_id, txout_id, pubkey_id, block_height
+                        FROM unspent_txout"""))
+
+def test_unspent_txout(stages):
+    store, loading = stages
+    for stage in loading:
+        maintained = unspent_txout(store)
+        assert maintained, stage
+        store.rebuild_unspent_txout()
+        assert unspent_txout(store) == maintained, stage
@@ -0,0 +1,83 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+from Abe.blkindex import BlockIndex
+import datagen
+
+def spy_scan(store):
+    """Return a list that collects the hashes of blocks scanned."""
+    scanned = []
+    skip_known_blocks = store._skip_known_blocks
+    def spy(blocks, ds):
+        def gen():
+            for block in blocks:
+                scanned.append(block[0])
+                yield block
+        return skip_known_blocks(gen(), ds)
+    store._skip_known_blocks = spy
+    return scanned
+
+def count_statements(store):
+    stmts = []
+    execute = store._execute
+    def counting(stmt, params, many=False):
+        stmts.append(stmt)
+        return execute(stmt, params, many)
+    store._execute = counting
+    return stmts
+
+def load(store):
+    """Catch up and close store, so that the next may write."""
+    store.catch_up()
+    store.close()
+
+def test_index_added_to_loaded_database(new_store, datadir, tmpdir):
+    chain = datagen.Chain()
+    hashes = chain.branch(8)
+    blkfile = str(datadir.join("blk0001.dat"))
+    chain.write(blkfile, hashes[:5])
+    load(new_store())
+
+    # Index from the saved offset after block 5.
+    chain.write(blkfile, hashes[5:])
+    index_file = str(tmpdir.join("blkindex"))
+    store = new_store("--blkfile-index", index_file)
+    scanned = spy_scan(store)
+    (datadir_id,) = store.selectrow("SELECT datadir_id FROM datadir")
+    load(store)
+    assert scanned == hashes[5:]
+    assert [block[2] for block in BlockIndex(index_file).blocks(
+                datadir_id, 1, 0)] == hashes
+
+    store = new_store("--blkfile-index", index_file, "--rescan")
+    scanned = spy_scan(store)
+    load(store)
+    assert scanned == hashes
+
+def test_rescan_statements(new_store, datadir, tmpdir):
+    chain = datagen.Chain()
+    hashes = chain.branch(60)
+    blkfile = str(datadir.join("blk0001.dat"))
+    counts = []
+    for blocks in (hashes[:10], hashes[10:]):
+        chain.write(blkfile, blocks)
+        load(new_store())
+        store = new_store("--rescan")
+        stmts = count_statements(store)
+        load(store)
+        counts.append(len(stmts))
+    # One query per IN_LIST_MAX blocks finds them all loaded.
+    assert counts[0] == counts[1] < 20
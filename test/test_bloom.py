@@ -0,0 +1,185 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import hashlib
+
+import pytest
+
+from Abe.bloom import BloomFilter
+import datagen
+
+def key(i):
+    return hashlib.sha256(str(i)).digest()
+
+def test_add_and_contains():
+    bloom = BloomFilter(2000, 0.001)
+    for i in xrange(1000):
+        bloom.add(key(i))
+    assert bloom.count == 1000
+    assert all(key(i) in bloom for i in xrange(1000))
+    false_positives = sum(key(i) in bloom for i in xrange(1000, 11000))
+    assert false_positives < 100
+
+def test_empty_filter_contains_nothing():
+    bloom = BloomFilter(100, 0.01)
+    assert not any(key(i) in bloom for i in xrange(100))
+
+def test_save_and_load(tmpdir):
+    filename = str(tmpdir.join("tx.bloom"))
+    bloom = BloomFilter(1000, 0.01)
+    for i in xrange(300):
+        bloom.add(key(i))
+    bloom.save(filename, 1234)
+
+    loaded = BloomFilter(1000, 0.01)
+    assert loaded.load(filename) == 1234
+    assert loaded.count == 300
+    assert loaded.bits == bloom.bits
+    assert all(key(i) in loaded for i in xrange(300))
+
+def test_load_missing_file(tmpdir):
+    bloom = BloomFilter(1000, 0.01)
+    assert bloom.load(str(tmpdir.join("missing"))) is None
+
+@pytest.mark.parametrize("nbytes,fp_rate", [(2000, 0.01), (1000, 0.001)])
+def test_load_parameter_mismatch(tmpdir, nbytes, fp_rate):
+    filename = str(tmpdir.join("tx.bloom"))
+    bloom = BloomFilter(1000, 0.01)
+    bloom.add(key(1))
+    bloom.save(filename, 7)
+
+    other = BloomFilter(nbytes, fp_rate)
+    assert other.load(filename) is None
+    assert other.count == 0
+    assert key(1) not in other
+
+def test_load_truncated_file(tmpdir):
+    filename = tmpdir.join("tx.bloom")
+    bloom = BloomFilter(1000, 0.01)
+    bloom.save(str(filename), 7)
+    filename.write(filename.read("rb")[:-1], "wb")
+    assert BloomFilter(1000, 0.01).load(str(filename)) is None
+
+# Loading with tx-bloom-bytes.
+
+def count_lookups(store):
+    calls = []
+    find = store.tx_find_id_and_value
+    def counting(tx, is_coinbase):
+        calls.append(tx['hash'])
+        return find(tx, is_coinbase)
+    store.tx_find_id_and_value = counting
+    return calls
+
+class LockConnection(object):
+    """Stands in for the connection that get_lock() returns."""
+    def __init__(conn):
+        conn.locks = 1
+        conn.rowcount = 1
+    def cursor(conn):
+        return conn
+    def execute(conn, stmt):
+        conn.locks += 1
+    def rollback(conn):
+        pass
+    def close(conn):
+        pass
+
+def hold_load_lock(store):
+    """Let store act as on a database that get_lock() can lock.
+    Return the list of connections it gets."""
+    conns = []
+    def get_lock():
+        conns.append(LockConnection())
+        return conns[-1]
+    store.get_lock = get_lock
+    return conns
+
+def block_count(store):
+    return store.selectrow("SELECT COUNT(1) FROM block")[0]
+
+def test_lookups_not_skipped_without_load_lock(new_store, datadir):
+    chain = datagen.Chain()
+    chain.write(str(datadir.join("blk0001.dat")), chain.branch(5))
+    store = new_store("--tx-bloom-bytes", "10000")
+    # As on SQLite, without the wait for a lock that never comes.
+    store.get_lock = lambda: None
+    lookups = count_lookups(store)
+    store.catch_up()
+    assert block_count(store) == 5
+    assert len(lookups) == store.selectrow("SELECT COUNT(1) FROM tx")[0]
+
+def test_lookups_skipped_with_load_lock(new_store, datadir):
+    chain = datagen.Chain()
+    chain.write(str(datadir.join("blk0001.dat")), chain.branch(5))
+    store = new_store("--tx-bloom-bytes", "10000")
+    hold_load_lock(store)
+    lookups = count_lookups(store)
+    store.catch_up()
+    assert block_count(store) == 5
+    assert lookups == []
+    assert store._load_lock is None
+
+@pytest.mark.parametrize("commit_bytes", ["0", "100000"])
+@pytest.mark.parametrize("batch_insert", [[], ["--batch-insert"]])
+def test_transaction_stored_by_other_process(new_store, datadir,
+                                             commit_bytes, batch_insert):
+    chain = datagen.Chain()
+    hashes = chain.branch(6)
+    chain.write(str(datadir.join("blk0001.dat")), hashes)
+    args = ["--commit-bytes", commit_bytes] + batch_insert
+    store = new_store("--tx-bloom-bytes", "10000", *args)
+    hold_load_lock(store)
+
+    # Another process, unseen by the filter, stores a transaction
+    # of block 3.
+    other = new_store(*args)
+    other.maybe_import_binary_tx(chain.txs(hashes[3])[1])
+    other.commit()
+
+    store.catch_up()
+    assert block_count(store) == 6
+    (last_block,) = store.selectrow("""
+        SELECT b.block_hash
+          FROM chain c
+          JOIN block b ON (b.block_id = c.chain_last_block_id)""")
+    assert store.hashout(last_block) == hashes[-1]
+    if commit_bytes != "0":
+        # Retried with lookups.
+        assert store._tx_bloom_stale
+
+def test_load_lock_kept_between_catch_ups(new_store, datadir):
+    blkfile = str(datadir.join("blk0001.dat"))
+    chain = datagen.Chain()
+    chain.write(blkfile, chain.branch(3))
+    store = new_store("--tx-bloom-bytes", "10000",
+                      "--txout-cache-size", "1000")
+    conns = hold_load_lock(store)
+    store.catch_up()
+
+    rollbacks = []
+    store.rollback = lambda: rollbacks.append(1)
+    cached = len(store.txout_cache)
+    lookups = count_lookups(store)
+    for i in xrange(2):
+        chain.write(blkfile, chain.branch(1))
+        store.catch_up()
+    assert block_count(store) == 5
+    assert lookups == []
+    assert rollbacks == []
+    assert len(store.txout_cache) > cached
+    assert len(conns) == 1 and conns[0].locks == 3
+    assert store._load_lock is None
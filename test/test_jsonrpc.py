@@ -0,0 +1,150 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import BaseHTTPServer
+import json
+import socket
+import threading
+
+import pytest
+
+from Abe import util
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer each call with its method name and params."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(handler):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(handler)
+        handler.server.connections += 1
+
+    def do_POST(handler):
+        server = handler.server
+        request = json.loads(handler.rfile.read(
+                int(handler.headers['Content-Length'])))
+        if server.raw_reply is not None:
+            body = server.raw_reply
+        elif isinstance(request, list):
+            body = json.dumps([reply(r) for r in request])
+        else:
+            body = json.dumps(reply(request))
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        server.requests += 1
+        # Drop the connection without telling the client, as a server
+        # closing an idle connection might.
+        handler.close_connection = server.drop_connections
+
+    def log_message(handler, *args):
+        pass
+
+def reply(request):
+    if request['method'] == 'fail':
+        return {"id": request['id'], "result": None,
+                "error": {"code": -5, "message": "failed"}}
+    if request['method'] == 'missing':
+        return {"id": request['id'], "result": None,
+                "error": {"code": -32601, "message": "no such method"}}
+    return {"id": request['id'], "error": None,
+            "result": [request['method']] + request['params']}
+
+@pytest.fixture
+def server():
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.requests = 0
+    server.raw_reply = None
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def client_for(server, **kwargs):
+    host, port = server.server_address
+    return util.JsonrpcClient("http://user:pw@%s:%d/" % (host, port),
+                              timeout=5, **kwargs)
+
+def test_call_reuses_connection(server):
+    client = client_for(server)
+    assert client.call("echo", 1, "a") == ["echo", 1, "a"]
+    assert client.call("echo", 2) == ["echo", 2]
+    assert server.connections == 1
+    client.close()
+
+def test_batch(server):
+    client = client_for(server)
+    results = client.batch([("echo", [1]), ("fail", []), ("echo", [2])])
+    assert results[0] == ["echo", 1]
+    assert isinstance(results[1], util.JsonrpcException)
+    assert results[2] == ["echo", 2]
+    assert client.batch([]) == []
+    client.close()
+
+def test_errors(server):
+    client = client_for(server)
+    with pytest.raises(util.JsonrpcMethodNotFound):
+        client.call("missing")
+    with pytest.raises(util.JsonrpcException):
+        client.call("fail")
+    server.raw_reply = "<html>Unauthorized</html>"
+    with pytest.raises(IOError):
+        client.call("echo")
+    client.close()
+
+def test_reconnects_after_server_drops_idle_connection(server):
+    client = client_for(server)
+    server.drop_connections = True
+    assert client.call("echo", 1) == ["echo", 1]
+    assert client.call("echo", 2) == ["echo", 2]
+    assert client.call("echo", 3) == ["echo", 3]
+    assert server.requests == 3
+    assert server.connections == 3
+    client.close()
+
+def test_connection_refused(server):
+    host, port = server.server_address
+    server.shutdown()
+    server.server_close()
+    client = util.JsonrpcClient("http://%s:%d/" % (host, port), timeout=5)
+    with pytest.raises(socket.error):
+        client.call("echo")
+    assert client._idle == []
+
+def test_connect_failure_is_not_hidden(server):
+    client = client_for(server)
+    def connect():
+        raise ValueError("cannot connect")
+    client._connect = connect
+    with pytest.raises(ValueError):
+        client.call("echo")
+
+def test_reconnect_failure_is_not_hidden(server):
+    client = client_for(server)
+    assert client.call("echo") == ["echo"]
+    server.drop_connections = True
+    client.call("echo")  # The server drops this pooled connection.
+    def connect():
+        raise ValueError("cannot connect")
+    client._connect = connect
+    with pytest.raises(ValueError):
+        client.call("echo")
@@ -0,0 +1,100 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import time
+
+from Abe import DataStore, abe
+from Abe.loader import Loader
+import datagen
+
+def test_loader_store_skips_startup_work(new_store, datadir, monkeypatch):
+    chain = datagen.Chain()
+    hashes = chain.branch(4)
+    chain.write(str(datadir.join("blk0001.dat")), hashes[:3])
+    tx = chain.txs(hashes[3])[0]
+    store = new_store("--import-tx", '["%s"]' % tx.encode('hex'),
+                      "--tx-bloom-bytes", "10000")
+    store.commit()
+
+    builds = []
+    init_tx_bloom = DataStore.DataStore._init_tx_bloom
+    def counting(store, *args):
+        builds.append(store)
+        return init_tx_bloom(store, *args)
+    monkeypatch.setattr(DataStore.DataStore, "_init_tx_bloom", counting)
+    # As on SQLite, without the wait for a lock that never comes.
+    monkeypatch.setattr(DataStore.DataStore, "get_lock", lambda store: None)
+    imports = []
+    monkeypatch.setattr(DataStore.DataStore, "maybe_import_binary_tx",
+                        lambda store, binary_tx: imports.append(binary_tx))
+
+    loader = Loader(store.args, 1000, store.tx_bloom)
+    loader.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if store.selectrow("SELECT COUNT(1) FROM block")[0] == 3:
+            break
+        store.commit()
+        time.sleep(0.05)
+    assert store.selectrow("SELECT COUNT(1) FROM block")[0] == 3
+    assert builds == [] and imports == []
+    assert loader.store.tx_bloom is store.tx_bloom
+    assert not loader.store.args.import_tx
+    assert store.args.import_tx
+
+def test_tips_spare_block_number_lookups(new_store, datadir, tmpdir,
+                                         monkeypatch):
+    chain = datagen.Chain()
+    chain.write(str(datadir.join("blk0001.dat")), chain.branch(5))
+    loaded = new_store()
+    loaded.catch_up()
+    (chain_id,) = loaded.selectrow(
+        "SELECT DISTINCT chain_id FROM chain_candidate")
+    chain_id = int(chain_id)
+    loaded.close()
+
+    result = []
+    def serve_store(store):
+        bg_loader = Loader(store.args, 1000)
+        bg_loader.start()
+        deadline = time.time() + 10
+        while bg_loader.tip_serial == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        app = abe.Abe(store, store.args, bg_loader)
+        def get_block_number(chain_id):
+            raise AssertionError("looked up the block number")
+        store.get_block_number = get_block_number
+        result.append((bg_loader.tip_serial, bg_loader.tips[chain_id],
+                       app.is_buried([(chain_id, 4)]),
+                       app.is_buried([(chain_id, 0)])))
+
+        chain.write(str(datadir.join("blk0001.dat")), chain.branch(4))
+        bg_loader.trigger()
+        deadline = time.time() + 10
+        while bg_loader.tip_serial == 1 and time.time() < deadline:
+            time.sleep(0.05)
+        result.append((bg_loader.tip_serial, bg_loader.tips[chain_id],
+                       app.is_buried([(chain_id, 4)]),
+                       app.is_buried([(chain_id, 5)])))
+        store.close()
+    monkeypatch.setattr(abe, "serve", serve_store)
+    monkeypatch.setattr(DataStore.DataStore, "get_lock", lambda store: None)
+    assert abe.main(["--dbtype", "sqlite3",
+                     "--connect-args", str(tmpdir.join("abe.sqlite")),
+                     "--datadir", str(datadir),
+                     "--default-loader", "blkfile",
+                     "--page-cache-depth", "5"]) == 0
+    assert result == [(1, 4, False, True), (2, 8, True, False)]
@@ -0,0 +1,93 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""The in-memory arrays of main chain block ids."""
+
+import datagen
+
+def longest(store):
+    """Return chain_id and the block_id at each height of its longest
+    branch, as the database has them."""
+    ((chain_id,),) = store.selectall(
+        "SELECT DISTINCT chain_id FROM chain_candidate")
+    return int(chain_id), [int(block_id) for (block_id,) in store.selectall("""
+        SELECT block_id
+          FROM chain_candidate
+         WHERE chain_id = ? AND in_longest = 1
+         ORDER BY block_height""", (chain_id,))]
+
+def loaded(store, chain_id):
+    tip_id = longest(store)[1][-1]
+    store.get_block_id_at_height(0, tip_id)
+    return store._main_chains[chain_id]
+
+def count_loads(store, monkeypatch):
+    loads = []
+    load = store._load_main_chains
+    def counting():
+        loads.append(1)
+        load()
+    monkeypatch.setattr(store, "_load_main_chains", counting)
+    return loads
+
+def test_rollback_keeps_arrays(new_store, datadir, monkeypatch):
+    blkfile = str(datadir.join("blk0001.dat"))
+    chain = datagen.Chain()
+    chain.write(blkfile, chain.branch(6, ntx=1))
+    store = new_store()
+    store.catch_up()
+    chain_id, ids = longest(store)
+    assert list(loaded(store, chain_id)) == ids
+    loads = count_loads(store, monkeypatch)
+
+    store.rollback()
+    assert list(store._main_chains[chain_id]) == ids
+
+    # A rolled-back disconnect leaves only the heights below it.
+    store.disconnect_block(ids[4], chain_id)
+    store.rollback()
+    assert longest(store)[1] == ids
+    assert list(store._main_chains[chain_id]) == ids[:4]
+    assert store.get_block_id_at_height(2, ids[5]) == ids[2]
+
+    chain.write(blkfile, chain.branch(3, ntx=1))
+    store.catch_up()
+    assert list(store._main_chains[chain_id]) == longest(store)[1]
+    assert loads == []
+
+def test_other_process_moves_tip(new_store, datadir, monkeypatch):
+    blkfile = str(datadir.join("blk0001.dat"))
+    chain = datagen.Chain()
+    first = chain.branch(6, ntx=1)
+    chain.write(blkfile, first)
+    store = new_store()
+    store.catch_up()
+    chain_id, ids = longest(store)
+    assert list(loaded(store, chain_id)) == ids
+    loads = count_loads(store, monkeypatch)
+
+    # Another process reorganizes the chain and extends it.
+    chain.write(blkfile, chain.branch(4, prev=first[2], ntx=1, tag="b"))
+    other = new_store()
+    other.catch_up()
+    other.close()
+
+    chain.write(blkfile, chain.branch(2, ntx=1, tag="b"))
+    store.catch_up()
+    ids = longest(store)[1]
+    assert len(ids) == 9
+    assert list(store._main_chains[chain_id]) == ids
+    assert loads == []
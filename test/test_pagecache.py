@@ -0,0 +1,80 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+from Abe.pagecache import PageCache
+
+def put(cache, key, nbytes, tags=((1, 10),)):
+    cache.put(key, "page " + key, nbytes, list(tags), cache.serial)
+
+def test_get_and_size():
+    cache = PageCache(1000)
+    assert cache.get("/a") is None
+    put(cache, "/a", 100)
+    put(cache, "/bb", 200)
+    assert cache.get("/a") == "page /a"
+    assert cache.size == 100 + len("/a") + 200 + len("/bb")
+
+    # Replacing a page replaces its size.
+    put(cache, "/a", 50)
+    assert cache.size == 50 + len("/a") + 200 + len("/bb")
+
+def test_evicts_least_recently_used():
+    cache = PageCache(3 * (100 + 2))
+    for key in ("/a", "/b", "/c"):
+        put(cache, key, 100)
+    cache.get("/a")
+    put(cache, "/d", 100)
+    assert cache.get("/b") is None
+    assert [cache.get(key) is not None for key in ("/a", "/c", "/d")] == \
+        [True, True, True]
+    assert cache.size == 3 * (100 + 2)
+
+    # One large page may evict several, oldest first.
+    put(cache, "/e", 200)
+    assert [key for key in ("/a", "/c", "/d", "/e")
+            if cache.get(key) is not None] == ["/d", "/e"]
+    assert cache.size == 102 + 202
+
+def test_page_larger_than_cache_not_stored():
+    cache = PageCache(100)
+    put(cache, "/a", 50)
+    put(cache, "/big", 100)
+    assert cache.get("/big") is None
+    assert cache.get("/a") == "page /a"
+    assert cache.size == 50 + 2
+
+def test_invalidate_above_fork_height():
+    cache = PageCache(10000)
+    put(cache, "/below", 10, [(1, 9)])
+    put(cache, "/at", 10, [(1, 10)])
+    put(cache, "/above", 10, [(1, 11)])
+    put(cache, "/mixed", 10, [(1, 5), (1, 12)])
+    put(cache, "/other", 10, [(2, 11)])
+    cache.invalidate(1, 10)
+    assert [key for key in ("/below", "/at", "/above", "/mixed", "/other")
+            if cache.get(key) is not None] == ["/below", "/at", "/other"]
+    assert cache.size == 3 * 10 + len("/below") + len("/at") + len("/other")
+
+def test_stale_put_refused():
+    cache = PageCache(10000)
+    serial = cache.serial
+    # A reorganization while the page renders.
+    cache.invalidate(1, 100)
+    cache.put("/a", "page /a", 10, [(1, 5)], serial)
+    assert cache.get("/a") is None
+    assert cache.size == 0
+    cache.put("/a", "page /a", 10, [(1, 5)], cache.serial)
+    assert cache.get("/a") == "page /a"
@@ -0,0 +1,101 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import logging
+import threading
+
+from Abe import util
+from Abe.DataStore import RpcPrefetcher
+
+class FakeClient(object):
+    """Answers batches for a chain of blocks, each of two transactions."""
+    def __init__(client, nblocks):
+        client.blocks = ["%064x" % (1000 + i) for i in xrange(nblocks)]
+        client.calls = []
+        client.in_batch = 0
+        client.closed = False
+        client.entered = threading.Event()
+        client.release = threading.Event()
+        client.release.set()
+
+    def txs(client, height):
+        return ["%064x" % (2000 + 2 * height), "%064x" % (2001 + 2 * height)]
+
+    def batch(client, calls):
+        assert not client.closed
+        client.in_batch += 1
+        client.entered.set()
+        try:
+            client.release.wait()
+            return [client._call(method, params) for method, params in calls]
+        finally:
+            client.in_batch -= 1
+
+    def _call(client, method, params):
+        client.calls.append((method, params[0]))
+        if method == "getblockhash":
+            if params[0] >= len(client.blocks):
+                return util.JsonrpcException(
+                    {'code': -1, 'message': 'out of range'}, method, params)
+            return client.blocks[params[0]]
+        if method == "getblock":
+            height = client.blocks.index(params[0])
+            return {'hash': params[0], 'tx': client.txs(height)}
+        return "raw " + params[0]
+
+    def close(client):
+        client.closed = True
+
+def prefetch(client, **kwargs):
+    fetch = RpcPrefetcher(client, 0, 2, 2, logging.getLogger(__name__),
+                          **kwargs)
+    fetch.start()
+    return fetch
+
+def test_yields_blocks_with_transactions():
+    client = FakeClient(3)
+    got = list(prefetch(client))
+    assert [height for height, rpc_hash, rpc_block, raw_txs in got] == \
+        [0, 1, 2]
+    for height, rpc_hash, rpc_block, raw_txs in got:
+        assert rpc_hash == client.blocks[height]
+        assert raw_txs == dict((tx_hash, "raw " + tx_hash)
+                               for tx_hash in client.txs(height))
+
+def test_known_transactions_not_fetched():
+    client = FakeClient(3)
+    known = set([client.txs(0)[0], client.txs(2)[1]])
+    got = list(prefetch(client, known=known.__contains__))
+    fetched = set(tx_hash for method, tx_hash in client.calls
+                  if method == "getrawtransaction")
+    assert fetched.isdisjoint(known)
+    for height, rpc_hash, rpc_block, raw_txs in got:
+        for tx_hash in client.txs(height):
+            assert raw_txs.get(tx_hash) == \
+                (None if tx_hash in known else "raw " + tx_hash)
+
+def test_join_waits_for_request_in_progress():
+    client = FakeClient(10)
+    client.release.clear()
+    fetch = prefetch(client)
+    client.entered.wait()
+    fetch.stop()
+    fetch.join(0.1)
+    assert fetch.is_alive()
+    client.release.set()
+    fetch.join()
+    client.close()
+    assert client.in_batch == 0
@@ -0,0 +1,51 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Reserving blocks of identifiers."""
+
+import pytest
+
+from Abe import DataStore
+
+class MysqlStatements(object):
+    """Records what _reserve_ids_mysql sends, as MySQL would see it."""
+    def __init__(stmts, last_insert_id):
+        stmts.sent = []
+        stmts.last_insert_id = last_insert_id
+    def sql(stmts, stmt, params=()):
+        stmts.sent.append((stmt, params))
+    def selectrow(stmts, stmt, params=()):
+        stmts.sent.append((stmt, params))
+        return (stmts.last_insert_id,)
+
+def test_reserve_ids_mysql_inserts_one_row(new_store, monkeypatch):
+    store = new_store()
+    stmts = MysqlStatements(2001)
+    monkeypatch.setattr(store, "sql", stmts.sql)
+    monkeypatch.setattr(store, "selectrow", stmts.selectrow)
+    assert store._reserve_ids_mysql('tx', 1000) == 2001
+    assert stmts.sent == [
+        ("SET SESSION auto_increment_increment = 1000", ()),
+        ("INSERT INTO tx_seq () VALUES ()", ()),
+        ("SELECT LAST_INSERT_ID()", ()),
+        ("SET SESSION auto_increment_increment = 1", ()),
+        ("DELETE FROM tx_seq WHERE id < ?", (2001,))]
+
+def test_reserve_ids_mysql_limit(new_store):
+    store = new_store()
+    with pytest.raises(Exception):
+        store._reserve_ids_mysql(
+            'tx', DataStore.MYSQL_MAX_AUTO_INCREMENT_INCREMENT + 1)
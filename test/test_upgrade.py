@@ -0,0 +1,44 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+from Abe import upgrade
+import datagen
+
+def test_populate_mempool_tx(new_store, datadir):
+    chain = datagen.Chain()
+    hashes = chain.branch(3)
+    chain.write(str(datadir.join("blk0001.dat")), hashes[:2])
+    store = new_store()
+    store.catch_up()
+    # Transactions of a block not loaded, as if from the memory pool.
+    for binary_tx in chain.txs(hashes[2]):
+        store.maybe_import_binary_tx(binary_tx)
+
+    store.sql("DROP TABLE mempool_tx")
+    store.sql("""UPDATE configvar SET configvar_value = 'Abe35'
+                  WHERE configvar_name = 'schema_version'""")
+    store.config['schema_version'] = 'Abe35'
+    # Create and populate the table, leaving later tables alone.
+    start = [vers for vers, func in upgrade.upgrades].index('Abe35')
+    upgrade.run_upgrades_locked(store, upgrade.upgrades[start : start + 3])
+
+    tracked = set(store.hashout(tx_hash) for (tx_hash,) in store.selectall("""
+        SELECT tx.tx_hash
+          FROM mempool_tx mt
+          JOIN tx ON (mt.tx_id = tx.tx_id)"""))
+    assert tracked == set(datagen.util.double_sha256(binary_tx)
+                          for binary_tx in chain.txs(hashes[2]))
+    assert store.config['schema_version'] == 'Abe36'
@@ -0,0 +1,80 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+from Abe.util import LRUCache
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(3)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['c'] = 3
+    assert cache.get('a') == 1  # 'b' is now the oldest.
+    cache['d'] = 4
+    assert 'b' not in cache
+    assert [k for k in 'acd' if k in cache] == ['a', 'c', 'd']
+
+def test_lru_update_refreshes_entry():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a'] = 10
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.get('a') == 10
+
+def test_lru_max_size():
+    cache = LRUCache(5)
+    for i in xrange(100):
+        cache[i] = i
+        assert len(cache) == min(i + 1, 5)
+    assert [i for i in xrange(100) if i in cache] == range(95, 100)
+
+def test_lru_pop_and_del():
+    cache = LRUCache(3)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'gone') == 'gone'
+    del cache['b']
+    assert len(cache) == 0
+    cache['c'] = 3
+    cache['d'] = 4
+    cache['e'] = 5
+    cache['f'] = 6
+    assert 'c' not in cache and len(cache) == 3
+
+def test_lru_hits_and_misses():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache.get('a')
+    cache.get('z')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_lru_clear():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache.clear()
+    assert len(cache) == 0
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.memory_use() == 0
+    # Still bounded and ordered after clearing.
+    cache['c'] = 3
+    cache['d'] = 4
+    cache['e'] = 5
+    assert 'c' not in cache
+    assert cache.get('d') == 4 and cache.get('e') == 5
@@ -0,0 +1,83 @@
+# Copyright(C) 2013 by Abe developers.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import sqlite3
+import types
+
+import pytest
+
+def fake_module(name):
+    module = types.ModuleType(name)
+    module.DatabaseError = type("DatabaseError", (Exception,), {})
+    module.OperationalError = type(
+        "OperationalError", (module.DatabaseError,), {})
+    module.IntegrityError = type(
+        "IntegrityError", (module.DatabaseError,), {})
+    return module
+
+def pg_error(module, cls, pgcode):
+    e = getattr(module, cls)("error")
+    e.pgcode = pgcode
+    return e
+
+@pytest.mark.parametrize("name,make,conflict", [
+        ("psycopg2", lambda m: pg_error(m, "OperationalError", "40P01"), True),
+        ("psycopg2", lambda m: pg_error(m, "OperationalError", "40001"), True),
+        ("psycopg2", lambda m: pg_error(m, "OperationalError", "55P03"), True),
+        ("psycopg2", lambda m: pg_error(m, "IntegrityError", "23505"), False),
+        ("psycopg2", lambda m: pg_error(m, "OperationalError", "57P01"),
+         False),
+        ("MySQLdb", lambda m: m.OperationalError(1213, "Deadlock found"), True),
+        ("MySQLdb", lambda m: m.OperationalError(1205, "Lock wait timeout"),
+         True),
+        ("MySQLdb", lambda m: m.IntegrityError(1062, "Duplicate entry"),
+         False),
+        ("MySQLdb", lambda m: m.OperationalError(
+                1146, "Table 'abe.lock_x' doesn't exist"), False),
+        ("MySQLdb", lambda m: ValueError(1213), False),
+        ])
+def test_is_lock_conflict(new_store, name, make, conflict):
+    store = new_store()
+    store.module = fake_module(name)
+    assert store._is_lock_conflict(make(store.module)) == conflict
+
+@pytest.mark.parametrize("e,conflict", [
+        (sqlite3.OperationalError("database is locked"), True),
+        (sqlite3.OperationalError("database table is locked"), True),
+        (sqlite3.OperationalError("no such table: block_lock"), False),
+        (sqlite3.IntegrityError("UNIQUE constraint failed: tx.tx_hash"),
+         False),
+        ])
+def test_is_lock_conflict_sqlite(new_store, e, conflict):
+    assert new_store()._is_lock_conflict(e) == conflict
+
+def test_new_worker_state(new_store):
+    store = new_store("--txout-cache-size", "100", "--pubkey-cache-size", "100",
+                      "--tx-bloom-bytes", "1000")
+    worker = store._new_worker()
+    try:
+        assert worker.conn is not store.conn
+        for attr in ("config", "txout_cache", "pubkey_cache", "_blocks",
+                     "_reserved_ids", "_sql_cache", "import_stats"):
+            assert getattr(worker, attr) is not getattr(store, attr)
+        for attr in ("datadirs", "tx_bloom", "_tx_bloom_lock",
+                     "_mempool_seen", "reorg_listeners"):
+            assert getattr(worker, attr) is getattr(store, attr)
+        # SQL functions use the worker's own connection.
+        assert worker.selectrow("SELECT 1")[0] == 1
+        assert store.cursor is not worker.cursor
+    finally:
+        worker.close()